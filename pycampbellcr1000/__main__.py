@@ -10,16 +10,32 @@
 
 '''
 import os
+import sys
+import json
 import argparse
 
 from datetime import datetime
+from functools import partial
+from contextlib import contextmanager
+
+from pylink import link_from_url
 
 # Make sure the logger is configured early:
 from . import VERSION
 from .logger import active_logger
-from .compat import stdout
+from .compat import stdout, is_py3
 from .device import CR1000
-from .utils import csv_to_dict, ListDict
+from .utils import csv_last_row, parse_datetime, CSVWriter
+from .sinks import SQLiteSink, ArrowSink
+from .store import ColumnStore
+from .tob3 import convert, convert_parquet
+from .archive import RawArchive
+from .timeindex import TimeIndex
+from .backfill import backfill
+from .trace import FrameCapture, read_capture
+from .simulator import Simulator, SimulatorServer, SimTable
+from .impairment import ImpairedLink, benchmark
+from .utils import bytes_to_hex
 
 
 NOW = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -77,30 +93,69 @@ def listtables_cmd(args, device):
         print(tablename.decode('utf-8'))
 
 
-def getdata_cmd(args, device, header=True, exclude_first=False):
-    '''Getdata command.'''
+def latest_cmd(args, device):
+    '''Latest command.'''
     try:
         args.delim = args.delim.decode("string-escape")
     except:
         args.delim = args.delim
-        
-    if args.start is not None:
-        args.start = datetime.strptime(args.start, "%Y-%m-%d %H:%M")
-    if args.stop is not None:
-        args.stop = datetime.strptime(args.stop, "%Y-%m-%d %H:%M")
+    records = device.get_latest(args.table, args.n, compact=True)
+    writer = CSVWriter(sys.stdout, delimiter=args.delim)
+    writer.writerows(records)
+    writer.close()
+
+
+@contextmanager
+def open_csv(filename):
+    '''Open `filename` to write CSV, or use the standard output if it is
+    "-". The csv module writes its own line terminators, so the newlines
+    must not be translated.'''
+    if filename == '-':
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    if is_py3:
+        file_output = open(filename, 'w', newline='')
+    else:
+        file_output = open(filename, 'wb')
+    try:
+        yield file_output
+    finally:
+        file_output.close()
+
+
+def is_new_record(record, last):
+    '''Check if `record` comes after the `last` (Datetime, RecNbr) resume
+    point. RecNbr is None when it can not be trusted.'''
+    dtime, recnbr = last
+    if record['Datetime'] != dtime:
+        return record['Datetime'] > dtime
+    return recnbr is not None and record['RecNbr'] > recnbr
+
+
+def download(args, device, write, after=None):
+    '''Download the records of `args.table` and pass each packet to
+    `write`. Records up to the `after` (Datetime, RecNbr) resume point are
+    skipped. Returns the resume point of the last written record.'''
     print("Your download is starting.")
+    if args.index is not None:
+        device.time_index = TimeIndex(args.index)
     total_records = 0
-    generator = device.get_data_generator(args.table, args.start, args.stop)
+    last = after
+    generator = device.get_data_generator(args.table, args.start, args.stop,
+                                          compact=True,
+                                          prefetch=args.prefetch,
+                                          workers=args.workers)
     for i, records in enumerate(generator):
-        if exclude_first:
-            records = ListDict(records[1:])
-            exclude_first = False
+        if after is not None:
+            records = [item for item in records if is_new_record(item, after)]
+            if records:
+                after = None
         total_records += len(records)
         print("Packet %d with %d records" % (i, len(records)))
-        args.output.write("%s" % records.to_csv(delimiter=args.delim,
-                                                header=header))
-        if header:
-            header = False
+        write(records)
+        if records:
+            last = (records[-1]['Datetime'], records[-1]['RecNbr'])
 
     print("---------------------------")
     if total_records == 0:
@@ -109,29 +164,240 @@ def getdata_cmd(args, device, header=True, exclude_first=False):
         print("1 new record was found")
     else:
         print("%d new records were found" % total_records)
+    return last
 
 
-def update_cmd(args, device):
-    '''Update command.'''
+def getdata_cmd(args, device):
+    '''Getdata command.'''
+    try:
+        args.delim = args.delim.decode("string-escape")
+    except:
+        args.delim = args.delim
+        
+    if args.start is not None:
+        args.start = datetime.strptime(args.start, "%Y-%m-%d %H:%M")
+    if args.stop is not None:
+        args.stop = datetime.strptime(args.stop, "%Y-%m-%d %H:%M")
+    if args.format == 'sqlite':
+        sink = SQLiteSink(args.output, device.table_def)
+        download(args, device, partial(sink.write, args.table))
+        sink.close()
+    else:
+        with open_csv(args.output) as file_output:
+            writer = CSVWriter(file_output, delimiter=args.delim)
+            download(args, device, writer.writerows)
+            writer.close()
+
+
+def get_state_filename(db):
+    '''Return the name of the update state file of `db`.'''
+    return '%s.state' % db
+
+
+def read_update_state(db, table, signature):
+    '''Return the (Datetime, RecNbr) resume point saved by the last update
+    of `db`, or None if there is no state or if `db` was modified since.'''
+    try:
+        with open(get_state_filename(db)) as file_state:
+            state = json.load(file_state)
+    except (IOError, OSError, ValueError):
+        return None
+    if state.get('Table') != table or \
+            state.get('Size') != os.path.getsize(db):
+        return None
+    dtime = parse_datetime(state['Datetime'])
+    # record numbers restart when the table definition changes
+    if state.get('Signature') != signature:
+        return dtime, None
+    return dtime, state['RecNbr']
+
+
+def write_update_state(db, table, signature, last):
+    '''Save the (Datetime, RecNbr) resume point of `db`.'''
+    state = {'Table': table,
+             'Signature': signature,
+             'Datetime': str(last[0]),
+             'RecNbr': last[1],
+             'Size': os.path.getsize(db)}
+    with open(get_state_filename(db), 'w') as file_state:
+        json.dump(state, file_state)
+
+
+def update_csv(args, device):
+    '''Update a CSV database.'''
     # create file if not exist
     with open(args.db, 'a'):
         os.utime(args.db, None)
-    with open(args.db, 'r') as file_db:
-        db = csv_to_dict(file_db, delimiter=args.delim)
-    with open(args.db, 'a') as file_db:
-        args.start = None
-        args.stop = None
-        if len(db) > 0:
-            db = db.sorted_by("Datetime", reverse=True)
-            format = "%Y-%m-%d %H:%M:%S"
-            start_date = datetime.strptime(db[0]['Datetime'], format)
-            # exclude this record
-            args.start = start_date.strftime("%Y-%m-%d %H:%M")
-            args.output = file_db
-            getdata_cmd(args, device, header=False, exclude_first=True)
+    signature = device.table_signature(args.table)
+    last = read_update_state(args.db, args.table, signature)
+    if last is None:
+        # no usable state: read the last row of the database
+        with open(args.db, 'rb') as file_db:
+            row = csv_last_row(file_db, delimiter=args.delim)
+        if row is not None:
+            last = (parse_datetime(row['Datetime']), None)
+    if is_py3:
+        file_db = open(args.db, 'a', newline='')
+    else:
+        file_db = open(args.db, 'ab')
+    with file_db:
+        writer = CSVWriter(file_db, delimiter=args.delim,
+                           header=last is None)
+        if last is not None:
+            args.start = last[0]
+        last = download(args, device, writer.writerows, after=last)
+        writer.close()
+    if last is not None:
+        write_update_state(args.db, args.table, signature, last)
+
+
+def update_sink(args, device, sink):
+    '''Update an SQLite database, a column store or a Parquet dataset.'''
+    last = sink.last_record(args.table)
+    if last is not None:
+        args.start = last[0]
+    download(args, device, partial(sink.write, args.table), after=last)
+    sink.close()
+
+
+def update_cmd(args, device):
+    '''Update command.'''
+    try:
+        args.delim = args.delim.decode("string-escape")
+    except:
+        args.delim = args.delim
+    args.start = None
+    args.stop = None
+    if args.format == 'sqlite':
+        update_sink(args, device, SQLiteSink(args.db, device.table_def))
+    elif args.format == 'store':
+        update_sink(args, device, ColumnStore(args.db, device.table_def))
+    elif args.format == 'parquet':
+        update_sink(args, device, ArrowSink(args.db, device.table_def,
+                                            station=args.station))
+    else:
+        update_csv(args, device)
+
+
+def backfill_cmd(args, device):
+    '''Backfill command.'''
+    sink = SQLiteSink(args.db, device.table_def)
+    total = backfill(device, sink, args.table, args.blocks)
+    sink.close()
+    print("%d missing records were found" % total)
+
+
+def convert_cmd(args, device):
+    '''Convert command.'''
+    try:
+        args.delim = args.delim.decode("string-escape")
+    except:
+        args.delim = args.delim
+    for filename in args.files:
+        if args.format == 'parquet':
+            output = args.output
+            total = convert_parquet(filename, output, args.workers)
         else:
-            args.output = file_db
-            getdata_cmd(args, device, header=True)
+            name = os.path.splitext(os.path.basename(filename))[0]
+            output = os.path.join(args.output, '%s.csv' % name)
+            with open_csv(output) as file_output:
+                total = convert(filename, file_output, args.workers,
+                                delimiter=args.delim)
+        print("%s : %d records written to %s" % (filename, total, output))
+
+
+def capture_cmd(args, device):
+    '''Capture command.'''
+    archive = RawArchive(args.archive)
+    count = len(archive.entries)
+    recnbr = device.capture_data(args.table, archive)
+    print("%d responses captured, next record %d" %
+          (len(archive.entries) - count, recnbr))
+    archive.close()
+
+
+def decode_cmd(args, device):
+    '''Decode command.'''
+    try:
+        args.delim = args.delim.decode("string-escape")
+    except:
+        args.delim = args.delim
+    archive = RawArchive(args.archive)
+    total = 0
+    with open_csv(args.output) as file_output:
+        writer = CSVWriter(file_output, delimiter=args.delim)
+        for records in archive.iter_records(args.table):
+            writer.writerows(records)
+            total += len(records)
+        writer.close()
+    archive.close()
+    print("%d records written to %s" % (total, args.output))
+
+
+def frames_cmd(args, device):
+    '''Frames command.'''
+    for frame in read_capture(args.capture):
+        dtime = datetime.fromtimestamp(frame.time)
+        direction = 'write' if frame.direction == FrameCapture.OUT \
+            else 'read'
+        print("%s %-5s %s" % (dtime.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                              direction, bytes_to_hex(frame.packet)))
+        if frame.header:
+            print("    %s" % ', '.join('%s=%s' % item for item in
+                                       sorted(frame.header.items())))
+
+
+def simulate_cmd(args, device):
+    '''Simulate command.'''
+    table = SimTable(args.table, [('Batt_Volt', 'FP2'), ('Temp', 'IEEE4B'),
+                                  ('Count', 'UInt4')],
+                     records=args.records, interval=args.interval)
+    simulator = Simulator([table], latency=args.latency,
+                          baudrate=args.baudrate,
+                          please_wait=args.please_wait)
+    server = SimulatorServer(simulator, (args.host, args.port))
+    print("Simulated datalogger on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+        server.server_close()
+
+
+def benchmark_cmd(args, device):
+    '''Benchmark command.'''
+    simulator = None
+    if args.target is None:
+        table = SimTable(args.table, [('Batt_Volt', 'FP2'),
+                                      ('Temp', 'IEEE4B'), ('Count', 'UInt4')],
+                         records=args.records)
+        simulator = Simulator([table])
+        link = simulator.connect(args.timeout)
+    else:
+        link = link_from_url(args.target)
+        link.settimeout(args.timeout)
+    link = ImpairedLink(link, args.latency, args.jitter, args.baudrate,
+                        args.corruption, args.loss, args.seed)
+    try:
+        device = CR1000(link)
+        results = benchmark(device, args.table, args.file, args.prefetch)
+        device.bye()
+    finally:
+        if simulator is not None:
+            simulator.stop()
+    print("getfile %s : %d bytes in %.2f sec (%.1f bytes/sec)" %
+          (args.file, results['file_bytes'], results['file_seconds'],
+           results['file_bytes_per_second']))
+    print("get_data_generator %s : %d records in %.2f sec "
+          "(%.1f records/sec)" % (args.table, results['records'],
+                                  results['records_seconds'],
+                                  results['records_per_second']))
+    print("%d timeouts, %d signature errors, %d frames lost, "
+          "%d bytes corrupted" % (results['timeouts'],
+                                  results['signature_errors'], link.lost,
+                                  link.corrupted))
 
 
 def get_cmd_parser(cmd, subparsers, help, func):
@@ -140,7 +406,8 @@ def get_cmd_parser(cmd, subparsers, help, func):
     parser = subparsers.add_parser(cmd, help=help, description=help,
                                    formatter_class=formatter_class)
     parser.add_argument('--timeout', default=10.0, type=float,
-                        help="Connection link timeout")
+                        help="Connection link timeout, until the round-trip "
+                             "time of the datalogger is measured")
     parser.add_argument('--src_addr', default=None, type=int,
                         help='Source physical address')
     parser.add_argument('--src', default=0x802, type=int,
@@ -153,6 +420,12 @@ def get_cmd_parser(cmd, subparsers, help, func):
                         help='Datalogger security code')
     parser.add_argument('--debug', action="store_true", default=False,
                         help='Display log')
+    parser.add_argument('--capture', action="store", default=None,
+                        help='Record the frames written and read in a '
+                             'capture file (see the frames command)')
+    parser.add_argument('--metrics', action="store", default=None,
+                        help='Write the metrics of the session to a file in '
+                             'the Prometheus text format')
     parser.add_argument('url', action="store",
                         help="Specify URL for connection link. "
                         "E.g. tcp:iphost:port or serial:/dev/ttyUSB0:19200:8N1"
@@ -161,6 +434,54 @@ def get_cmd_parser(cmd, subparsers, help, func):
     return parser
 
 
+def get_offline_cmd_parser(cmd, subparsers, help, func):
+    '''Make a subparser command that does not talk to a datalogger.'''
+    formatter_class = argparse.ArgumentDefaultsHelpFormatter
+    parser = subparsers.add_parser(cmd, help=help, description=help,
+                                   formatter_class=formatter_class)
+    parser.add_argument('--debug', action="store_true", default=False,
+                        help='Display log')
+    parser.set_defaults(func=func, url=None)
+    return parser
+
+
+def write_metrics(args, device):
+    '''Write the metrics of the session if asked.'''
+    if device is not None and args.metrics is not None:
+        with open(args.metrics, 'w') as file_output:
+            device.metrics.write_prometheus(file_output)
+
+
+def get_device(args):
+    '''Connect to the datalogger, unless the command is offline.'''
+    if args.url is None:
+        return None
+    capture = None
+    if args.capture is not None:
+        # installed before the hello exchange, which is captured too
+        capture = FrameCapture(args.capture)
+    try:
+        return CR1000.from_url(args.url, args.timeout, args.dest_addr,
+                               args.dest, args.src_addr, args.src, args.code,
+                               capture)
+    except Exception:
+        if capture is not None:
+            capture.close()
+        raise
+
+
+def run_cmd(args):
+    '''Execute the command, then say bye and close the capture file.'''
+    device = get_device(args)
+    try:
+        args.func(args, device)
+        write_metrics(args, device)
+    finally:
+        if device is not None and device.pakbus.capture is not None:
+            device.bye()
+            device.pakbus.capture.close()
+
+
 def main():
     '''Parse command-line arguments and execute CR1000 command.'''
 
@@ -188,7 +509,8 @@ def main():
                                     ' datalogger.',
                                func=settime_cmd)
     subparser.add_argument('datetime', help='The chosen datetime value. '
-                                            '(like : "%s" or "%s")' % (NOWWITHSECONDS, NOW))
+                                            '(like : "%s" or "%s")' %
+                                            (NOWWITHSECONDS, NOW))
 
     # getprogstat command
     subparser = get_cmd_parser('getprogstat', subparsers,
@@ -239,39 +561,197 @@ def main():
     subparser.add_argument('table', action="store",
                            help="The table name used for data collection")
     subparser.add_argument('output', action='store',
-                           type=argparse.FileType('w', 0),
-                           help='Filename where output is written')
+                           help='Filename where output is written ("-" for '
+                                'the standard output)')
     subparser.add_argument('--start', help='The beginning datetime record '
                                            '(like : "%s")' % NOW)
     subparser.add_argument('--stop', help='The stopping datetime record '
                                           '(like : "%s")' % NOW)
     subparser.add_argument('--delim', action='store', default=",",
                            help='CSV char delimiter')
+    subparser.add_argument('--format', choices=('csv', 'sqlite'),
+                           default='csv', help='Output format')
+    subparser.add_argument('--index', action='store', default=None,
+                           help='Time index file used to collect by record '
+                                'numbers')
+    subparser.add_argument('--prefetch', default=0, type=int,
+                           help='Number of pages collected ahead while the '
+                                'previous ones are written')
+    subparser.add_argument('--workers', default=None, type=int,
+                           help='Number of processes decoding the pages')
+
+    # latest command
+    subparser = get_cmd_parser('latest', subparsers,
+                               help='Print the most recent records of a '
+                                    'table.',
+                               func=latest_cmd)
+    subparser.add_argument('table', action="store",
+                           help="The table name used for data collection")
+    subparser.add_argument('--n', default=1, type=int,
+                           help='Number of records')
+    subparser.add_argument('--delim', action='store', default=",",
+                           help='CSV char delimiter')
 
     # update command
     subparser = get_cmd_parser('update', subparsers,
-                               help='Update CSV database records by getting '
+                               help='Update CSV, SQLite database, column '
+                               'store or Parquet dataset records by getting '
                                'automatically new records.',
                                func=update_cmd)
     subparser.add_argument('table', action="store",
                            help="The table name used for data collection")
     subparser.add_argument('--delim', action="store", default=",",
                            help='CSV char delimiter')
-    subparser.add_argument('db', action="store", help='The CSV file database')
+    subparser.add_argument('--format',
+                           choices=('csv', 'sqlite', 'store', 'parquet'),
+                           default='csv', help='Database format')
+    subparser.add_argument('--station', action='store', default='default',
+                           help='Station name of the Parquet dataset '
+                                'partitions')
+    subparser.add_argument('--index', action='store', default=None,
+                           help='Time index file used to collect by record '
+                                'numbers')
+    subparser.add_argument('--prefetch', default=0, type=int,
+                           help='Number of pages collected ahead while the '
+                                'previous ones are written')
+    subparser.add_argument('--workers', default=None, type=int,
+                           help='Number of processes decoding the pages')
+    subparser.add_argument('db', action="store",
+                           help='The file database, or the directory of '
+                                'the column store or of the Parquet dataset')
+
+    # backfill command
+    subparser = get_cmd_parser('backfill', subparsers,
+                               help='Collect the records missing in an '
+                                    'SQLite database.',
+                               func=backfill_cmd)
+    subparser.add_argument('table', action="store",
+                           help="The table name used for data collection")
+    subparser.add_argument('db', action="store",
+                           help='The SQLite database')
+    subparser.add_argument('--blocks', default=16, type=int,
+                           help='Maximum number of record ranges in one '
+                                'request')
+
+    # capture command
+    subparser = get_cmd_parser('capture', subparsers,
+                               help='Append the raw records of a table to an '
+                                    'archive without decoding them, from '
+                                    'the last captured record.',
+                               func=capture_cmd)
+    subparser.add_argument('table', action="store",
+                           help="The table name used for data collection")
+    subparser.add_argument('archive', action="store",
+                           help='The raw archive file')
+
+    # decode command
+    subparser = get_offline_cmd_parser('decode', subparsers,
+                                       help='Decode the records of a table '
+                                            'captured in a raw archive into '
+                                            'CSV.',
+                                       func=decode_cmd)
+    subparser.add_argument('archive', action="store",
+                           help='The raw archive file')
+    subparser.add_argument('table', action="store",
+                           help="The table name")
+    subparser.add_argument('output', action='store',
+                           help='Filename where output is written')
+    subparser.add_argument('--delim', action='store', default=",",
+                           help='CSV char delimiter')
+
+    # frames command
+    subparser = get_offline_cmd_parser('frames', subparsers,
+                                       help='Print the frames of a capture '
+                                            'file.',
+                                       func=frames_cmd)
+    subparser.add_argument('capture', action="store",
+                           help='The capture file')
+
+    # simulate command
+    subparser = get_offline_cmd_parser('simulate', subparsers,
+                                       help='Serve a simulated datalogger '
+                                            'on a TCP port.',
+                                       func=simulate_cmd)
+    subparser.add_argument('--host', action='store', default='localhost',
+                           help='Listening host')
+    subparser.add_argument('--port', default=6785, type=int,
+                           help='Listening port')
+    subparser.add_argument('--table', action='store', default='Table1',
+                           help='Name of the simulated table')
+    subparser.add_argument('--records', default=10000, type=int,
+                           help='Number of records of the table')
+    subparser.add_argument('--interval', default=60, type=int,
+                           help='Time between two records in seconds')
+    subparser.add_argument('--latency', default=0, type=float,
+                           help='Delay of each response in seconds')
+    subparser.add_argument('--baudrate', default=None, type=int,
+                           help='Emulated baud rate of the link')
+    subparser.add_argument('--please-wait', default=0, type=float,
+                           dest='please_wait',
+                           help='Delay of the collect data responses in '
+                                'seconds, announced by a please wait '
+                                'message')
+
+    # benchmark command
+    subparser = get_offline_cmd_parser('benchmark', subparsers,
+                                       help='Measure the throughput of '
+                                            'getfile and getdata through an '
+                                            'impaired link, with a simulated '
+                                            'datalogger by default.',
+                                       func=benchmark_cmd)
+    subparser.add_argument('--target', action='store', default=None,
+                           help='URL of the datalogger link instead of the '
+                                'simulated datalogger')
+    subparser.add_argument('--table', action='store', default='Table1',
+                           help='The table name used for data collection')
+    subparser.add_argument('--records', default=1000, type=int,
+                           help='Number of records of the simulated table')
+    subparser.add_argument('--file', action='store', default='.TDF',
+                           help='The file read with getfile')
+    subparser.add_argument('--timeout', default=10.0, type=float,
+                           help='Connection link timeout')
+    subparser.add_argument('--prefetch', default=0, type=int,
+                           help='Number of pages collected ahead')
+    subparser.add_argument('--latency', default=0, type=float,
+                           help='One-way delay in seconds')
+    subparser.add_argument('--jitter', default=0, type=float,
+                           help='Maximum random delay added to the latency '
+                                'in seconds')
+    subparser.add_argument('--baudrate', default=None, type=int,
+                           help='Emulated baud rate (e.g. 9600)')
+    subparser.add_argument('--corruption', default=0, type=float,
+                           help='Probability of each byte to be corrupted')
+    subparser.add_argument('--loss', default=0, type=float,
+                           help='Probability of each frame to be lost')
+    subparser.add_argument('--seed', default=None, type=int,
+                           help='Seed of the random impairments')
+
+    # convert command
+    subparser = get_offline_cmd_parser('convert', subparsers,
+                                       help='Convert TOB3 files from a '
+                                            'datalogger card into CSV.',
+                                       func=convert_cmd)
+    subparser.add_argument('files', nargs='+', help='The TOB3 files')
+    subparser.add_argument('--output', action='store', default='.',
+                           help='Directory where CSV files or the Parquet '
+                                'dataset are written')
+    subparser.add_argument('--format', choices=('csv', 'parquet'),
+                           default='csv', help='Output format')
+    subparser.add_argument('--workers', default=None, type=int,
+                           help='Number of decoding processes '
+                                '(default: number of CPUs)')
+    subparser.add_argument('--delim', action='store', default=",",
+                           help='CSV char delimiter')
 
     # Parse argv arguments
     args = parser.parse_args()
 
     if args.debug:
         active_logger()
-        device = CR1000.from_url(args.url, args.timeout, args.dest_addr, args.dest,
-                                 args.src_addr, args.src, args.code)
-        args.func(args, device)
+        run_cmd(args)
     else:
         try:
-            device = CR1000.from_url(args.url, args.timeout, args.dest_addr, args.dest,
-                                     args.src_addr, args.src, args.code)
-            args.func(args, device)
+            run_cmd(args)
         except Exception as e:
             parser.error('%s' % e)
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.archive
+    ------------------------
+
+    Append-only archive of the raw collectdata responses.
+
+    Capturing stores the undecoded `RecData` of each response with the table
+    definition blob (`.TDF`) it refers to, so the connection window is only
+    spent on the wire. The records are decoded later, offline::
+
+        >>> archive = RawArchive('station.pba')
+        >>> device.capture_data('Table1', archive)
+        >>> for records in archive.iter_records('Table1'):
+        ...     sink.write('Table1', records)
+
+    The archive is made of two files: `<filename>` holds the blobs one after
+    the other and `<filename>.idx` holds one fixed-size entry per blob.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import os
+import struct
+import time
+import zlib
+
+from collections import namedtuple
+
+from .logger import LOGGER
+from .pakbus import PakBus
+from .utils import ListDict, field_name, make_record
+
+
+# kind, TableNbr, Signature, BegRecNbr, NbrOfRecs, tabledef entry, capture
+# time, offset and length of the blob
+INDEX_ENTRY = struct.Struct(str('<cHHLHLdQL'))
+
+TABLEDEF = b'T'
+RECDATA = b'D'
+
+ArchiveEntry = namedtuple('ArchiveEntry', ['kind', 'tablenbr', 'signature',
+                                           'begrecnbr', 'nbrofrecs',
+                                           'tabledef', 'time', 'offset',
+                                           'length'])
+
+
+class RawArchive(object):
+    '''Indexed append-only archive of raw collectdata responses.
+
+    :param filename: The archive data file, the index is `<filename>.idx`.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = open(filename, 'ab+')
+        self.index = open('%s.idx' % filename, 'ab+')
+        self.entries = self._read_index()
+        # tabledef entry number of each known .TDF blob (crc32, length)
+        self.tabledefs = {}
+        for i, entry in enumerate(self.entries):
+            if entry.kind == TABLEDEF:
+                self.tabledefs[self._tabledef_key(self.read(entry))] = i
+
+    def _read_index(self):
+        '''Read all the index entries.'''
+        self.index.seek(0)
+        raw = self.index.read()
+        # ignore a partially written last entry
+        count = len(raw) // INDEX_ENTRY.size
+        return [ArchiveEntry._make(INDEX_ENTRY.unpack_from(raw, i *
+                                                           INDEX_ENTRY.size))
+                for i in range(count)]
+
+    def _tabledef_key(self, raw):
+        return zlib.crc32(raw) & 0xFFFFFFFF, len(raw)
+
+    def _append(self, kind, raw, tablenbr=0, signature=0, begrecnbr=0,
+                nbrofrecs=0, tabledef=0):
+        '''Append the `raw` blob and its index entry, return the entry
+        number.'''
+        self.data.seek(0, os.SEEK_END)
+        offset = self.data.tell()
+        self.data.write(raw)
+        self.data.flush()
+        entry = ArchiveEntry(kind, tablenbr, signature, begrecnbr, nbrofrecs,
+                             tabledef, time.time(), offset, len(raw))
+        # the index entry is written once the blob is on disk
+        self.index.write(INDEX_ENTRY.pack(*entry))
+        self.index.flush()
+        self.entries.append(entry)
+        return len(self.entries) - 1
+
+    def add_tabledef(self, raw):
+        '''Store the `.TDF` blob `raw` if it is not already in the archive
+        and return its entry number.'''
+        key = self._tabledef_key(raw)
+        if key not in self.tabledefs:
+            self.tabledefs[key] = self._append(TABLEDEF, raw)
+        return self.tabledefs[key]
+
+    def add_recdata(self, tabledef, signature, recdata):
+        '''Store the raw `RecData` of a collectdata response.
+
+        :param tabledef: Entry number of the `.TDF` blob (`add_tabledef`).
+        :param signature: The table definition signature.
+        :param recdata: The raw record data.
+        '''
+        frag, more = PakBus.parse_collectdata_header(recdata)
+        if frag is None:
+            return None
+        return self._append(RECDATA, recdata, frag['TableNbr'], signature,
+                            frag['BegRecNbr'], frag['NbrOfRecs'] or 0,
+                            tabledef)
+
+    def read(self, entry):
+        '''Return the blob of `entry`.'''
+        self.data.seek(entry.offset)
+        return self.data.read(entry.length)
+
+    def next_recnbr(self, tabledef, tablename):
+        '''Return the record number following the last record of
+        `tablename` captured with the table definition `tabledef`, or None
+        if there is none.'''
+        tablenbr, item = tabledef.find(tablename)
+        signature = item['Signature']
+        for entry in reversed(self.entries):
+            if (entry.kind == RECDATA and entry.tablenbr == tablenbr and
+                    entry.signature == signature):
+                return entry.begrecnbr + max(entry.nbrofrecs, 1)
+        return None
+
+    def iter_packets(self, tablename=None):
+        '''Yield the parsed table definition and the raw record data of each
+        captured response, optionally only those of `tablename`.'''
+        tabledefs = {}
+        for entry in list(self.entries):
+            if entry.kind != RECDATA:
+                continue
+            if entry.tabledef not in tabledefs:
+                raw = self.read(self.entries[entry.tabledef])
+                tabledefs[entry.tabledef] = PakBus.parse_tabledef(raw)
+            tabledef = tabledefs[entry.tabledef]
+            name = field_name(tabledef[entry.tablenbr - 1]['Header']
+                              ['TableName'])
+            if tablename is None or name == field_name(tablename):
+                yield tabledef, self.read(entry)
+
+    def iter_records(self, tablename=None):
+        '''Decode the captured responses and yield the records of each one
+        as ListDict, like `CR1000.get_data_generator`.'''
+        for tabledef, recdata in self.iter_packets(tablename):
+            data, more = PakBus.parse_collectdata(recdata, tabledef)
+            records = ListDict()
+            for frag in data:
+                if not frag['NbrOfRecs']:
+                    if frag['IsOffset']:
+                        LOGGER.info('Skip fragment of record %s' %
+                                    frag['BegRecNbr'])
+                    continue
+                for item in frag['RecFrag']:
+                    records.append(make_record(item))
+            if records:
+                yield records
+
+    def close(self):
+        '''Close the archive files.'''
+        self.data.close()
+        self.index.close()
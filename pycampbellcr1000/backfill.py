@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.backfill
+    -------------------------
+
+    Find the missing records of a local store and collect only them::
+
+        >>> sink = SQLiteSink('station.db', device.table_def)
+        >>> backfill(device, sink, 'Table1')
+
+    The store must give the `(RecNbr, Datetime)` of its records in record
+    number order (`SQLiteSink.iter_recnbrs`) and accept records in any order.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+
+from datetime import timedelta
+
+from .logger import LOGGER
+
+
+def scan_gaps(rows, interval=None):
+    '''Return the record number gaps (see `find_gaps`) and the time gaps
+    (see `find_time_gaps`) of `rows`, in a single pass over any iterable
+    of `(RecNbr, Datetime)` sorted by record number. Only the gaps are
+    kept in memory.'''
+    gaps = []
+    time_gaps = []
+    previous = None
+    for recnbr, dtime in rows:
+        if previous is not None:
+            if recnbr > previous[0] + 1:
+                gaps.append((previous[0] + 1, recnbr))
+            elif interval is not None and recnbr == previous[0] + 1 and \
+                    dtime - previous[1] > interval:
+                time_gaps.append((previous[1], dtime))
+        previous = (recnbr, dtime)
+    return gaps, time_gaps
+
+
+def find_gaps(rows):
+    '''Return the `(first, end)` ranges of missing record numbers (`end`
+    excluded) between the `(RecNbr, Datetime)` `rows` sorted by record
+    number.'''
+    return scan_gaps(rows)[0]
+
+
+def find_time_gaps(rows, interval):
+    '''Return the `(datetime, datetime)` of the consecutive records of
+    `rows` sorted by record number which are more than `interval` apart.
+    These holes can not be filled, the datalogger did not store records.'''
+    return scan_gaps(rows, interval)[1]
+
+
+def table_interval(tabledef):
+    '''Return the interval of a table definition as timedelta, or None for
+    an event-driven table.'''
+    seconds, nanoseconds = tabledef['Header']['TblInterval']
+    if (seconds, nanoseconds) == (0, 0):
+        return None
+    return timedelta(seconds=seconds, microseconds=nanoseconds // 1000)
+
+
+def logger_range(device, tablename):
+    '''Return the `(first, end)` record numbers held by the datalogger in
+    `tablename`, or None if the table is empty.'''
+    latest = device.get_latest(tablename, 1)
+    if not latest:
+        return None
+    tablenbr, tabledef = device.table_def.find(tablename)
+    end = latest[-1]['RecNbr'] + 1
+    return max(0, end - tabledef['Header']['TableSize']), end
+
+
+def clip_gaps(gaps, first, end):
+    '''Return the parts of the `gaps` ranges between `first` and `end`.'''
+    clipped = []
+    for gap_first, gap_end in gaps:
+        gap_first, gap_end = max(gap_first, first), min(gap_end, end)
+        if gap_first < gap_end:
+            clipped.append((gap_first, gap_end))
+    return clipped
+
+
+def backfill(device, sink, tablename, max_blocks=16):
+    '''Collect the records of `tablename` missing in `sink` that the
+    datalogger still holds, with record range requests of up to
+    `max_blocks` ranges. Return the number of records written.
+
+    :param device: A `CR1000`.
+    :param sink: A store with `iter_recnbrs` and `write` methods.
+    :param tablename: Table name that contains the data.
+    :param max_blocks: Maximum number of ranges in one request.
+    '''
+    tablenbr, tabledef = device.table_def.find(tablename)
+    # the stored records are streamed, a table may not fit in memory
+    gaps, time_gaps = scan_gaps(sink.iter_recnbrs(tablename),
+                                table_interval(tabledef))
+    for begin, end in time_gaps:
+        LOGGER.info('No records from %s to %s' % (begin, end))
+    if not gaps:
+        return 0
+    held = logger_range(device, tablename)
+    if held is None:
+        return 0
+    gaps = clip_gaps(gaps, *held)
+    LOGGER.info('Collect %d missing ranges' % len(gaps))
+    total = 0
+    for records in device.get_data_ranges(tablename, gaps, max_blocks,
+                                          compact=True):
+        sink.write(tablename, records)
+        total += len(records)
+    return total
@@ -75,14 +75,24 @@ if is_py2:
     stdout = sys.stdout
     xrange = xrange
 
+    # unicode strings can not be interned
+    def intern(string):
+        return string
+
+    import Queue as queue
+    import SocketServer as socketserver
+
 
 elif is_py3:
     from collections import OrderedDict
     from logging import NullHandler
     from io import StringIO
 
-    ord = lambda x: x
-    chr = lambda x: bytes([x])
+    def ord(x):
+        return x
+
+    def chr(x):
+        return bytes([x])
 
     def to_char(string):
         if len(string) == 0:
@@ -93,6 +103,9 @@ elif is_py3:
     bytes = bytes
     stdout = sys.stdout.buffer
     xrange = range
+    from sys import intern
+    import queue
+    import socketserver
 
 
 def is_text(data):
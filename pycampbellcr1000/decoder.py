@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.decoder
+    ------------------------
+
+    Decoding of the raw collect data pages of one table, optionally on
+    several processes.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import sys
+import calendar
+
+from collections import deque
+
+from .pakbus import PakBus
+from .metrics import process_time
+from .utils import Dict
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:  # python 2 without the `futures` backport
+    ProcessPoolExecutor = None
+
+
+def table_layout(tabledef, tablenbr):
+    '''Return the compact and picklable table definition list needed by
+    `PakBus.parse_collectdata` to decode the pages of the table `tablenbr`.
+    '''
+    item = tabledef[tablenbr - 1]
+    header = item['Header']
+    layout = {'Header': {'TableName': header['TableName'],
+                         'TblInterval': header['TblInterval']},
+              'Fields': [{'FieldName': field['FieldName'],
+                          'FieldType': field['FieldType'],
+                          'Dimension': field['Dimension'],
+                          'SubDim': field.get('SubDim', [])}
+                         for field in item['Fields']]}
+    return [None] * (tablenbr - 1) + [layout]
+
+
+def decode_rows(layout, raw, arrays=False):
+    '''Decode a raw page into a list of `(TimeOfRec, RecNbr, value...)`
+    row tuples, the values being in table definition order. The array fields
+    are NumPy arrays with `arrays`.'''
+    data, more = PakBus.parse_collectdata(raw, layout, arrays=arrays)
+    rows = []
+    for frag in data:
+        if not frag['NbrOfRecs']:
+            continue
+        keys = [field['FieldName'] for field in
+                layout[frag['TableNbr'] - 1]['Fields']]
+        for item in frag['RecFrag']:
+            fields = item['Fields']
+            rows.append((item['TimeOfRec'], item['RecNbr']) +
+                        tuple([fields[key] for key in keys]))
+    return rows
+
+
+def row_to_record(row, names, record_type=None, timestamps=False):
+    '''Return a record from a row of `decode_rows`, like `make_record`.
+
+    :param row: The row tuple.
+    :param names: The field names of the row.
+    :param record_type: A `Record` class, by default the record is a `Dict`.
+    :param timestamps: Give the record datetime as an integer UNIX timestamp.
+    '''
+    if timestamps:
+        row = (calendar.timegm(row[0].timetuple()),) + row[1:]
+    if record_type is not None:
+        return record_type(row)
+    return Dict(zip(names, row))
+
+
+# table layout and array option of the worker process
+_layout = None
+_arrays = False
+
+
+def _init_worker(layout, arrays):
+    global _layout, _arrays
+    _layout, _arrays = layout, arrays
+
+
+def _decode_page(raw):
+    '''Worker entry point, return the decoding time and the rows.'''
+    begin = process_time()
+    rows = decode_rows(_layout, raw, _arrays)
+    return process_time() - begin, rows
+
+
+class PageDecoder(object):
+    '''Decode the raw pages of a table into row tuples, on `workers`
+    processes. The table layout is sent once to each process, then only
+    the raw pages are.
+
+    :param layout: The table layout (see `table_layout`).
+    :param workers: Number of decoding processes, decode in the current
+                    process with None or 1.
+    :param arrays: Decode the array fields as NumPy arrays.
+    :param metrics: The `Metrics` counting the decoded pages and records.
+    :param hooks: The `Hooks` called for each decoded page.
+    '''
+
+    def __init__(self, layout, workers=None, arrays=False, metrics=None,
+                 hooks=None):
+        self.layout = layout
+        self.workers = workers
+        self.arrays = arrays
+        self.metrics = metrics
+        self.hooks = hooks
+
+    def _count(self, size, seconds, rows):
+        if self.metrics is not None:
+            self.metrics.observe('page_decode_seconds', seconds)
+            self.metrics.inc('pages_decoded_total')
+            self.metrics.inc('records_decoded_total', len(rows))
+        if self.hooks is not None and self.hooks.active:
+            self.hooks.emit('page_parsed', size=size, records=len(rows),
+                            duration=seconds)
+        return rows
+
+    def map(self, pages):
+        '''Yield the rows of each page of `pages`, in page order. Up to two
+        pages per process are decoded ahead.'''
+        if (not self.workers or self.workers == 1 or
+                ProcessPoolExecutor is None or sys.version_info < (3, 7)):
+            for raw in pages:
+                begin = process_time()
+                rows = decode_rows(self.layout, raw, self.arrays)
+                yield self._count(len(raw), process_time() - begin, rows)
+            return
+        executor = ProcessPoolExecutor(self.workers,
+                                       initializer=_init_worker,
+                                       initargs=(self.layout, self.arrays))
+        futures = deque()
+        try:
+            for raw in pages:
+                futures.append((len(raw), executor.submit(_decode_page, raw)))
+                if len(futures) >= 2 * self.workers:
+                    size, future = futures.popleft()
+                    yield self._count(size, *future.result())
+            while futures:
+                size, future = futures.popleft()
+                yield self._count(size, *future.result())
+        finally:
+            for size, future in futures:
+                future.cancel()
+            executor.shutdown()
@@ -11,15 +11,20 @@
 '''
 from __future__ import division, unicode_literals
 import time
+import threading
 
 from datetime import datetime, timedelta
 from pylink import link_from_url
 
 from .logger import LOGGER
-from .pakbus import PakBus
-from .exceptions import NoDeviceException
-from .compat import xrange, is_py3
-from .utils import cached_property, ListDict, Dict, nsec_to_time, time_to_nsec, bytes_to_hex
+from .pakbus import PakBus, RecordBuffer, RTTEstimator
+from .decoder import PageDecoder, table_layout, row_to_record
+from .exceptions import NoDeviceException, BadDataException
+from .compat import xrange, queue, ord
+from .metrics import process_time
+from .utils import (cached_property, ListDict, Dict, nsec_to_time,
+                    time_to_nsec, bytes_to_hex, field_name, make_record,
+                    record_type)
 
 
 class CR1000(object):
@@ -32,20 +37,34 @@ class CR1000(object):
     :param src_addr: Source physical address (12-bit int) (default src)
     :param src: Source node ID (12-bit int) (default 0x802)
     :param security_code: 16-bit security code (default 0x0000)
+    :param capture: A `FrameCapture` recording the frames from the first
+                    hello exchange.
     '''
     connected = False
+    #: A `TimeIndex` learning the record numbers of the collected records,
+    #: used to collect a time window by record numbers.
+    time_index = None
+    #: Decode the array fields of the collected records as NumPy arrays
+    #: shaped from their `SubDim`, if NumPy is installed.
+    arrays = False
+    #: Number of retransmissions of a command without response.
+    retries = 2
 
     def __init__(self, link, dest_addr=None, dest=0x001, src_addr=None,
-                 src=0x802, security_code=0x0000):
+                 src=0x802, security_code=0x0000, capture=None):
         link.open()
         LOGGER.info("init client")
         self.pakbus = PakBus(link, dest_addr, dest, src_addr, src, security_code)
+        if capture is not None:
+            self.pakbus.capture = capture
+        # the link timeout is the timeout until the round-trip time is known
+        self.rtt = RTTEstimator(link.timeout or 10)
         self.pakbus.wait_packet()
-        # try ping the datalogger
+        # try ping the datalogger, the link is reopened between the attempts
         for i in xrange(20):
             LOGGER.info('%d'%(i))
             try:
-                if self.ping_node():
+                if self.ping_node(retries=0):
                     self.connected = True
                     break
             except NoDeviceException:
@@ -56,7 +75,8 @@ class CR1000(object):
 
     @classmethod
     def from_url(cls, url, timeout=10, dest_addr=None, dest=0x001,
-                 src_addr=None, src=0x802, security_code=0x0000):
+                 src_addr=None, src=0x802, security_code=0x0000,
+                 capture=None):
         ''' Get device from url.
 
         :param url: A `PyLink` connection URL.
@@ -66,28 +86,96 @@ class CR1000(object):
         :param src_addr: Source physical address (12-bit int) (default src)
         :param src: Source node ID (12-bit int) (default 0x802)
         :param security_code: 16-bit security code (default 0x0000)
+        :param capture: A `FrameCapture` recording the frames.
         '''
         link = link_from_url(url)
         link.settimeout(timeout)
-        return cls(link, dest_addr, dest, src_addr, src, security_code)     #EGC Add security code to the constructor call
-
-    def send_wait(self, cmd):
-        '''Send command and wait for response packet.'''
+        return cls(link, dest_addr, dest, src_addr, src, security_code, capture)     #EGC Add security code to the constructor call
+
+    def send_wait(self, cmd, retries=None):
+        '''Send command and wait for response packet. The command is sent
+        again, with the same transaction number, when no response comes
+        within the retransmission timeout (see `RTTEstimator`), doubled at
+        each attempt.
+
+        :param cmd: The `(packet, transaction number)` command.
+        :param retries: Number of retransmissions. By default `retries`
+                        if the command can be repeated without side effect
+                        (see `PakBus.is_idempotent`), else none.
+        '''
         packet, transac_id = cmd
-        begin = time.time()
-        self.pakbus.write(packet)
-        # wait response packet
-        response = self.pakbus.wait_packet(transac_id)
-        end = time.time()
+        if retries is None:
+            retries = self.retries if self.pakbus.is_idempotent(packet) else 0
+        link = self.pakbus.link
+        baudrate = getattr(link, 'baudrate', None)
+        previous_timeout = getattr(link, 'timeout', None)
+        expected = self.pakbus.response_type(packet)
+        # a packet kept for this transaction number answers an older one
+        self.pakbus.forget(transac_id)
+        response = None
+        started = time.time()
+        timeout = self.rtt.timeout(len(packet), baudrate)
+        try:
+            for attempt in xrange(retries + 1):
+                if hasattr(link, 'settimeout'):
+                    link.settimeout(timeout)
+                begin = time.time()
+                self.pakbus.write(packet)
+                # wait response packet
+                response = self.pakbus.wait_packet(transac_id, timeout,
+                                                   expected)
+                end = time.time()
+                if response and response[1]:
+                    self.metrics.inc('transactions_total')
+                    self.metrics.observe('rtt_seconds', end - begin,
+                                         msgtype='0x%02x' % ord(packet[8]))
+                    if attempt == 0 and not self.pakbus.delayed:
+                        # no measure from retransmitted or delayed commands
+                        transfer = self.rtt.transfer_time(
+                            len(packet) + self.pakbus.read_size, baudrate)
+                        self.rtt.add(max(end - begin - transfer, 0))
+                    break
+                self.metrics.inc('timeouts_total')
+                LOGGER.info('No response to transaction %s after %.1f sec' %
+                            (transac_id, timeout))
+                timeout = self.rtt.backoff(timeout)
+            else:
+                response = response or ({}, {})
+        finally:
+            # the link timeout is only changed for this transaction
+            if previous_timeout is not None and hasattr(link, 'settimeout'):
+                link.settimeout(previous_timeout)
+        if self.hooks.active:
+            self.hooks.emit('transaction_completed', msgtype=ord(packet[8]),
+                            transac_id=transac_id, size=len(packet),
+                            response_size=self.pakbus.read_size,
+                            attempts=attempt + 1, duration=end - started,
+                            ok=bool(response[1]))
         send_time = timedelta(seconds=int((end - begin) / 2))
         return response[0], response[1], send_time
 
-    def ping_node(self):
-        '''Check if remote host is available.'''
+    @property
+    def metrics(self):
+        '''The `Metrics` of the session.'''
+        return self.pakbus.metrics
+
+    @property
+    def hooks(self):
+        '''The `Hooks` of the session.'''
+        return self.pakbus.hooks
+
+    def ping_node(self, retries=None):
+        '''Check if remote host is available.
+
+        :param retries: Number of retransmissions of the hello command
+                        (default `retries`).
+        '''
         # send hello command and wait for response packet
-        hdr, msg, send_time = self.send_wait(self.pakbus.get_hello_cmd())
+        hdr, msg, send_time = self.send_wait(self.pakbus.get_hello_cmd(),
+                                             retries)
         if not (hdr and msg):
             raise NoDeviceException()
+        self.rtt.seed(msg.get('HopMetric'))
         return True
 
     def gettime(self):
@@ -106,8 +194,10 @@ class CR1000(object):
         self.ping_node()
         diff = dtime - current_time
         diff = diff.total_seconds()
+        # NSec adjustment: seconds and nanoseconds
+        adjustment = (int(diff), int(round((diff - int(diff)) * 1e9)))
         # settime (OldTime in response)
-        hdr, msg, sdt1 = self.send_wait(self.pakbus.get_clock_cmd((diff, 0)))
+        hdr, msg, sdt1 = self.send_wait(self.pakbus.get_clock_cmd(adjustment))
         # gettime (NewTime in response)
         hdr, msg, sdt2 = self.send_wait(self.pakbus.get_clock_cmd())
         # remove transmission time
@@ -169,18 +259,40 @@ class CR1000(object):
         filedir = self.pakbus.parse_filedir(data)
         return [item['FileName'] for item in filedir['files']]
 
+    @cached_property
+    def table_def_raw(self):
+        '''Return the raw table definition file (.TDF).'''
+        return self.getfile('.TDF')
+
     @cached_property
     def table_def(self):
         '''Return table definition.'''
-        data = self.getfile('.TDF')
         # List tables
-        tabledef = self.pakbus.parse_tabledef(data)
+        tabledef = self.pakbus.parse_tabledef(self.table_def_raw)
         return tabledef
 
     def list_tables(self):
         '''List the tables available in the datalogger.'''
         return [item['Header']['TableName'] for item in self.table_def]
 
+    def _get_table(self, tablename):
+        '''Return the table number and the table definition of
+        `tablename`.'''
+        return self.table_def.find(tablename)
+
+    def table_signature(self, tablename):
+        '''Return the table definition signature of `tablename`.'''
+        tablenbr, tabledef = self._get_table(tablename)
+        return tabledef['Signature']
+
+    def record_type(self, tablename):
+        '''Return the compact `Record` class of the records of `tablename`.
+        '''
+        tablenbr, tabledef = self._get_table(tablename)
+        keys = [field['FieldName'] for field in tabledef['Fields']]
+        return record_type(['Datetime', 'RecNbr'] + keys, keys,
+                           tabledef['Header']['TableName'])
+
     def _collect_data(self, tablename, start_date=None, stop_date=None):
         '''Collect fragment data from `tablename` from `start_date` to
         `stop_date` as ListDict.'''
@@ -194,43 +306,99 @@ class CR1000(object):
             p1 = 0
             p2 = 0
 
-        tabledef = self.table_def
-        # Get table number
-        tablenbr = None
-        if is_py3:
-            tablename = bytes(tablename, encoding="utf-8")
-        for i, item in enumerate(tabledef):
-            if item['Header']['TableName'] == tablename:
-                tablenbr = i + 1
-                break
-        if tablenbr is None:
-            raise StandardError('table %s not found' % tablename)
-        # Get table definition signature
-        tabledefsig = tabledef[tablenbr - 1]['Signature']
+        # Get table number and table definition signature
+        tablenbr, item = self._get_table(tablename)
+        tabledefsig = item['Signature']
 
         # Send collect data request
         cmd = self.pakbus.get_collectdata_cmd(tablenbr, tabledefsig, mode,
                                               p1, p2)
         hdr, msg, send_time = self.send_wait(cmd)
         more = True
-        data, more = self.pakbus.parse_collectdata(msg['RecData'], tabledef)
+        recdata = self._reassemble(msg['RecData'])
+        data, more = self._parse_page(recdata)
+        if recdata is not msg['RecData']:
+            data[0]['Reassembled'] = True
+        self._learn(data)
         # Return parsed record data and flag if more records exist
         return data, more
 
-    def get_data(self, tablename, start_date=None, stop_date=None):
+    def _reassemble(self, recdata):
+        '''If the raw collectdata response `recdata` starts with the first
+        fragment of a record larger than a packet, collect the next
+        fragments (collect mode 8) and return the record data of the whole
+        record, else return `recdata`. Raise `BadDataException` if the
+        record can not be completed.'''
+        frag, more = self.pakbus.parse_collectdata_header(recdata)
+        if frag is None or not frag['IsOffset']:
+            return recdata
+        tablenbr, recnbr = frag['TableNbr'], frag['BegRecNbr']
+        item = self.table_def[tablenbr - 1]
+        record = RecordBuffer(tablenbr, recnbr,
+                              self.pakbus.record_size(item))
+        LOGGER.info('Reassemble record %d of %d bytes' %
+                    (recnbr, len(record.data)))
+        while record.add(recdata) and not record.complete:
+            # collect the record from the byte offset
+            cmd = self.pakbus.get_collectdata_cmd(tablenbr, item['Signature'],
+                                                  0x08, recnbr,
+                                                  record.received)
+            hdr, msg, send_time = self.send_wait(cmd)
+            recdata = msg.get('RecData', b'')
+        if not record.complete:
+            LOGGER.error('Record %d is incomplete, %d of %d bytes received' %
+                         (recnbr, record.received, len(record.data)))
+            raise BadDataException()
+        return record.to_recdata()
+
+    def _parse_page(self, recdata):
+        '''Parse the raw collectdata response `recdata` and count the decoded
+        records and the decoding time.'''
+        begin = process_time()
+        data, more = self.pakbus.parse_collectdata(recdata, self.table_def,
+                                                   arrays=self.arrays)
+        duration = process_time() - begin
+        records = sum(frag['NbrOfRecs'] or 0 for frag in data)
+        self.metrics.observe('page_decode_seconds', duration)
+        self.metrics.inc('pages_decoded_total')
+        self.metrics.inc('records_decoded_total', records)
+        if self.hooks.active:
+            self.hooks.emit('page_parsed', size=len(recdata),
+                            records=records, duration=duration)
+        return data, more
+
+    def _learn(self, data):
+        '''Add the record numbers of the parsed fragments `data` to the time
+        index.'''
+        if self.time_index is not None:
+            self.time_index.add_fragments(self.table_def, data)
+
+    def get_data(self, tablename, start_date=None, stop_date=None,
+                 compact=False, timestamps=False, prefetch=0, workers=None):
         '''Get all data from `tablename` from `start_date` to `stop_date` as
         ListDict. By default the entire contents of the data will be
         downloaded.
 
         :param tablename: Table name that contains the data.
         :param start_date: The beginning datetime record.
-        :param stop_date: The stopping datetime record.'''
+        :param stop_date: The stopping datetime record.
+        :param compact: Return compact `Record` objects instead of `Dict`.
+        :param timestamps: Give the record datetimes as integer UNIX
+                           timestamps.
+        :param prefetch: Number of pages collected ahead by a background
+                         thread (0 to disable).
+        :param workers: Number of processes decoding the collected pages.
+        '''
         records = ListDict()
-        for items in self.get_data_generator(tablename, start_date, stop_date):
+        for items in self.get_data_generator(tablename, start_date, stop_date,
+                                             compact, timestamps, prefetch,
+                                             workers):
             records.extend(items)
         return records
 
-    def get_data_generator(self, tablename, start_date=None, stop_date=None):
+    def get_data_generator(self, tablename, start_date=None, stop_date=None,
+                           compact=False, timestamps=False, prefetch=0,
+                           workers=None):
         '''Get all data from `tablename` from `start_date` to `stop_date` as
         generator. The data can be fragmented into multiple packets, this
         generator can return parsed data from each packet before receiving
@@ -239,14 +407,107 @@ class CR1000(object):
         :param tablename: Table name that contains the data.
         :param start_date: The beginning datetime record.
         :param stop_date: The stopping datetime record.
+        :param compact: Yield compact `Record` objects instead of `Dict`.
+        :param timestamps: Give the record datetimes as integer UNIX
+                           timestamps.
+        :param prefetch: Number of pages collected ahead by a background
+                         thread while the previous ones are decoded and
+                         consumed (0 to disable).
+        :param workers: Number of processes decoding the collected pages,
+                        in page order. The pages are collected ahead by a
+                        background thread, as with `prefetch`.
         '''
         self.ping_node()
+        cls = self.record_type(tablename) if compact else None
         start_date = start_date or datetime(1990, 1, 1, 0, 0, 1)
         stop_date = stop_date or datetime.now()
+        if prefetch or workers:
+            generator = self._get_prefetch_generator(tablename, start_date,
+                                                     stop_date, cls,
+                                                     timestamps, prefetch,
+                                                     workers)
+        elif self.time_index is None:
+            generator = self._get_time_generator(tablename, start_date,
+                                                 stop_date, cls, timestamps)
+        else:
+            generator = self._get_indexed_generator(tablename, start_date,
+                                                    stop_date, cls,
+                                                    timestamps)
+        begin = time.time()
+        for records in generator:
+            if self.hooks.active:
+                end = time.time()
+                self.hooks.emit('records_yielded', tablename=tablename,
+                                records=len(records), duration=end - begin)
+                begin = end
+            yield records
+
+    def _get_indexed_generator(self, tablename, start_date, stop_date, cls,
+                               timestamps):
+        '''Get the records from `start_date` to `stop_date` by record numbers
+        if the time index knows where they are, else by time.'''
+        tablenbr, item = self._get_table(tablename)
+        recnbrs = self.time_index.lookup(tablename, item['Signature'],
+                                         start_date, stop_date)
+        if recnbrs is None:
+            generator = self._get_time_generator(tablename, start_date,
+                                                 stop_date, cls, timestamps)
+        else:
+            LOGGER.info('Collect records %s to %s' % recnbrs)
+            generator = self._get_range_generator(tablename, recnbrs[0],
+                                                  recnbrs[1], start_date,
+                                                  stop_date, cls, timestamps)
+        try:
+            for records in generator:
+                yield records
+        finally:
+            self.time_index.save()
+
+    def _get_range_generator(self, tablename, first, end, start_date,
+                             stop_date, cls, timestamps):
+        '''Get the records from `start_date` to `stop_date` between the
+        record numbers `first` and `end` (excluded, None for the newest
+        record) with record range collect requests (mode 6).'''
+        tablenbr, item = self._get_table(tablename)
+        more = True
+        while more:
+            if end is None:
+                mode, p2 = 0x04, 0  # from first to the newest record
+            else:
+                mode, p2 = 0x06, end  # from first to end
+            data, more = self._collect_tables(mode, [(tablenbr,
+                                                      item['Signature'],
+                                                      first, p2)])
+            records = ListDict()
+            received = False
+            for frag in data:
+                if not frag['NbrOfRecs'] or frag['TableNbr'] != tablenbr:
+                    continue
+                received = True
+                for rec in frag['RecFrag']:
+                    # the end of the time range is excluded, as with mode 7
+                    if start_date <= rec['TimeOfRec'] < stop_date:
+                        records.append(make_record(rec, cls, timestamps))
+                first = frag['BegRecNbr'] + frag['NbrOfRecs']
+                if frag['RecFrag'][-1]['TimeOfRec'] >= stop_date:
+                    # the next records are after the time range
+                    received = False
+            if not received or (end is not None and first >= end):
+                more = False
+            if records:
+                yield records.sorted_by('Datetime')
+
+    def _get_time_generator(self, tablename, start_date, stop_date, cls,
+                            timestamps):
+        '''Get the records from `start_date` to `stop_date` with time range
+        collect requests (mode 7).'''
         more = True
         while more:
             records = ListDict()
             data, more = self._collect_data(tablename, start_date, stop_date)
+            # a record larger than a packet was reassembled, the next pages
+            # will hold one record: go on by record numbers
+            reassembled = more and data and data[-1].get('Reassembled')
             for i, rec in enumerate(data):
                 if not rec["NbrOfRecs"]:
                     more = False
@@ -255,22 +516,357 @@ class CR1000(object):
                     if start_date <= item['TimeOfRec'] <= stop_date:
                         start_date = item['TimeOfRec']
                         # for no duplicate record
-                        if more and ((j == (len(rec['RecFrag']) - 1))
-                                     and (i == (len(data) - 1))):
+                        if more and not reassembled and \
+                                ((j == (len(rec['RecFrag']) - 1))
+                                 and (i == (len(data) - 1))):
                             break
-                        new_rec = Dict()
-                        new_rec["Datetime"] = item['TimeOfRec']
-                        new_rec["RecNbr"] = item['RecNbr']
-                        for key in item['Fields']:
-                            new_rec["%s" % key] = item['Fields'][key]
-                        records.append(new_rec)
+                        records.append(make_record(item, cls, timestamps))
 
             if records:
-                records = records.sorted_by('Datetime')
                 yield records.sorted_by('Datetime')
-            else:
+            if reassembled:
+                first = data[-1]['BegRecNbr'] + data[-1]['NbrOfRecs']
+                for records in self._get_range_generator(
+                        tablename, first, None, start_date, stop_date, cls,
+                        timestamps):
+                    yield records
+                break
+            if not records:
                 more = False
 
+    def _get_prefetch_generator(self, tablename, start_date, stop_date, cls,
+                                timestamps, prefetch, workers=None):
+        '''Get the records from `start_date` to `stop_date`, the pages being
+        collected by a background thread (see `_prefetch_pages`) while the
+        previous ones are decoded, on `workers` processes if given.'''
+        tablenbr, item = self._get_table(tablename)
+        names = ['Datetime', 'RecNbr'] + [field_name(field['FieldName'])
+                                          for field in item['Fields']]
+        decoder = PageDecoder(table_layout(self.table_def, tablenbr), workers,
+                              self.arrays, self.metrics, self.hooks)
+        pages = self._prefetch_pages(tablename, start_date, stop_date,
+                                     max(prefetch, 2 * (workers or 0)))
+        rows_list = decoder.map(pages)
+        try:
+            for rows in rows_list:
+                if not rows:
+                    continue
+                if self.time_index is not None:
+                    self.time_index.add(tablename, item['Signature'],
+                                        [rows[0][:2], rows[-1][:2]])
+                records = ListDict()
+                done = False
+                for row in rows:
+                    # the end of the time range is excluded, as with mode 7
+                    if row[0] >= stop_date:
+                        done = True
+                    elif start_date <= row[0]:
+                        records.append(row_to_record(row, names, cls,
+                                                     timestamps))
+                if records:
+                    yield records.sorted_by('Datetime')
+                if done:
+                    break
+        finally:
+            rows_list.close()
+            pages.close()
+            if self.time_index is not None:
+                self.time_index.save()
+
+    def _prefetch_pages(self, tablename, start_date, stop_date, depth):
+        '''Yield the raw record data of the pages of `tablename` from
+        `start_date`, collected by a background thread up to `depth` pages
+        ahead. The first page is collected by time (mode 7), the next ones
+        from the record following the previous page (mode 4), known from
+        the fragment header without decoding the page. The link must not
+        be used by another thread meanwhile.'''
+        tablenbr, item = self._get_table(tablename)
+        pages = queue.Queue(depth)
+        stop = threading.Event()
+
+        def collect():
+            try:
+                mode = 0x07  # collect from p1 to p2 (nsec)
+                p1, p2 = time_to_nsec(start_date), time_to_nsec(stop_date)
+                while not stop.is_set():
+                    cmd = self.pakbus.get_collectdata_cmd(
+                        tablenbr, item['Signature'], mode, p1, p2)
+                    hdr, msg, send_time = self.send_wait(cmd)
+                    if 'RecData' not in msg:
+                        break
+                    recdata = self._reassemble(msg['RecData'])
+                    frag, more = self.pakbus.parse_collectdata_header(recdata)
+                    if frag is None or not frag['NbrOfRecs']:
+                        break
+                    pages.put(('page', recdata))
+                    if not more:
+                        break
+                    # collect from the next record
+                    mode, p1, p2 = 0x04, frag['BegRecNbr'] + \
+                        frag['NbrOfRecs'], 0
+                pages.put(('end', None))
+            except Exception as e:
+                pages.put(('error', e))
+
+        thread = threading.Thread(target=collect)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                kind, value = pages.get()
+                if kind == 'end':
+                    break
+                elif kind == 'error':
+                    raise value
+                yield value
+        finally:
+            stop.set()
+            # unblock the thread if the queue is full
+            while thread.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def get_latest(self, tablename, n=1, compact=False, timestamps=False):
+        '''Get the `n` most recent records of `tablename` as ListDict, with
+        one collect data request when they fit in one packet.
+
+        :param tablename: Table name that contains the data.
+        :param n: Number of records.
+        :param compact: Return compact `Record` objects instead of `Dict`.
+        :param timestamps: Give the record datetimes as integer UNIX
+                           timestamps.
+        '''
+        self.ping_node()
+        tablenbr, item = self._get_table(tablename)
+        cls = self.record_type(tablename) if compact else None
+        records = ListDict()
+        mode, recnbr = 0x05, n  # most recent n records
+        more = True
+        while more:
+            data, more = self._collect_tables(mode, [(tablenbr,
+                                                      item['Signature'],
+                                                      recnbr, 0)])
+            received = False
+            for frag in data:
+                if frag['NbrOfRecs'] and frag['TableNbr'] == tablenbr:
+                    for rec in frag['RecFrag']:
+                        records.append(make_record(rec, cls, timestamps))
+                    recnbr = frag['BegRecNbr'] + frag['NbrOfRecs']
+                    received = True
+            if not received or len(records) >= n:
+                break
+            # the records did not fit: go on from the last one
+            mode = 0x04
+        return ListDict(records[-n:])
+
+    def get_data_ranges(self, tablename, ranges, max_blocks=16,
+                        compact=False, timestamps=False):
+        '''Get the records of `tablename` in several record number ranges,
+        with up to `max_blocks` ranges in each collect data request (mode
+        6). The records of each response are yielded as ListDict.
+
+        :param tablename: Table name that contains the data.
+        :param ranges: List of `(first, end)` record numbers, `end` excluded.
+        :param max_blocks: Maximum number of ranges in one request.
+        :param compact: Yield compact `Record` objects instead of `Dict`.
+        :param timestamps: Give the record datetimes as integer UNIX
+                           timestamps.
+        '''
+        self.ping_node()
+        tablenbr, item = self._get_table(tablename)
+        cls = self.record_type(tablename) if compact else None
+        pending = [[first, end] for first, end in ranges if first < end]
+        while pending:
+            blocks = pending[:max_blocks]
+            data, more = self._collect_tables(0x06, [
+                (tablenbr, item['Signature'], first, end)
+                for first, end in blocks])
+            records = ListDict()
+            received = set()
+            for frag in data:
+                if not frag['NbrOfRecs'] or frag['TableNbr'] != tablenbr:
+                    continue
+                for rec in frag['RecFrag']:
+                    records.append(make_record(rec, cls, timestamps))
+                for i, block in enumerate(blocks):
+                    if block[0] <= frag['BegRecNbr'] < block[1]:
+                        block[0] = frag['BegRecNbr'] + frag['NbrOfRecs']
+                        received.add(i)
+            if not received:
+                # the datalogger does not hold these records anymore
+                LOGGER.info('No records in %d ranges' % len(blocks))
+                more = False
+            if not more:
+                # all the requested blocks were answered
+                blocks = []
+            pending = [block for block in blocks if block[0] < block[1]] + \
+                pending[max_blocks:]
+            if records:
+                yield records
+
+    def get_data_multi(self, cursors, compact=False, timestamps=False):
+        '''Get the new records of several tables, collected with several
+        tables in each request. Returns a dict of table name to records as
+        ListDict, the next cursor of a table being the `RecNbr` of its last
+        record plus one.
+
+        :param cursors: Dict of table name to the record number to collect
+                        from, or None to collect only the most recent record.
+        :param compact: Return compact `Record` objects instead of `Dict`.
+        :param timestamps: Give the record datetimes as integer UNIX
+                           timestamps.
+        '''
+        self.ping_node()
+        results = {}
+        tables = {}  # table number -> (table name, record type)
+        recent = []
+        pending = {}  # table number -> [signature, record number]
+        for tablename, cursor in cursors.items():
+            tablenbr, item = self._get_table(tablename)
+            cls = self.record_type(tablename) if compact else None
+            tables[tablenbr] = (tablename, cls)
+            results[tablename] = ListDict()
+            if cursor is None:
+                recent.append((tablenbr, item['Signature'], 1, 0))
+            else:
+                pending[tablenbr] = [item['Signature'], cursor]
+
+        def dispatch(data):
+            '''Split the fragments by table, return the tables that got
+            records.'''
+            received = set()
+            for frag in data:
+                if not frag['NbrOfRecs'] or frag['TableNbr'] not in tables:
+                    continue
+                tablename, cls = tables[frag['TableNbr']]
+                for item in frag['RecFrag']:
+                    results[tablename].append(make_record(item, cls,
+                                                          timestamps))
+                received.add(frag['TableNbr'])
+                if frag['TableNbr'] in pending:
+                    pending[frag['TableNbr']][1] = (frag['BegRecNbr'] +
+                                                    frag['NbrOfRecs'])
+            return received
+
+        if recent:
+            # most recent record of each table
+            LOGGER.info('Send collect_data cmd for %d tables' % len(recent))
+            dispatch(self._collect_tables(0x05, recent)[0])
+        more = bool(pending)
+        while more:
+            # records from the cursor of each table
+            LOGGER.info('Send collect_data cmd for %d tables' % len(pending))
+            data, more = self._collect_tables(0x04, [
+                (tablenbr, signature, recnbr, 0)
+                for tablenbr, (signature, recnbr) in sorted(pending.items())])
+            if not dispatch(data):
+                break
+        return results
+
+    def _collect_tables(self, mode, tables):
+        '''Send one collect data command for several tables and return the
+        parsed fragments and the flag if more records exist.'''
+        cmd = self.pakbus.get_multi_collectdata_cmd(mode, tables)
+        hdr, msg, send_time = self.send_wait(cmd)
+        if 'RecData' not in msg:
+            return [], False
+        data, more = self._parse_page(self._reassemble(msg['RecData']))
+        self._learn(data)
+        return data, more
+
+    VALUES_ERRORS = {1: 'Permission denied',
+                     16: 'Invalid table or field name',
+                     17: 'Data type conversion not supported',
+                     18: 'Memory bounds violation'}
+
+    def _get_field(self, tabledef, fieldname):
+        '''Return the field name as text, the data type, the swath and the
+        string length of `fieldname`, which may name one element of an
+        array (e.g. 'Temp(2)').'''
+        fieldname = field_name(fieldname)
+        name = fieldname.split('(')[0]
+        for field in tabledef['Fields']:
+            if field_name(field['FieldName']) == name:
+                break
+        else:
+            raise ValueError('field %s not found' % fieldname)
+        type_ = field['FieldType']
+        if type_ == 'ASCII':
+            return fieldname, type_, 1, field['Dimension']
+        if name != fieldname:
+            return fieldname, type_, 1, None
+        return fieldname, type_, field['Dimension'], None
+
+    def _check_values_response(self, msg):
+        '''Raise ValueError if a GetValues or SetValues command failed.'''
+        if 'RespCode' not in msg:
+            raise NoDeviceException()
+        if msg['RespCode'] != 0:
+            raise ValueError(self.VALUES_ERRORS.get(msg['RespCode'],
+                                                    'Error %d' %
+                                                    msg['RespCode']))
+
+    def get_values(self, tablename, fields):
+        '''Get the current values of `fields` of `tablename` (typically
+        `Public`) as Dict, with one GetValues command per field. Array fields
+        give a list of values, unless only one element is named (e.g.
+        'Temp(2)').
+
+        :param tablename: Table name that contains the fields.
+        :param fields: List of field names.
+        '''
+        self.ping_node()
+        tablenbr, item = self._get_table(tablename)
+        tablename = field_name(item['Header']['TableName'])
+        values = Dict()
+        for fieldname in fields:
+            fieldname, type_, swath, length = self._get_field(item, fieldname)
+            if type_ in ('FP3', 'FP4'):
+                # the datalogger converts the values
+                type_ = 'IEEE4B'
+            cmd = self.pakbus.get_getvalues_cmd(tablename, type_, fieldname,
+                                                swath)
+            hdr, msg, send_time = self.send_wait(cmd)
+            self._check_values_response(msg)
+            if type_ == 'ASCII':
+                (value,), size = self.pakbus.decode_bin([type_],
+                                                        msg['Values'], length)
+            else:
+                value, size = self.pakbus.decode_bin(swath * [type_],
+                                                     msg['Values'])
+                if swath == 1:
+                    value = value[0]
+            values[fieldname] = value
+        return values
+
+    def set_values(self, tablename, values):
+        '''Set the values of several fields of `tablename` (typically
+        `Public`), with one SetValues command per field.
+
+        :param tablename: Table name that contains the fields.
+        :param values: Dict of field names to values, a list of values for
+                       the elements of an array field.
+        '''
+        self.ping_node()
+        tablenbr, item = self._get_table(tablename)
+        tablename = field_name(item['Header']['TableName'])
+        for fieldname, value in values.items():
+            fieldname, type_, swath, length = self._get_field(item, fieldname)
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            if type_ in ('ASCII', 'ASCIIZ'):
+                type_, value = 'ASCIIZ', [field_name(value[0])]
+            elif type_ in ('FP2', 'FP3', 'FP4'):
+                # the datalogger converts the values
+                type_ = 'IEEE4B'
+            cmd = self.pakbus.get_setvalues_cmd(tablename, type_, fieldname,
+                                                value)
+            hdr, msg, send_time = self.send_wait(cmd)
+            self._check_values_response(msg)
+
     def get_raw_packets(self, tablename):
         '''Get all raw packets from table `tablename`.
 
@@ -285,6 +881,39 @@ class CR1000(object):
                 records.append(rec)
         return records
 
+    def capture_data(self, tablename, archive, recnbr=None):
+        '''Collect the records of `tablename` from the record number `recnbr`
+        and append the raw responses to `archive` without decoding them.
+        By default the capture resumes after the last record of the archive.
+        Return the record number following the last captured record.
+
+        :param tablename: Table name that contains the data.
+        :param archive: A `RawArchive`.
+        :param recnbr: The first record number to collect.
+        '''
+        self.ping_node()
+        tablenbr, item = self._get_table(tablename)
+        tabledef = archive.add_tabledef(self.table_def_raw)
+        if recnbr is None:
+            recnbr = archive.next_recnbr(self.table_def, tablename) or 0
+        more = True
+        while more:
+            LOGGER.info('Send collect_data cmd from record %d' % recnbr)
+            cmd = self.pakbus.get_collectdata_cmd(tablenbr, item['Signature'],
+                                                  0x04, recnbr)
+            hdr, msg, send_time = self.send_wait(cmd)
+            if 'RecData' not in msg:
+                break
+            recdata = self._reassemble(msg['RecData'])
+            frag, more = self.pakbus.parse_collectdata_header(recdata)
+            if frag is None:
+                break
+            if not frag['NbrOfRecs']:
+                break
+            archive.add_recdata(tabledef, item['Signature'], recdata)
+            recnbr = frag['BegRecNbr'] + frag['NbrOfRecs']
+        return recnbr
+
     def getprogstat(self):
         '''Get programming statistics as dict.'''
         LOGGER.info('Try get programming statistics')
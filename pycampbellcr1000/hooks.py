@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.hooks
+    ----------------------
+
+    Callbacks called on the events of the packet and decoding pipeline, to
+    attach profilers, rate limiters or tracing systems::
+
+        >>> def on_transaction(event, info):
+        ...     print(info['msgtype'], info['duration'])
+        >>> device.hooks.register('transaction_completed', on_transaction)
+
+    Each callback gets the event name and a dict of its information, with
+    the timings in seconds and the sizes in bytes:
+
+    - ``frame_written``: ``size`` (packet), ``wire_size`` (quoted frame),
+      ``duration`` (link write).
+    - ``frame_received``: ``size``, ``wire_size``, ``duration`` (link read),
+      ``valid`` (signature check).
+    - ``packet_decoded``: ``hdr``, ``msg``, ``duration``.
+    - ``page_parsed``: ``size`` (record data), ``records``, ``duration``
+      (CPU time).
+    - ``records_yielded``: ``tablename``, ``records``, ``duration`` (since the
+      previous records).
+    - ``transaction_completed``: ``msgtype``, ``transac_id``, ``size``,
+      ``response_size``, ``attempts``, ``duration``, ``ok``.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+
+from .logger import LOGGER
+
+
+EVENTS = ('frame_written', 'frame_received', 'packet_decoded', 'page_parsed',
+          'records_yielded', 'transaction_completed')
+
+
+class Hooks(object):
+    '''Registry of the callbacks of each event. The callers check `active`
+    before building the event information, so nothing is done without
+    callbacks.'''
+
+    def __init__(self):
+        self.callbacks = dict((event, []) for event in EVENTS)
+        self.active = False
+
+    def register(self, event, callback):
+        '''Call `callback(event, info)` on each `event`.'''
+        if event not in self.callbacks:
+            raise ValueError('unknown event %s' % event)
+        self.callbacks[event].append(callback)
+        self.active = True
+
+    def unregister(self, event, callback):
+        '''Remove a callback of `event`.'''
+        self.callbacks[event].remove(callback)
+        self.active = any(self.callbacks.values())
+
+    def emit(self, event, **info):
+        '''Call the callbacks of `event`. An exception of a callback is
+        logged and does not stop the others.'''
+        for callback in self.callbacks[event]:
+            try:
+                callback(event, info)
+            except Exception as e:
+                LOGGER.error('Hook %r of %s failed: %s', callback, event, e)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.impairment
+    ---------------------------
+
+    Emulation of a slow and lossy link (radio or satellite) around any
+    `PyLink` link, to measure the collection throughput without the field
+    hardware::
+
+        >>> link = ImpairedLink(link_from_url('tcp:localhost:6785'),
+        ...                     latency=0.3, baudrate=9600, loss=0.01)
+        >>> device = CR1000(link)
+        >>> benchmark(device, 'Table1')
+
+    Both directions are impaired by background threads: the data written is
+    delivered to the link after its transfer time and latency, the data read
+    is released frame by frame (up to a ``\\xBD`` flag) once it is
+    transferred. A lost frame is dropped entirely, a corrupted frame has some
+    of its bytes replaced.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import time
+import random
+import threading
+
+from collections import deque
+
+from .logger import LOGGER
+from .pakbus import RTTEstimator
+from .compat import is_text, bytes
+
+
+class ImpairedLink(object):
+    '''Wrap `link` with latency, jitter, bandwidth limit, byte corruption
+    and frame loss.
+
+    :param link: The wrapped `PyLink` link.
+    :param latency: One-way delay in seconds.
+    :param jitter: Maximum random delay added to the latency in seconds.
+    :param baudrate: Emulated baud rate, 10 bits per byte (None for no
+                     limit). It is also seen by `CR1000` to account for the
+                     transfer time in the timeouts.
+    :param corruption: Probability of each byte to be replaced.
+    :param loss: Probability of each frame to be lost.
+    :param seed: Seed of the random impairments, to reproduce a run. Each
+                 direction has its own generator, the reader thread does
+                 not change the impairments of the written data.
+    :param timeout: Read timeout in seconds (default the `link` timeout).
+    '''
+    FLAG = b'\xBD'
+
+    def __init__(self, link, latency=0, jitter=0, baudrate=None,
+                 corruption=0, loss=0, seed=None, timeout=None):
+        self.link = link
+        self.latency = latency
+        self.jitter = jitter
+        self.baudrate = baudrate
+        self.corruption = corruption
+        self.loss = loss
+        self.write_random = random.Random(seed)
+        self.read_random = random.Random(None if seed is None else seed + 1)
+        self.timeout = timeout or getattr(link, 'timeout', None) or 1
+        # frames received, with their release time
+        self.pending = deque()
+        self.condition = threading.Condition()
+        # end of the transfer of the last frame received
+        self.channel_free = 0
+        self.released = 0
+        # frames written, with their delivery time
+        self.outgoing = deque()
+        self.send_condition = threading.Condition()
+        self.send_channel_free = 0
+        self.delivered = 0
+        # the counters are updated by both directions
+        self.lock = threading.Lock()
+        self.lost = 0
+        self.corrupted = 0
+        self.closed = True
+        self.thread = None
+        self.sender = None
+
+    @property
+    def url(self):
+        return getattr(self.link, 'url', None)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def open(self):
+        self.link.open()
+        self.closed = False
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._receive)
+            self.thread.daemon = True
+            self.thread.start()
+        if self.sender is None or not self.sender.is_alive():
+            self.sender = threading.Thread(target=self._send)
+            self.sender.daemon = True
+            self.sender.start()
+
+    def close(self):
+        with self.send_condition:
+            self.closed = True
+            self.send_condition.notify_all()
+        # the frames written are delivered before the link is closed
+        if self.sender is not None:
+            self.sender.join()
+        self.link.close()
+        # the reader must not outlive the link, it could be reopened
+        if self.thread is not None and \
+                self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def impair(self, data, rng):
+        '''Return the frame `data` corrupted, or None if it is lost.
+
+        :param rng: The `random.Random` generator of the direction.
+        '''
+        if self.loss and len(data) > 1 and rng.random() < self.loss:
+            with self.lock:
+                self.lost += 1
+            return None
+        if self.corruption:
+            buff = bytearray(data)
+            corrupted = 0
+            for i in range(len(buff)):
+                if rng.random() < self.corruption:
+                    buff[i] ^= rng.randint(1, 255)
+                    corrupted += 1
+            with self.lock:
+                self.corrupted += corrupted
+            data = bytes(buff)
+        return data
+
+    def delay(self, rng):
+        '''Return a random one-way delay.
+
+        :param rng: The `random.Random` generator of the direction.
+        '''
+        if self.jitter:
+            return self.latency + rng.uniform(0, self.jitter)
+        return self.latency
+
+    def write(self, data):
+        '''Queue `data`, written to the link after its transfer time and the
+        delay unless it is lost. The caller is not delayed.'''
+        if is_text(data):
+            data = data.encode('utf-8')
+        frame = self.impair(data, self.write_random)
+        transfer = RTTEstimator.transfer_time(len(data), self.baudrate)
+        with self.send_condition:
+            # a lost frame still uses the channel
+            self.send_channel_free = (max(time.time(), self.send_channel_free)
+                                      + transfer)
+            # frames are delivered in order
+            self.delivered = max(self.send_channel_free +
+                                 self.delay(self.write_random), self.delivered)
+            if frame is not None:
+                self.outgoing.append((self.delivered, frame))
+                self.send_condition.notify_all()
+
+    def _send(self):
+        '''Write the queued frames to the wrapped link once they are
+        delivered, until the link is closed and the queue is empty.'''
+        while True:
+            with self.send_condition:
+                while True:
+                    now = time.time()
+                    if self.outgoing and self.outgoing[0][0] <= now:
+                        delivery, frame = self.outgoing.popleft()
+                        break
+                    if self.closed and not self.outgoing:
+                        return
+                    wait = None
+                    if self.outgoing:
+                        wait = self.outgoing[0][0] - now
+                    self.send_condition.wait(wait)
+            try:
+                self.link.write(frame)
+            except Exception as e:
+                LOGGER.error('Impaired link write failed: %s', e)
+
+    def _receive(self):
+        '''Read the wrapped link and queue the frames.'''
+        frame = []
+        while not self.closed and not getattr(self.link, 'closed', False):
+            try:
+                data = self.link.read(1)
+            except Exception as e:
+                LOGGER.error('Impaired link read failed: %s', e)
+                break
+            if is_text(data):
+                data = data.encode('utf-8')
+            if data:
+                frame.append(data)
+                if data != self.FLAG:
+                    continue
+            if frame:
+                self._queue(b''.join(frame))
+                frame = []
+
+    def _queue(self, data):
+        data = self.impair(data, self.read_random)
+        if data is None:
+            return
+        now = time.time()
+        transfer = RTTEstimator.transfer_time(len(data), self.baudrate)
+        self.channel_free = max(now, self.channel_free) + transfer
+        # frames are released in order
+        self.released = max(self.channel_free + self.delay(self.read_random),
+                            self.released)
+        with self.condition:
+            self.pending.append((self.released, data))
+            self.condition.notify_all()
+
+    def read(self, size=None, timeout=None):
+        '''Read up to `size` bytes of the released frames, b'' if none is
+        released within `timeout` (default the link timeout).'''
+        deadline = time.time() + (timeout or self.timeout)
+        with self.condition:
+            while True:
+                now = time.time()
+                if self.pending and self.pending[0][0] <= now:
+                    release, data = self.pending.popleft()
+                    size = size or len(data)
+                    if len(data) > size:
+                        self.pending.appendleft((release, data[size:]))
+                    return data[:size]
+                if now >= deadline:
+                    return b''
+                wait = deadline - now
+                if self.pending:
+                    wait = min(wait, self.pending[0][0] - now)
+                self.condition.wait(wait)
+
+
+def benchmark(device, tablename, filename='.TDF', prefetch=0, check=None):
+    '''Measure the throughput of `getfile` and `get_data_generator`. Return
+    a dict of the sizes, durations and rates, and of the timeouts and
+    signature errors of the session.
+
+    :param device: A `CR1000`.
+    :param tablename: The table collected entirely.
+    :param filename: The file read.
+    :param prefetch: The `prefetch` of `get_data_generator`.
+    :param check: Function called with each list of collected records, to
+                  verify them.
+    '''
+    results = {}
+    begin = time.time()
+    data = device.getfile(filename)
+    duration = time.time() - begin
+    results['file_bytes'] = len(data)
+    results['file_seconds'] = duration
+    results['file_bytes_per_second'] = len(data) / duration if duration else 0
+
+    begin = time.time()
+    records = 0
+    for items in device.get_data_generator(tablename, prefetch=prefetch):
+        records += len(items)
+        if check is not None:
+            check(items)
+    duration = time.time() - begin
+    results['records'] = records
+    results['records_seconds'] = duration
+    results['records_per_second'] = records / duration if duration else 0
+    results['timeouts'] = device.metrics.get('timeouts_total')
+    results['signature_errors'] = device.metrics.get('signature_errors_total')
+    return results
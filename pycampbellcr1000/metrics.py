@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.metrics
+    ------------------------
+
+    Counters and histograms of the transactions, the link and the decoding,
+    kept by `PakBus` and `CR1000`::
+
+        >>> device.metrics.snapshot()['counters']['timeouts_total']
+        >>> with open('station.prom', 'w') as output:
+        ...     device.metrics.write_prometheus(output)
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import time
+import threading
+
+try:
+    process_time = time.process_time
+except AttributeError:  # python 2
+    process_time = time.clock
+
+
+#: Upper bounds of the buckets of the histograms in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    'bytes_sent_total': 'Bytes written to the link',
+    'bytes_received_total': 'Bytes read from the link',
+    'signature_errors_total': 'Packets read with a bad signature',
+    'timeouts_total': 'Commands without response',
+    'please_waits_total': 'Please wait messages received',
+    'transactions_total': 'Commands answered',
+    'records_decoded_total': 'Records decoded from collect data pages',
+    'pages_decoded_total': 'Collect data pages decoded',
+    'rtt_seconds': 'Round-trip time of the commands',
+    'page_decode_seconds': 'CPU time spent decoding a collect data page',
+}
+
+
+class Histogram(object):
+    '''Cumulative histogram of observed values.
+
+    :param buckets: The sorted upper bounds of the buckets.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        '''Add an observed `value`.'''
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': list(zip(self.buckets, self.counts))}
+
+
+def format_labels(labels):
+    '''Return the Prometheus text form of the `(name, value)` labels.'''
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in labels)
+
+
+class Metrics(object):
+    '''Counters and histograms of a session, by name and labels.
+
+    :param prefix: Prefix of the Prometheus metric names.
+    '''
+
+    def __init__(self, prefix='pycr1000'):
+        self.prefix = prefix
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        '''Add `value` to the counter `name`.'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        '''Add the observed `value` to the histogram `name`.'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def get(self, name, **labels):
+        '''Return the value of the counter `name`, the sum of all its labels
+        if none is given.'''
+        with self.lock:
+            if labels:
+                return self.counters.get((name, tuple(sorted(labels.items()))),
+                                         0)
+            return sum(value for (key, _), value in self.counters.items()
+                       if key == name)
+
+    def snapshot(self):
+        '''Return the counters, the histograms and the decoding rate as a
+        dict. The counters and histograms are keyed by name, then by labels
+        string (empty without labels).'''
+        counters, histograms = {}, {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                counters.setdefault(name, {})[format_labels(labels)] = value
+            for (name, labels), histogram in self.histograms.items():
+                histograms.setdefault(name, {})[format_labels(labels)] = \
+                    histogram.snapshot()
+        elapsed = time.time() - self.started
+        records = sum(counters.get('records_decoded_total', {}).values())
+        return {'elapsed': elapsed, 'counters': counters,
+                'histograms': histograms,
+                'records_per_second': records / elapsed if elapsed else 0}
+
+    def write_prometheus(self, output):
+        '''Write the metrics to the `output` file in the Prometheus text
+        exposition format.'''
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.snapshot())
+                                for key, histogram in self.histograms.items())
+        lines = []
+        previous = None
+        for (name, labels), value in counters:
+            metric = '%s_%s' % (self.prefix, name)
+            if name != previous:
+                lines.append('# HELP %s %s' % (metric, HELP.get(name, name)))
+                lines.append('# TYPE %s counter' % metric)
+                previous = name
+            lines.append('%s%s %s' % (metric, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            metric = '%s_%s' % (self.prefix, name)
+            if name != previous:
+                lines.append('# HELP %s %s' % (metric, HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % metric)
+                previous = name
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket%s %s' % (
+                    metric, format_labels(labels + (('le', bound),)), count))
+            lines.append('%s_bucket%s %s' % (
+                metric, format_labels(labels + (('le', '+Inf'),)),
+                histogram['count']))
+            lines.append('%s_sum%s %s' % (metric, format_labels(labels),
+                                          histogram['sum']))
+            lines.append('%s_count%s %s' % (metric, format_labels(labels),
+                                            histogram['count']))
+        output.write('\n'.join(lines) + '\n')
@@ -15,12 +15,21 @@ from __future__ import division, unicode_literals
 
 import struct
 import time
+import logging
+import threading
 
 from .compat import ord, chr, is_text, is_py3, bytes
 from .logger import LOGGER
 from .utils import Singleton
 from .exceptions import DeliveryFailureException
-from .utils import bytes_to_hex, nsec_to_time
+from .metrics import Metrics
+from .hooks import Hooks
+from .utils import nsec_to_time, HexBytes
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class Transaction(Singleton):
@@ -32,6 +41,78 @@ class Transaction(Singleton):
         return self.id
 
 
+class RTTEstimator(object):
+    '''Retransmission timeout of a session, from the smoothed round-trip
+    time and its variance (as TCP does), seeded from the hop metric of the
+    hello response. The transfer time of the packets at the link baud rate
+    is measured apart, so the timeout scales with the payload size.
+
+    :param timeout: Timeout in seconds before any measure.
+    :param min_timeout: Lower bound of the timeout.
+    :param max_timeout: Upper bound of the timeout.
+    '''
+    #: Response time (seconds) of each PakBus hop metric code.
+    HOP_METRICS = {0: 0.2, 1: 1, 2: 5, 3: 10, 4: 20, 5: 60, 6: 300, 7: 1800}
+    #: Maximum size in bytes of a response.
+    MAX_RESPONSE = 1010
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    def __init__(self, timeout=10, min_timeout=0.2, max_timeout=60):
+        self.min_timeout = min_timeout
+        self.max_timeout = max(max_timeout, timeout)
+        self.rto = timeout
+        self.srtt = None
+        self.rttvar = None
+        self.measured = False
+
+    def _update_rto(self):
+        self.rto = min(max(self.srtt + 4 * self.rttvar, self.min_timeout),
+                       self.max_timeout)
+
+    def seed(self, hop_metric):
+        '''Estimate the round-trip time from `hop_metric` until it is
+        measured. The timeout is not shorter than the response time of the
+        hop metric.'''
+        if hop_metric not in self.HOP_METRICS:
+            return
+        delay = self.HOP_METRICS[hop_metric]
+        self.min_timeout = min(max(self.min_timeout, delay), self.max_timeout)
+        if not self.measured:
+            self.srtt, self.rttvar = delay, delay / 2
+        if self.srtt is not None:
+            self._update_rto()
+
+    def add(self, rtt):
+        '''Add a measured round-trip time (without transfer time).'''
+        if not self.measured:
+            self.srtt, self.rttvar = rtt, rtt / 2
+            self.measured = True
+        else:
+            self.rttvar += self.BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.ALPHA * (rtt - self.srtt)
+        self._update_rto()
+
+    def backoff(self, timeout):
+        '''Return the timeout of the next attempt of a request after
+        `timeout` expired: twice longer, up to `max_timeout`. The timeout
+        of the next requests is not changed.'''
+        return max(min(timeout * 2, self.max_timeout), timeout)
+
+    @classmethod
+    def transfer_time(cls, size, baudrate=None):
+        '''Return the time to send `size` bytes at `baudrate` (10 bits per
+        byte), 0 if the link has no baud rate.'''
+        if not baudrate:
+            return 0
+        return size * 10 / baudrate
+
+    def timeout(self, size, baudrate=None):
+        '''Return the timeout of a request of `size` bytes.'''
+        return self.rto + self.transfer_time(size + self.MAX_RESPONSE,
+                                             baudrate)
+
+
 class PakBus(object):
     '''Interface for a pakbus client.
 
@@ -73,10 +154,32 @@ class PakBus(object):
         'SecNano': {'code': 23, 'fmt': '<2l', 'size': 8},
     }
 
+    # NumPy dtype of the data types decoded in bulk into arrays
+    ARRAYTYPE = {
+        'Byte': 'u1', 'UInt2': '>u2', 'UInt4': '>u4', 'Int1': 'i1',
+        'Int2': '>i2', 'Int4': '>i4', 'IEEE4B': '>f4', 'IEEE8B': '>f8',
+        'Bool8': 'u1', 'Bool': 'u1', 'Bool2': '>u2', 'Bool4': '>u4',
+        'Sec': '>i4', 'FP2': '>u2', 'Short': '<i2', 'Long': '<i4',
+        'UShort': '<u2', 'ULong': '<u4', 'IEEE4L': '<f4', 'IEEE8L': '<f8',
+    }
+
     # link state
     RING = 0x9
     READY = 0xA
     FINISHED = 0xB
+    # longest read of the link while waiting for a packet (seconds)
+    POLL_TIME = 1
+    # seconds a packet or a please wait message of another transaction is
+    # kept for its own wait
+    MAILBOX_AGE = 60
+    #: (HiProtoCode, MsgType) of the commands which can be sent again
+    #: without side effect: hello, getsettings, collectdata, getprogstat,
+    #: getvalues and fileupload. The clock command is repeated only when it
+    #: does not adjust the clock.
+    IDEMPOTENT = frozenset([(0x0, 0x09), (0x0, 0x0f), (0x1, 0x09),
+                            (0x1, 0x18), (0x1, 0x1a), (0x1, 0x1d)])
+    #: A `FrameCapture` recording the frames written and read.
+    capture = None
 
     def __init__(self, link, dest_addr=None, dest=0x001,
                  src_addr=None, src=0x802, security_code=0x0000):
@@ -93,31 +196,57 @@ class PakBus(object):
             self.dest_addr = dest
         self.security_code = security_code
         self.transaction = Transaction()
+        # size in bytes of the last packet read
+        self.read_size = 0
+        # (time received, hdr, msg) packets and please wait deadlines of the
+        # transactions not being waited for, by transaction number
+        self.mailbox = {}
+        self.please_wait = {}
+        self.delayed = False
+        self.lock = threading.RLock()
+        self.metrics = Metrics()
+        self.hooks = Hooks()
         LOGGER.info('Get the node attention')
         self.link.write(b'\xBD\xBD\xBD\xBD\xBD\xBD')
               
 
     def write(self, packet):
         '''Send packet over PakBus.'''
-        LOGGER.info('Packet data: %s' % bytes_to_hex(packet))
+        LOGGER.info('Packet data: %s', HexBytes(packet))
         LOGGER.info('Calculate signature for packet')
         sign = self.compute_signature(packet)
         LOGGER.info('Calculate signature nullifier to create packet')
         nullifier = self.compute_signature_nullifier(sign)
-        frame = self.quote(b''.join((packet, nullifier)))
-        packet = b''.join((b'\xBD', frame, b'\xBD'))
-        LOGGER.info('Write: %s' % bytes_to_hex(packet))
-        self.link.write(packet)
-
-    def read(self):
-        '''Receive packet over PakBus.'''
+        packet = b''.join((packet, nullifier))
+        if self.capture is not None:
+            self.capture.write(self.capture.OUT, packet)
+        frame = b''.join((b'\xBD', self.quote(packet), b'\xBD'))
+        LOGGER.info('Write: %s', HexBytes(frame))
+        begin = time.time()
+        self.link.write(frame)
+        if self.hooks.active:
+            self.hooks.emit('frame_written', size=len(packet),
+                            wire_size=len(frame),
+                            duration=time.time() - begin)
+        self.metrics.inc('bytes_sent_total', len(packet), stage='packet')
+        self.metrics.inc('bytes_sent_total', len(frame), stage='wire')
+
+    def read(self, timeout=None):
+        '''Receive packet over PakBus.
+
+        :param timeout: Time to wait for the packet, by default the link
+                        timeout.
+        '''
         all_bytes = []
         byte = None
+        verbose = LOGGER.isEnabledFor(logging.INFO)
         begin = time.time()
+        deadline = begin + (timeout or self.link.timeout)
+        self.read_size = 0
         while byte != b'\xBD':
-            if (byte != None):
-                LOGGER.info('Read byte: %s' % bytes_to_hex(byte))
-            if time.time() - begin > self.link.timeout:
+            if verbose and byte is not None:
+                LOGGER.info('Read byte: %s', HexBytes(byte))
+            if time.time() > deadline:
                 return None
             # Read until first \xBD frame character
             byte = self._read_one_byte()
@@ -125,18 +254,32 @@ class PakBus(object):
             # Read unitl first character other than \xBD
             byte = self._read_one_byte()
         while byte != b'\xBD':
+            if not byte and time.time() > deadline:
+                LOGGER.error('Incomplete packet')
+                return None
             # Read until next occurence of \xBD character
             all_bytes.append(byte)
             byte = self._read_one_byte()
 
         # Unquote quoted characters
         packet = b''.join(all_bytes)
-        LOGGER.info('Read packet: %s' % bytes_to_hex(packet))
+        self.read_size = len(packet) + 2
+        LOGGER.info('Read packet: %s', HexBytes(packet))
         packet = self.unquote(packet)
+        if self.capture is not None:
+            self.capture.write(self.capture.IN, packet)
+        self.metrics.inc('bytes_received_total', self.read_size, stage='wire')
+        self.metrics.inc('bytes_received_total', len(packet), stage='packet')
+        valid = not self.compute_signature(packet)
+        if self.hooks.active:
+            self.hooks.emit('frame_received', size=len(packet),
+                            wire_size=self.read_size, valid=valid,
+                            duration=time.time() - begin)
 
         # Calculate signature (should be zero)
-        if self.compute_signature(packet):
+        if not valid:
             LOGGER.error('Check signature : Error')
+            self.metrics.inc('signature_errors_total')
             return None
         else:
             LOGGER.info('Check signature : OK')
@@ -151,44 +294,137 @@ class PakBus(object):
         else:
             return data
 
-    def wait_packet(self, transac_id=None):
+    @classmethod
+    def response_type(cls, packet):
+        '''Return the (HiProtoCode, MsgType) of the response to the command
+        `packet`.'''
+        return ord(packet[4]) >> 4, ord(packet[8]) | 0x80
+
+    def forget(self, transac_id):
+        '''Drop the packet and the please wait message kept for
+        `transac_id`: a new transaction with this number is sent, they
+        answer an older one.'''
+        with self.lock:
+            self.mailbox.pop(transac_id, None)
+            self.please_wait.pop(transac_id, None)
+
+    def _purge(self):
+        '''Drop the packets and the please wait messages of the mailbox
+        older than `MAILBOX_AGE`.'''
+        limit = time.time() - self.MAILBOX_AGE
+        for transac_id, (received, hdr, msg) in list(self.mailbox.items()):
+            if received < limit:
+                del self.mailbox[transac_id]
+        for transac_id, deadline in list(self.please_wait.items()):
+            if deadline < limit:
+                del self.please_wait[transac_id]
+
+    @staticmethod
+    def _is_response(hdr, msg, expected):
+        '''Check if the packet answers a command whose response is of the
+        `expected` (HiProtoCode, MsgType). A delivery failure answers any
+        command.'''
+        if expected is None:
+            return True
+        msgtype = (hdr['HiProtoCode'], msg['MsgType'])
+        if msgtype == (0x1, 0xa1):
+            # please wait message, with the type of the command
+            return msg['CmdMsgType'] | 0x80 == expected[1]
+        return msgtype in (expected, (0x0, 0x81))
+
+    def wait_packet(self, transac_id=None, timeout=None, expected=None):
         '''Wait for an incoming packet.
 
-        :param transac_id: Expected transaction number.
+        A please wait message of the transaction extends its deadline by the
+        announced time, the link is still read meanwhile. The packets of
+        other transactions are kept in a mailbox for their own wait, up to
+        `MAILBOX_AGE` seconds.
+
+        :param transac_id: Expected transaction number (default the first
+                           packet for us).
+        :param timeout: Time to wait for the packet, by default the link
+                        timeout.
+        :param expected: The (HiProtoCode, MsgType) of the response (see
+                         `response_type`). The packets of the transaction
+                         of another type answer an older command with the
+                         same transaction number, they are dropped.
         '''
-        LOGGER.info('Wait packet with transaction %s' % transac_id)
-        data = self.read()
-        if data is None or data == b'':
-            return {}, {}
-
-        hdr, msg = self.decode_packet(data)
-        if hdr == {} or msg == {}:
-            return hdr, msg
-
-        # ignore packets that are not for us
-
-        LOGGER.info('src, SrcNodeId = <%x, %x>' %
-                    (self.src, hdr['SrcNodeId']))
-        LOGGER.info('dest, DstNodeId = <%x, %x>' %
-                    (self.dest, hdr['DstNodeId']))
-
-        if (hdr['DstNodeId'] != self.src):
-            return {}, {}
-
-        # Handle 'please wait' packets
-        if msg['TranNbr'] == transac_id and msg['MsgType'] == 0xa1:
-            timewait = msg['WaitSec']
-            LOGGER.info('Please Wait Message packet <%s sec>' % timewait)
-            time.sleep(timewait)
-            return self.wait_packet(transac_id)
-
+        LOGGER.info('Wait packet with transaction %s', transac_id)
+        timeout = timeout or self.link.timeout
+        deadline = time.time() + timeout
+        # the response was delayed by a please wait message
+        self.delayed = False
+        while True:
+            with self.lock:
+                if transac_id in self.mailbox:
+                    received, hdr, msg = self.mailbox.pop(transac_id)
+                    if self._is_response(hdr, msg, expected):
+                        return self._received(hdr, msg)
+                    LOGGER.info('Drop stale packet of transaction %s',
+                                transac_id)
+                if transac_id in self.please_wait:
+                    # announced before this wait began
+                    deadline = max(deadline,
+                                   self.please_wait.pop(transac_id) + timeout)
+                    self.delayed = True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return {}, {}
+                data = self.read(min(remaining, self.POLL_TIME))
+            if data is None or data == b'':
+                continue
+
+            begin = time.time()
+            hdr, msg = self.decode_packet(data)
+            if self.hooks.active:
+                self.hooks.emit('packet_decoded', hdr=hdr, msg=msg,
+                                duration=time.time() - begin)
+            if hdr == {} or msg == {}:
+                continue
+
+            # ignore packets that are not for us
+            LOGGER.info('src, SrcNodeId = <%x, %x>', self.src,
+                        hdr['SrcNodeId'])
+            LOGGER.info('dest, DstNodeId = <%x, %x>', self.dest,
+                        hdr['DstNodeId'])
+            if (hdr['DstNodeId'] != self.src):
+                continue
+
+            if msg['TranNbr'] == transac_id and \
+                    not self._is_response(hdr, msg, expected):
+                LOGGER.info('Drop stale packet of transaction %s',
+                            transac_id)
+                continue
+
+            # Handle 'please wait' packets
+            if msg['MsgType'] == 0xa1:
+                timewait = msg['WaitSec']
+                LOGGER.info('Please Wait Message packet <%s sec>', timewait)
+                self.metrics.inc('please_waits_total')
+                if msg['TranNbr'] == transac_id:
+                    deadline = max(deadline, time.time() + timewait + timeout)
+                    self.delayed = True
+                else:
+                    with self.lock:
+                        self._purge()
+                        self.please_wait[msg['TranNbr']] = \
+                            time.time() + timewait
+                continue
+
+            # This should be the packet we are waiting for
+            if transac_id is None or msg['TranNbr'] == transac_id:
+                return self._received(hdr, msg)
+            LOGGER.info('Keep packet of transaction %s', msg['TranNbr'])
+            with self.lock:
+                self._purge()
+                self.mailbox[msg['TranNbr']] = (time.time(), hdr, msg)
+
+    def _received(self, hdr, msg):
+        '''Return the received packet of a transaction.'''
         # Handle failure message packets and raise exception
         if msg['MsgType'] == 0x81:
             raise DeliveryFailureException()
-
-        # This should be the packet we are waiting for
-        if msg['TranNbr'] == transac_id:
-            return hdr, msg
+        return hdr, msg
 
     def pack_header(self, hi_proto, exp_more=0x2, link_state=None,
                     hops=0x0):
@@ -212,7 +448,18 @@ class PakBus(object):
                           (hops & 0xF) << 12 | (self.src & 0xFFF))
         return hdr
 
-    def compute_signature(self, buff, seed=0xAAAA):
+    @classmethod
+    def is_idempotent(cls, packet):
+        '''Check if the command `packet` can be sent again when no response
+        comes.'''
+        command = (ord(packet[4]) >> 4, ord(packet[8]))
+        if command == (0x1, 0x17):
+            # clock adjustment (NSec) after the security code
+            return packet[12:20] == b'\0' * 8
+        return command in cls.IDEMPOTENT
+
+    @classmethod
+    def compute_signature(cls, buff, seed=0xAAAA):
         '''Compute signature for PakBus packets.'''
         sig = seed
         for x in buff:
@@ -281,14 +528,15 @@ class PakBus(object):
             buff.append(enc)
         return b''.join(buff)
 
-    def decode_bin(self, types, buff, length=1):
+    @classmethod
+    def decode_bin(cls, types, buff, length=1):
         '''Decode binary data according to data type.'''
         offset = 0  # offset into buffer
         values = []  # list of values to return
         for type_ in types:
             # get default format and size for Type
-            fmt = self.DATATYPE[type_]['fmt']
-            size = self.DATATYPE[type_]['size']
+            fmt = cls.DATATYPE[type_]['fmt']
+            size = cls.DATATYPE[type_]['size']
 
             if type_ == 'ASCIIZ':
                 # special handling: nul-terminated string
@@ -328,17 +576,10 @@ class PakBus(object):
         # Return decoded values and current offset into buffer (size)
         return values, offset
 
-    def decode_packet(self, data):
-        '''Decode packet from raw data.'''
-        LOGGER.info('Decode packet')
-        # pkt: buffer containing unquoted packet, signature nullifier stripped
-        # Initialize output variables
-        hdr = {'LinkState': None, 'DstPhyAddr': None, 'ExpMoreCode': None,
-               'Priority': None, 'SrcPhyAddr': None, 'HiProtoCode': None,
-               'DstNodeId': None, 'HopCnt': None, 'SrcNodeId': None}
-        msg = {'MsgType': None, 'TranNbr': None, 'raw': None}
-
-        # decode PakBus header
+    @classmethod
+    def decode_header(cls, data):
+        '''Decode the PakBus header of the packet `data`.'''
+        hdr = {}
         rawhdr = struct.unpack(str('>4H'), data[0:8])  # raw header bits
         hdr['LinkState'] = rawhdr[0] >> 12
         hdr['DstPhyAddr'] = rawhdr[0] & 0x0FFF
@@ -349,14 +590,25 @@ class PakBus(object):
         hdr['DstNodeId'] = rawhdr[2] & 0x0FFF
         hdr['HopCnt'] = rawhdr[3] >> 12
         hdr['SrcNodeId'] = rawhdr[3] & 0x0FFF
+        return hdr
+
+    def decode_packet(self, data):
+        '''Decode packet from raw data.'''
+        LOGGER.info('Decode packet')
+        # pkt: buffer containing unquoted packet, signature nullifier stripped
+        # Initialize output variables
+        msg = {'MsgType': None, 'TranNbr': None, 'raw': None}
+
+        # decode PakBus header
+        hdr = self.decode_header(data)
 
         # decode default message fields:
         # raw message, message type and transaction number
         msg['raw'] = data[8:]
         values, size = self.decode_bin(('Byte', 'Byte'), msg['raw'][:2])
         msg['MsgType'], msg['TranNbr'] = values
-        LOGGER.info('HiProtoCode, MsgType = <%x, %x>' %
-                    (hdr['HiProtoCode'], msg['MsgType']))
+        LOGGER.info('HiProtoCode, MsgType = <%x, %x>', hdr['HiProtoCode'],
+                    msg['MsgType'])
 
         # PakBus Control Packets
         if hdr['HiProtoCode'] == 0 and msg['MsgType'] in (0x09, 0x89, 0xe):
@@ -372,6 +624,10 @@ class PakBus(object):
             msg = self.unpack_clock_response(msg)
         elif hdr['HiProtoCode'] == 1 and msg['MsgType'] == 0x98:
             msg = self.unpack_getprogstat_response(msg)
+        elif hdr['HiProtoCode'] == 1 and msg['MsgType'] == 0x9a:
+            msg = self.unpack_getvalues_response(msg)
+        elif hdr['HiProtoCode'] == 1 and msg['MsgType'] == 0x9b:
+            msg = self.unpack_setvalues_response(msg)
         elif hdr['HiProtoCode'] == 1 and msg['MsgType'] == 0x9c:
             msg = self.unpack_filedownload_response(msg)
         elif hdr['HiProtoCode'] == 1 and msg['MsgType'] == 0x9d:
@@ -379,8 +635,8 @@ class PakBus(object):
         elif hdr['HiProtoCode'] == 1 and msg['MsgType'] == 0xa1:
             msg = self.unpack_pleasewait_response(msg)
         else:
-            LOGGER.error('No implementation for <(%r, %r)> packet type'
-                         % (hdr['HiProtoCode'], msg['MsgType']))
+            LOGGER.error('No implementation for <(%r, %r)> packet type',
+                         hdr['HiProtoCode'], msg['MsgType'])
         return hdr, msg
 
     def get_hello_cmd(self):
@@ -468,26 +724,38 @@ class PakBus(object):
         :param p1: 1st parameter used to specify what to collect (optional)
         :param p2: 2nd parameter used to specify what to collect (optional)
         '''
+        return self.get_multi_collectdata_cmd(mode, [(tablenbr, tabledefsig,
+                                                      p1, p2)])
+
+    def get_multi_collectdata_cmd(self, mode, tables):
+        '''Create Collect Data Command packet for several tables with the
+        same collection mode.
+
+        :param mode: Collection mode code (p1 and p2 will be used depending on
+                    value).
+        :param tables: List of `(tablenbr, tabledefsig, p1, p2)`.
+        '''
         transac_id = self.transaction.next_id()
         # BMP5 Application Packet
         hdr = self.pack_header(0x1)
         msg = self.encode_bin(['Byte', 'Byte', 'UInt2', 'Byte'],
                               [0x09, transac_id, self.security_code,
                                mode])
-        # encode table number and signature
-        msg += self.encode_bin(['UInt2', 'UInt2'], [tablenbr, tabledefsig])
-        # add p1 and p2 according to collect mode
-        if (mode == 0x04) | (mode == 0x05):
-            # only P1 used (type UInt4)
-            msg += self.encode_bin(['UInt4'], [p1])
-        elif (mode == 0x06) | (mode == 0x08):
-            # P1 and P2 used (type UInt4)
-            msg += self.encode_bin(['UInt4', 'UInt4'], [p1, p2])
-        elif mode == 0x07:
-            # P1 and P2 used (type NSec)
-            msg += self.encode_bin(['NSec', 'NSec'], [p1, p2])
-        # add field list = all fields
-        msg += self.encode_bin(['UInt2'], [0])
+        for tablenbr, tabledefsig, p1, p2 in tables:
+            # encode table number and signature
+            msg += self.encode_bin(['UInt2', 'UInt2'], [tablenbr, tabledefsig])
+            # add p1 and p2 according to collect mode
+            if (mode == 0x04) | (mode == 0x05):
+                # only P1 used (type UInt4)
+                msg += self.encode_bin(['UInt4'], [p1])
+            elif (mode == 0x06) | (mode == 0x08):
+                # P1 and P2 used (type UInt4)
+                msg += self.encode_bin(['UInt4', 'UInt4'], [p1, p2])
+            elif mode == 0x07:
+                # P1 and P2 used (type NSec)
+                msg += self.encode_bin(['NSec', 'NSec'], [p1, p2])
+            # add field list = all fields
+            msg += self.encode_bin(['UInt2'], [0])
         return b''.join((hdr, msg)), transac_id
 
     def unpack_collectdata_response(self, msg):
@@ -516,6 +784,55 @@ class PakBus(object):
         msg['RespCode'], msg['Time'] = values
         return msg
 
+    def get_getvalues_cmd(self, tablename, type_, fieldname, swath=1):
+        '''Create Get Values Command packet.
+
+        :param tablename: Name of the table containing the field.
+        :param type_: Data type of the returned values (e.g. 'IEEE4B').
+        :param fieldname: Name of the first field (e.g. 'Temp' or 'Temp(2)').
+        :param swath: Number of values.
+        '''
+        transac_id = self.transaction.next_id()
+        # BMP5 Application Packet
+        hdr = self.pack_header(0x1)
+        msg = self.encode_bin(['Byte', 'Byte', 'UInt2', 'ASCIIZ', 'Byte',
+                               'ASCIIZ', 'UInt2'],
+                              [0x1a, transac_id, self.security_code,
+                               tablename, self.DATATYPE[type_]['code'],
+                               fieldname, swath])
+        return b''.join((hdr, msg)), transac_id
+
+    def unpack_getvalues_response(self, msg):
+        '''Unpack Get Values Response packet.'''
+        (msg['RespCode'],), size = self.decode_bin(['Byte'], msg['raw'][2:])
+        # return raw values for later parsing
+        msg['Values'] = msg['raw'][size + 2:]
+        return msg
+
+    def get_setvalues_cmd(self, tablename, type_, fieldname, values):
+        '''Create Set Values Command packet.
+
+        :param tablename: Name of the table containing the field.
+        :param type_: Data type of the given values (e.g. 'IEEE4B').
+        :param fieldname: Name of the first field (e.g. 'Temp' or 'Temp(2)').
+        :param values: List of values, one for each field of the swath.
+        '''
+        transac_id = self.transaction.next_id()
+        # BMP5 Application Packet
+        hdr = self.pack_header(0x1)
+        msg = self.encode_bin(['Byte', 'Byte', 'UInt2', 'ASCIIZ', 'Byte',
+                               'ASCIIZ', 'UInt2'],
+                              [0x1b, transac_id, self.security_code,
+                               tablename, self.DATATYPE[type_]['code'],
+                               fieldname, len(values)])
+        msg += self.encode_bin(len(values) * [type_], values)
+        return b''.join((hdr, msg)), transac_id
+
+    def unpack_setvalues_response(self, msg):
+        '''Unpack Set Values Response packet.'''
+        (msg['RespCode'],), size = self.decode_bin(['Byte'], msg['raw'][2:])
+        return msg
+
     def get_getprogstat_cmd(self):
         '''Create Get Programming Statistics Transaction packet.'''
         transac_id = self.transaction.next_id()
@@ -615,7 +932,7 @@ class PakBus(object):
             offset += size
 
             # end loop when file attribute list terminator reached
-            if filename == '':
+            if not filename:
                 break
 
             file_['FileName'] = filename
@@ -637,106 +954,206 @@ class PakBus(object):
             fd['files'].append(file_)  # add file entry to list
         return fd
 
-    def parse_tabledef(self, raw):
-        '''Parse table definition.'''
-        tabledef = []  # List of table definitions
+    @classmethod
+    def parse_tabledef(cls, raw):
+        '''Parse table definition.
+
+        Only the table headers are decoded, the field definitions and the
+        signature of each table are decoded when first used (see
+        `TableDef`).'''
+        tabledef = TableDefList()  # List of table definitions
         offset = 0  # offset into raw buffer
-        fslversion, size = self.decode_bin(['Byte'], raw[offset:])
+        fslversion, size = cls.decode_bin(['Byte'], raw[offset:])
         offset += size
 
         # Parse list of table definitions
         while offset < len(raw):
 
             tblhdr = {}  # table header
-            tblfld = []  # table field definitions
             start = offset  # start of table definition
 
             # Extract table header data
             types = ['ASCIIZ', 'UInt4', 'Byte', 'NSec', 'NSec']
-            values, size = self.decode_bin(types, raw[offset:])
+            # the header is small, do not copy the rest of the buffer
+            values, size = cls.decode_bin(types, raw[offset:offset + 256])
             tblhdr['TableName'] = values[0]
             tblhdr['TableSize'] = values[1]
             tblhdr['TimeType'] = values[2]
             tblhdr['TblTimeInto'] = values[3]
             tblhdr['TblInterval'] = values[4]
 
-            offset += size
+            offset = cls.skip_fielddef(raw, offset + size)
+            tabledef.append(TableDef(tblhdr, raw[start:offset], size))
+        return tabledef
 
-            # Extract field definitions
-            (fieldtype,), size = self.decode_bin(['Byte'], raw[offset:])
-            offset += size
+    @classmethod
+    def skip_fielddef(cls, raw, offset):
+        '''Return the offset following the field definitions of a table
+        starting at `offset`, without decoding them.'''
+        try:
+            fieldtype = ord(raw[offset])
+            offset += 1
             while fieldtype != 0:
-                fld = {}
-
-                # Extract bits from fieldtype
-                fld['ReadOnly'] = fieldtype >> 7  # only Bit 7
-
-                # Convert fieldtype to ASCII FieldType (e.g. 'FP4') if possible
-                # else return numerical value
-                fld['FieldType'] = fieldtype & 0x7F  # only Bits 0..6
-                for Type in self.DATATYPE.keys():
-                    if fld['FieldType'] == self.DATATYPE[Type]['code']:
-                        fld['FieldType'] = Type
-                        break
-
-                # Extract field name
-                values, size = self.decode_bin(['ASCIIZ'], raw[offset:])
-                fld['FieldName'] = values[0]
-                offset += size
-
-                # Extract AliasName list
-                fld['AliasName'] = []
-                aliasname = b'00'
-                # Alias names list terminator reached
-                while aliasname != b'':
-                    values, size = self.decode_bin(['ASCIIZ'], raw[offset:])
-                    aliasname = values[0]
-                    offset += size
-                    if aliasname != b'':
-                        fld['AliasName'].append(aliasname)
-
-                # Extract other mandatory field definition items
-                types = ['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4']
-                values, size = self.decode_bin(types, raw[offset:])
-                fld['Processing'] = values[0]
-                fld['Units'] = values[1]
-                fld['Description'] = values[2]
-                fld['BegIdx'] = values[3]
-                fld['Dimension'] = values[4]
-                offset += size
+                # field name
+                offset = raw.index(b'\0', offset) + 1
+                # alias names, up to the empty one
+                while ord(raw[offset]) != 0:
+                    offset = raw.index(b'\0', offset) + 1
+                offset += 1
+                # processing, units and description
+                for i in range(3):
+                    offset = raw.index(b'\0', offset) + 1
+                # BegIdx and Dimension
+                offset += 8
+                # sub dimensions, up to 0
+                while raw[offset:offset + 4] != b'\0\0\0\0':
+                    if offset >= len(raw):
+                        raise IndexError(offset)
+                    offset += 4
+                offset += 4
+                fieldtype = ord(raw[offset])
+                offset += 1
+        except (IndexError, ValueError):
+            # the index of a missing terminator raises ValueError
+            raise ValueError('Truncated table definition')
+        return offset
+
+    @classmethod
+    def parse_fielddef(cls, raw, offset=0):
+        '''Parse the field definitions of a table starting at `offset`.'''
+        tblfld = []  # table field definitions
+
+        # Extract field definitions
+        (fieldtype,), size = cls.decode_bin(['Byte'], raw[offset:])
+        offset += size
+        while fieldtype != 0:
+            fld = {}
+
+            # Extract bits from fieldtype
+            fld['ReadOnly'] = fieldtype >> 7  # only Bit 7
+
+            # Convert fieldtype to ASCII FieldType (e.g. 'FP4') if possible
+            # else return numerical value
+            fld['FieldType'] = fieldtype & 0x7F  # only Bits 0..6
+            for Type in cls.DATATYPE.keys():
+                if fld['FieldType'] == cls.DATATYPE[Type]['code']:
+                    fld['FieldType'] = Type
+                    break
 
-                # Extract sub dimension (if any)
-                fld['SubDim'] = []
-                subdim = 1
-                # sub-dimension list terminator reached
-                while subdim != 0:
-                    (subdim,), size = self.decode_bin(['UInt4'], raw[offset:])
-                    offset += size
-                    if subdim != 0:
-                        fld['SubDim'].append(subdim)
+            # Extract field name
+            values, size = cls.decode_bin(['ASCIIZ'], raw[offset:])
+            fld['FieldName'] = values[0]
+            offset += size
 
-                # append current field definition to list
-                tblfld.append(fld)
+            # Extract AliasName list
+            fld['AliasName'] = []
+            aliasname = b'00'
+            # Alias names list terminator reached
+            while aliasname != b'':
+                values, size = cls.decode_bin(['ASCIIZ'], raw[offset:])
+                aliasname = values[0]
+                offset += size
+                if aliasname != b'':
+                    fld['AliasName'].append(aliasname)
+
+            # Extract other mandatory field definition items
+            types = ['ASCIIZ', 'ASCIIZ', 'ASCIIZ', 'UInt4', 'UInt4']
+            values, size = cls.decode_bin(types, raw[offset:])
+            fld['Processing'] = values[0]
+            fld['Units'] = values[1]
+            fld['Description'] = values[2]
+            fld['BegIdx'] = values[3]
+            fld['Dimension'] = values[4]
+            offset += size
 
-                (fieldtype,), size = self.decode_bin(['Byte'], raw[offset:])
+            # Extract sub dimension (if any)
+            fld['SubDim'] = []
+            subdim = 1
+            # sub-dimension list terminator reached
+            while subdim != 0:
+                (subdim,), size = cls.decode_bin(['UInt4'], raw[offset:])
                 offset += size
-            # calculate table signature
-            tblsig = self.compute_signature(raw[start:offset])
+                if subdim != 0:
+                    fld['SubDim'].append(subdim)
 
-            # Append header, field list and signature to table definition list
-            item = {'Header': tblhdr, 'Fields': tblfld, 'Signature': tblsig}
-            tabledef.append(item)
-        return tabledef
+            # append current field definition to list
+            tblfld.append(fld)
 
-    def parse_collectdata(self, raw, tabledef, fieldnbr=[]):
-        '''Parse data returned by Collectdata Response.'''
+            (fieldtype,), size = cls.decode_bin(['Byte'], raw[offset:])
+            offset += size
+        return tblfld
+
+    @classmethod
+    def decode_array(cls, type_, buff, offset, dimension, subdim=()):
+        '''Decode `dimension` values of `type_` from `buff` at `offset` into
+        a NumPy array shaped from `subdim` (first index varying slowest).
+        The array is a read-only view of `buff` when the data type is not
+        FP2. Return the array and its size in bytes.'''
+        dtype = numpy.dtype(cls.ARRAYTYPE[type_])
+        values = numpy.frombuffer(buff, dtype, dimension, offset)
+        if type_ == 'FP2':
+            mant = (values & 0x1FFF).astype('f8')
+            exp = (values >> 13) & 0x3
+            sign = values >> 15
+            values = numpy.where(sign, -mant, mant) / 10.0 ** exp
+        subdim = tuple(subdim)
+        if len(subdim) > 1 and numpy.prod(subdim) == dimension:
+            values = values.reshape(subdim)
+        return values, dimension * dtype.itemsize
+
+    @classmethod
+    def record_size(cls, tabledef):
+        '''Return the size in bytes of a whole record of the table
+        definition `tabledef`, its time stamp included, as it is sent in the
+        fragments of a record larger than a packet.'''
+        size = cls.DATATYPE['NSec']['size']
+        for field in tabledef['Fields']:
+            if field['FieldType'] == 'ASCII':
+                size += field['Dimension']
+            else:
+                size += field['Dimension'] * \
+                    cls.DATATYPE[field['FieldType']]['size']
+        return size
+
+    @classmethod
+    def parse_collectdata_header(cls, raw):
+        '''Decode only the header of the first fragment of a Collectdata
+        Response, without the table definition. Return the fragment (None if
+        there is no record data) and the flag if more records exist.'''
+        if len(raw) < 9:
+            return None, False
+        frag = {}
+        values, size = cls.decode_bin(['UInt2', 'UInt4', 'UInt2'], raw)
+        frag['TableNbr'], frag['BegRecNbr'], nbrofrecs = values
+        frag['IsOffset'] = nbrofrecs >> 15
+        if frag['IsOffset']:
+            (byteoffset,), size = cls.decode_bin(['UInt4'], raw[6:])
+            frag['ByteOffset'] = byteoffset & 0x7FFFFFFF
+            frag['NbrOfRecs'] = None
+        else:
+            frag['NbrOfRecs'] = nbrofrecs & 0x7FFF
+            frag['ByteOffset'] = None
+        (more_rec,), size = cls.decode_bin(['Bool'], raw[-1:])
+        return frag, more_rec
+
+    @classmethod
+    def parse_collectdata(cls, raw, tabledef, fieldnbr=[], arrays=False):
+        '''Parse data returned by Collectdata Response.
+
+        :param raw: The raw record data.
+        :param tabledef: The table definitions.
+        :param fieldnbr: The numbers of the collected fields (default all).
+        :param arrays: Decode the array fields as NumPy arrays, if NumPy is
+                       installed (see `decode_array`).
+        '''
+        arrays = arrays and numpy is not None
         offset = 0
         recdata = []  # output structure
 
         while offset < len(raw) - 1:
             frag = {}  # record fragment
 
-            values, size = self.decode_bin(['UInt2', 'UInt4'], raw[offset:])
+            values, size = cls.decode_bin(['UInt2', 'UInt4'], raw[offset:])
             frag['TableNbr'], frag['BegRecNbr'] = values
             offset += size
 
@@ -746,12 +1163,12 @@ class PakBus(object):
             frag['TableName'] = tablename
 
             # Decode number of records (16 bits) or ByteOffset (32 Bits)
-            (isoffset,), size = self.decode_bin(['Byte'], raw[offset:])
+            (isoffset,), size = cls.decode_bin(['Byte'], raw[offset:])
             frag['IsOffset'] = isoffset >> 7
 
             # Handle fragmented records
             if frag['IsOffset']:
-                (byteoffset,), size = self.decode_bin(['UInt4'], raw[offset:])
+                (byteoffset,), size = cls.decode_bin(['UInt4'], raw[offset:])
                 offset += size
                 frag['ByteOffset'] = byteoffset & 0x7FFFFFFF
                 frag['NbrOfRecs'] = None
@@ -761,7 +1178,7 @@ class PakBus(object):
 
             # Handle complete records (standard case)
             else:
-                (nbrofrecs,), size = self.decode_bin(['UInt2'], raw[offset:])
+                (nbrofrecs,), size = cls.decode_bin(['UInt2'], raw[offset:])
                 offset += size
                 frag['NbrOfRecs'] = nbrofrecs & 0x7FFF
                 frag['ByteOffset'] = None
@@ -770,9 +1187,12 @@ class PakBus(object):
                 interval = t_frag['Header']['TblInterval']
                 if interval == (0, 0):  # event-driven table
                     timeofrec = None
+                elif not frag['NbrOfRecs']:
+                    # no time without records
+                    timeofrec = None
                 else:
                     # interval data, read time of first record
-                    [timeofrec], size = self.decode_bin(['NSec'], raw[offset:])
+                    [timeofrec], size = cls.decode_bin(['NSec'], raw[offset:])
                     offset += size
 
                 # Loop over all records
@@ -790,7 +1210,7 @@ class PakBus(object):
                         record['TimeOfRec'] = nsec_to_time(next_timeofrec)
                     else:
                         # event-driven, time data precedes each record
-                        values, size = self.decode_bin(['NSec'], raw[offset:])
+                        values, size = cls.decode_bin(['NSec'], raw[offset:])
                         record['TimeOfRec'] = values[0]
                         record['TimeOfRec'] = nsec_to_time(record['TimeOfRec'])
                         offset += size
@@ -810,14 +1230,21 @@ class PakBus(object):
                         fieldtype = t_frag['Fields'][field - 1]['FieldType']
                         dimension = t_frag['Fields'][field - 1]['Dimension']
                         if fieldtype == 'ASCII':
-                            values, size = self.decode_bin([fieldtype],
-                                                           raw[offset:],
-                                                           dimension)
+                            values, size = cls.decode_bin([fieldtype],
+                                                          raw[offset:],
+                                                          dimension)
                             record['Fields'][fieldname] = values[0]
+                        elif (arrays and dimension > 1 and
+                              fieldtype in cls.ARRAYTYPE):
+                            record['Fields'][fieldname], size = \
+                                cls.decode_array(fieldtype, raw, offset,
+                                                 dimension,
+                                                 t_frag['Fields'][field - 1]
+                                                 .get('SubDim', ()))
                         else:
                             values, size = \
-                                self.decode_bin(dimension * [fieldtype],
-                                                raw[offset:])
+                                cls.decode_bin(dimension * [fieldtype],
+                                               raw[offset:])
                             if dimension>1:
                                 record['Fields'][fieldname] = values
                             else:
@@ -828,7 +1255,7 @@ class PakBus(object):
             recdata.append(frag)
 
         # Get flag if more records exist
-        (more_rec,), size = self.decode_bin(['Bool'], raw[offset:])
+        (more_rec,), size = cls.decode_bin(['Bool'], raw[offset:])
         return recdata, more_rec
 
     def __del__(self):
@@ -840,3 +1267,150 @@ class PakBus(object):
 
     def __repr__(self):
         return '%s' % self.__str__()
+
+
+class TableDef(dict):
+    '''Definition of one table: `Header`, `Fields` and `Signature`.
+
+    `Fields` and `Signature` are decoded from the raw table definition when
+    first used.
+
+    :param header: The decoded table header.
+    :param raw: The raw table definition.
+    :param fields_offset: Offset of the field definitions in `raw`.
+    '''
+
+    LAZY_KEYS = ('Fields', 'Signature')
+
+    def __init__(self, header, raw, fields_offset):
+        super(TableDef, self).__init__(Header=header)
+        self.raw = raw
+        self.fields_offset = fields_offset
+
+    def __missing__(self, key):
+        if key == 'Fields':
+            value = PakBus.parse_fielddef(self.raw, self.fields_offset)
+        elif key == 'Signature':
+            # calculate table signature
+            value = PakBus.compute_signature(self.raw)
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+    def load(self):
+        '''Decode the lazy keys now and return the table definition.'''
+        for key in self.LAZY_KEYS:
+            self[key]
+        return self
+
+    # The lazy keys are seen by all the read methods of the mapping, and by
+    # dict(), json.dumps and the comparisons which use them.
+
+    def __contains__(self, key):
+        return key in self.LAZY_KEYS or super(TableDef, self).__contains__(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __iter__(self):
+        return super(TableDef, self.load()).__iter__()
+
+    def __len__(self):
+        return super(TableDef, self.load()).__len__()
+
+    def keys(self):
+        return super(TableDef, self.load()).keys()
+
+    def values(self):
+        return super(TableDef, self.load()).values()
+
+    def items(self):
+        return super(TableDef, self.load()).items()
+
+    def copy(self):
+        return dict(self.load())
+
+    def __eq__(self, other):
+        return super(TableDef, self.load()).__eq__(other)
+
+    def __ne__(self, other):
+        return super(TableDef, self.load()).__ne__(other)
+
+    def __repr__(self):
+        return super(TableDef, self.load()).__repr__()
+
+    __hash__ = None
+
+
+class TableDefList(list):
+    '''List of table definitions, with a table name index.'''
+    names = None
+
+    def find(self, tablename):
+        '''Return the table number and the table definition of
+        `tablename`.'''
+        if is_text(tablename):
+            tablename = tablename.encode('utf-8')
+        if self.names is None or len(self.names) != len(self):
+            self.names = dict((item['Header']['TableName'], i + 1)
+                              for i, item in enumerate(self))
+        if tablename not in self.names:
+            raise ValueError('table %s not found' % tablename)
+        tablenbr = self.names[tablename]
+        return tablenbr, self[tablenbr - 1]
+
+
+class RecordBuffer(object):
+    '''Reassemble a record sent in several fragments (`IsOffset`) into a
+    preallocated buffer.
+
+    :param tablenbr: The table number.
+    :param recnbr: The record number.
+    :param size: The size of the whole record (see `PakBus.record_size`).
+    '''
+
+    def __init__(self, tablenbr, recnbr, size):
+        self.tablenbr = tablenbr
+        self.recnbr = recnbr
+        self.data = bytearray(size)
+        # bytes received from the beginning of the record
+        self.received = 0
+        # MoreRecsExist of the last fragment
+        self.more = False
+
+    @property
+    def complete(self):
+        return self.received >= len(self.data)
+
+    def add(self, recdata):
+        '''Copy the fragment of the raw collectdata response `recdata` in
+        the buffer. Return False if it is not a fragment of this record or
+        it does not follow the received bytes.'''
+        frag, more = PakBus.parse_collectdata_header(recdata)
+        if (frag is None or not frag['IsOffset'] or
+                frag['TableNbr'] != self.tablenbr or
+                frag['BegRecNbr'] != self.recnbr or
+                frag['ByteOffset'] > self.received):
+            return False
+        # TableNbr, BegRecNbr, ByteOffset ... MoreRecsExist
+        chunk = memoryview(recdata)[10:-1]
+        end = min(frag['ByteOffset'] + len(chunk), len(self.data))
+        self.data[frag['ByteOffset']:end] = \
+            chunk[:end - frag['ByteOffset']]
+        if end <= self.received:
+            return False
+        self.received = end
+        self.more = more
+        return True
+
+    def to_recdata(self):
+        '''Return the record as the record data of a collectdata response
+        with one whole record, with the MoreRecsExist flag of the last
+        fragment.'''
+        header = struct.pack(str('>HLH'), self.tablenbr, self.recnbr, 1)
+        more = b'\x01' if self.more else b'\x00'
+        return b''.join((header, bytes(self.data), more))
@@ -0,0 +1,619 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.simulator
+    --------------------------
+
+    A virtual datalogger speaking PakBus, to test and benchmark the client
+    without hardware::
+
+        >>> simulator = Simulator([SimTable('Table1', [('Temp', 'IEEE4B')],
+        ...                                 records=10000)], latency=0.05)
+        >>> device = CR1000(simulator.connect())
+
+    It answers the hello, getsettings, clock, getprogstat, fileupload
+    (`.TDF` and `.DIR` are generated from the tables) and collect data
+    commands (all modes). The records are synthetic: the values of a record
+    only depend on its record number (see `SimTable.record`).
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import math
+import time
+import socket
+import struct
+import threading
+
+from datetime import datetime, timedelta
+
+from .logger import LOGGER
+from .pakbus import PakBus, RTTEstimator
+from .compat import xrange, is_text, socketserver
+from .utils import time_to_nsec
+
+
+FLOAT_TYPES = ('FP2', 'IEEE4B', 'IEEE8B', 'IEEE4L', 'IEEE8L')
+BOOL_TYPES = ('Bool', 'Bool2', 'Bool4', 'Bool8')
+TIME_TYPES = ('NSec', 'SecNano')
+
+
+def encode_fp2(value):
+    '''Encode `value` as a FP2 number, with the largest decimal exponent
+    keeping the mantissa on 13 bits.'''
+    sign = 0x8000 if value < 0 else 0
+    for exp in (3, 2, 1, 0):
+        mant = int(round(abs(value) * 10 ** exp))
+        if mant <= 0x1FFF:
+            return sign | exp << 13 | mant
+    return sign | 0x1FFF
+
+
+class SimTable(object):
+    '''A synthetic table of the simulator.
+
+    :param name: The table name.
+    :param fields: List of `(name, type)` or `(name, type, dimension)`
+                   tuples, the dimension of an ASCII field being its length.
+    :param records: Number of records stored since the first one.
+    :param size: Number of records held by the table, the oldest ones are
+                 overwritten (default `records`).
+    :param interval: Time between two records in seconds.
+    :param start: Datetime of the record 0.
+    :param event: An event-driven table: the records are not evenly spaced
+                  and each one is sent with its time.
+    '''
+
+    def __init__(self, name, fields, records=1000, size=None, interval=60,
+                 start=datetime(2012, 1, 1), event=False):
+        self.name = name
+        self.fields = []
+        for field in fields:
+            name_, type_ = field[:2]
+            dimension = field[2] if len(field) > 2 else 1
+            if (type_ not in PakBus.DATATYPE or type_ == 'ASCIIZ' or
+                    'c' in PakBus.DATATYPE[type_]['fmt']):
+                raise ValueError('unsupported type %s' % type_)
+            self.fields.append((name_, type_, dimension))
+        self.records = records
+        self.size = size or records
+        self.interval = interval
+        self.start = start
+        self.event = event
+        self.signature = PakBus.compute_signature(self.definition())
+
+    @property
+    def first(self):
+        '''The number of the oldest record held.'''
+        return max(self.records - self.size, 0)
+
+    def add(self, n=1):
+        '''Store `n` new records.'''
+        self.records += n
+
+    def time(self, recnbr):
+        '''Return the datetime of the record `recnbr`.'''
+        seconds = recnbr * self.interval
+        if self.event:
+            # irregular but increasing times
+            seconds += recnbr * 37 % self.interval
+        return self.start + timedelta(seconds=seconds)
+
+    def recnbr_at(self, nsec):
+        '''Return the number of the first record at or after `nsec`.'''
+        lo, hi = 0, self.records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if time_to_nsec(self.time(mid)) < tuple(nsec):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def value(self, recnbr, index, element=0):
+        '''Return the value of an element of the field `index` in the record
+        `recnbr`.'''
+        name, type_, dimension = self.fields[index]
+        n = recnbr + element
+        if type_ == 'ASCII':
+            value = ('%s%d' % (name, recnbr)).encode('utf-8')
+            return value[:dimension].ljust(dimension, b'\0')
+        elif type_ in FLOAT_TYPES:
+            # exact in binary and in FP2
+            return n % 100 / 4 + index
+        elif type_ in BOOL_TYPES:
+            return n % 2
+        elif type_ in TIME_TYPES:
+            return time_to_nsec(self.time(recnbr))
+        elif type_ == 'Sec':
+            return time_to_nsec(self.time(recnbr))[0]
+        return (n + index) % 100
+
+    def record(self, recnbr):
+        '''Return the record `recnbr` as a dict, as it is collected.'''
+        record = {'Datetime': self.time(recnbr), 'RecNbr': recnbr}
+        for index, (name, type_, dimension) in enumerate(self.fields):
+            if type_ == 'ASCII' or dimension == 1:
+                record[name] = self.value(recnbr, index)
+            else:
+                record[name] = [self.value(recnbr, index, element)
+                                for element in xrange(dimension)]
+        return record
+
+    def encode(self, recnbr):
+        '''Return the binary record `recnbr`, without its time.'''
+        buff = []
+        for index, (name, type_, dimension) in enumerate(self.fields):
+            if type_ == 'ASCII':
+                buff.append(self.value(recnbr, index))
+                continue
+            fmt = str(PakBus.DATATYPE[type_]['fmt'])
+            for element in xrange(dimension):
+                value = self.value(recnbr, index, element)
+                if type_ == 'FP2':
+                    buff.append(struct.pack(fmt, encode_fp2(value)))
+                elif type_ in TIME_TYPES:
+                    buff.append(struct.pack(fmt, *value))
+                else:
+                    buff.append(struct.pack(fmt, value))
+        return b''.join(buff)
+
+    def encode_time(self, recnbr):
+        '''Return the NSec time of the record `recnbr`.'''
+        return struct.pack(str('>2l'), *time_to_nsec(self.time(recnbr)))
+
+    def definition(self):
+        '''Return the table definition, as in the `.TDF` file.'''
+        interval = (0, 0) if self.event else (self.interval, 0)
+        buff = [self.name.encode('utf-8'), b'\0',
+                struct.pack(str('>LB4l'), self.size, 14, 0, 0, *interval)]
+        for name, type_, dimension in self.fields:
+            # read-only field
+            buff.append(struct.pack(str('B'),
+                                    PakBus.DATATYPE[type_]['code'] | 0x80))
+            # name, no alias, processing, units and description
+            buff.append(name.encode('utf-8') + b'\0\0Smp\0\0\0')
+            # BegIdx, Dimension and no sub dimension
+            buff.append(struct.pack(str('>3L'), 1, dimension, 0))
+        buff.append(b'\0')
+        return b''.join(buff)
+
+    def select(self, mode, p1, p2):
+        '''Return the range of the record numbers held and selected by the
+        collect `mode` and its parameters.'''
+        first, end = self.first, self.records
+        if mode == 0x04:
+            first = max(p1, first)
+        elif mode == 0x05:
+            first = max(end - p1, first)
+        elif mode == 0x06:
+            first, end = max(p1, first), min(p2, end)
+        elif mode == 0x07:
+            first = max(self.recnbr_at(p1), first)
+            end = min(self.recnbr_at(p2), end)
+        return xrange(first, max(first, end))
+
+
+class SocketLink(object):
+    '''A `PyLink`-like link on a connected socket, used on both sides of
+    the simulator connections. Once closed, it is reopened on a new socket
+    from `connect`, if given.
+
+    :param sock: The connected socket.
+    :param timeout: The read timeout in seconds.
+    :param connect: Function returning a new connected socket.
+    '''
+    closed = False
+
+    def __init__(self, sock, timeout=1, connect=None):
+        self.socket = sock
+        self.timeout = timeout
+        self.connect = connect
+
+    @property
+    def url(self):
+        return 'socket:%d' % self.socket.fileno()
+
+    def open(self):
+        if self.closed and self.connect is not None:
+            self.socket = self.connect()
+            self.closed = False
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.socket.close()
+
+    def write(self, data):
+        if is_text(data):
+            data = data.encode('utf-8')
+        self.socket.sendall(data)
+
+    def read(self, size=None, timeout=None):
+        '''Read up to `size` bytes, b'' if none comes within `timeout`
+        (default the link timeout) or the socket is closed.'''
+        if self.closed:
+            return b''
+        try:
+            self.socket.settimeout(timeout or self.timeout)
+            data = self.socket.recv(size or 1024)
+        except socket.timeout:
+            return b''
+        except socket.error:
+            data = b''
+        if not data:
+            # closed by the other side
+            self.closed = True
+        return data
+
+
+class Simulator(object):
+    '''A virtual datalogger answering the PakBus commands of the clients
+    connected to it (see `connect` and `SimulatorServer`).
+
+    :param tables: List of `SimTable` (default a `Table1` of 1000 records).
+    :param node: The PakBus node ID of the datalogger.
+    :param latency: Delay of each response in seconds.
+    :param baudrate: Emulated baud rate: the transfer time of the request
+                     and of the response is added to the delay (None for no
+                     limit).
+    :param please_wait: Delay of the collect data responses in seconds,
+                        announced by a please wait message (0 to disable).
+    :param hop_metric: Hop metric of the hello responses.
+    :param max_packet: Maximum size of a response packet in bytes.
+    :param files: Dict of the file names to their content, besides the
+                  `.TDF` and `.DIR` files.
+    '''
+    #: Time between two checks of the stop flag while reading (seconds).
+    POLL_TIME = 0.1
+    OS_VERSION = 'CR1000.Std.32'
+    SERIAL_NUMBER = '1234'
+    PROGRAM = 'CPU:simulator.cr1'
+
+    def __init__(self, tables=None, node=0x001, latency=0, baudrate=None,
+                 please_wait=0, hop_metric=0, max_packet=1000, files=None):
+        if tables is None:
+            tables = [SimTable('Table1', [('Batt_Volt', 'FP2'),
+                                          ('Temp', 'IEEE4B'),
+                                          ('Count', 'UInt4')])]
+        self.tables = tables
+        self.node = node
+        self.latency = latency
+        self.baudrate = baudrate
+        self.please_wait = please_wait
+        self.hop_metric = hop_metric
+        self.max_packet = max_packet
+        self.files = files
+        if files is None:
+            self.files = {self.PROGRAM: b"'Simulated program\r\nBeginProg\r\n"
+                                        b"EndProg\r\n"}
+        # seconds added to the UTC time by the clock commands
+        self.clock_offset = 0
+        self.stopped = threading.Event()
+        self.links = []
+        self.handlers = {(0x0, 0x09): self.hello,
+                         (0x0, 0x0f): self.getsettings,
+                         (0x1, 0x09): self.collectdata,
+                         (0x1, 0x17): self.clock,
+                         (0x1, 0x18): self.getprogstat,
+                         (0x1, 0x1d): self.fileupload}
+
+    def find(self, tablename):
+        '''Return the `SimTable` named `tablename`.'''
+        for table in self.tables:
+            if table.name == tablename:
+                return table
+        raise ValueError('table %s not found' % tablename)
+
+    def now(self):
+        '''Return the datalogger datetime.'''
+        return datetime.utcnow() + timedelta(seconds=self.clock_offset)
+
+    def table_def_raw(self):
+        '''Return the `.TDF` file of the tables.'''
+        return b'\x01' + b''.join(table.definition() for table in self.tables)
+
+    def filedir_raw(self):
+        '''Return the `.DIR` file listing `files`.'''
+        lastupdate = self.now().strftime('%Y-%m-%d %H:%M:%S')
+        buff = [b'\x01']
+        for name, data in sorted(self.files.items()):
+            buff.append(name.encode('utf-8') + b'\0')
+            buff.append(struct.pack(str('>L'), len(data)))
+            # last update and the run now attribute
+            buff.append(lastupdate.encode('utf-8') + b'\0\x01\0')
+        buff.append(b'\0')
+        return b''.join(buff)
+
+    def connect(self, timeout=1):
+        '''Serve a new connection on a socket pair and return the client
+        link, with the read `timeout`. The link is connected again when it
+        is reopened.'''
+        return SocketLink(self._connect(), timeout, self._connect)
+
+    def _connect(self):
+        client, server = socket.socketpair()
+        self.start(SocketLink(server, self.POLL_TIME))
+        return client
+
+    def start(self, link):
+        '''Serve `link` in a background thread.'''
+        thread = threading.Thread(target=self.serve, args=(link,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        '''Stop serving and close the connections.'''
+        self.stopped.set()
+        for link in list(self.links):
+            link.close()
+
+    def serve(self, link):
+        '''Answer the requests read on `link`, until it is closed or the
+        simulator is stopped.'''
+        self.links.append(link)
+        try:
+            pakbus = PakBus(link, src=self.node)
+            while not self.stopped.is_set() and \
+                    not getattr(link, 'closed', False):
+                data = pakbus.read(self.POLL_TIME)
+                if not data or len(data) < 10:
+                    continue
+                hdr = pakbus.decode_header(data)
+                if hdr['DstNodeId'] != self.node:
+                    continue
+                try:
+                    self.answer(pakbus, hdr, data[8:], len(data))
+                except Exception as e:
+                    LOGGER.error('Simulator failed to answer: %s', e)
+        except socket.error:
+            # the connection was closed by the client or by stop
+            pass
+        finally:
+            self.links.remove(link)
+
+    def answer(self, pakbus, hdr, msg, size):
+        '''Send the response of the request message `msg` of `size`
+        bytes.'''
+        (msgtype, transac_id), offset = pakbus.decode_bin(['Byte', 'Byte'],
+                                                          msg)
+        # answer to the node of the request
+        pakbus.dest = hdr['SrcNodeId']
+        pakbus.dest_addr = hdr['SrcPhyAddr']
+        handler = self.handlers.get((hdr['HiProtoCode'], msgtype))
+        if handler is not None:
+            hi_proto, body = handler(pakbus, transac_id, msg)
+        elif msgtype & 0x80 or (hdr['HiProtoCode'], msgtype) == (0x0, 0x0d):
+            # a response or a bye command
+            return
+        else:
+            # delivery failure: unsupported message type
+            hi_proto = 0x0
+            body = pakbus.encode_bin(['Byte', 'Byte', 'Byte'],
+                                     [0x81, transac_id, 0x04]) + msg[:16]
+        self.send(pakbus, hi_proto, body, size)
+
+    def send(self, pakbus, hi_proto, body, size=0):
+        '''Send the message `body` after the latency and the transfer time of
+        the request of `size` bytes and of the response.'''
+        packet = pakbus.pack_header(hi_proto) + body
+        # framing and signature nullifier
+        transfer = RTTEstimator.transfer_time(size + len(packet) + 8,
+                                              self.baudrate)
+        delay = self.latency + transfer
+        if delay:
+            time.sleep(delay)
+        pakbus.write(packet)
+
+    def hello(self, pakbus, transac_id, msg):
+        return 0x0, pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'Byte',
+                                       'UInt2'],
+                                      [0x89, transac_id, 0x00,
+                                       self.hop_metric, 1800])
+
+    def getsettings(self, pakbus, transac_id, msg):
+        # OS version, serial number, station name, PakBus address
+        settings = [(0, self.OS_VERSION.encode('utf-8'), True),
+                    (1, self.SERIAL_NUMBER.encode('utf-8'), True),
+                    (2, b'Simulator', False),
+                    (3, struct.pack(str('>H'), self.node), False)]
+        buff = [pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'UInt2', 'Byte',
+                                   'Byte', 'Byte'],
+                                  [0x8f, transac_id, 0x01, 14, 1, 0, 0])]
+        for setting, value, readonly in settings:
+            buff.append(struct.pack(str('>HH'), setting,
+                                    readonly << 14 | len(value)))
+            buff.append(value)
+        return 0x0, b''.join(buff)
+
+    def clock(self, pakbus, transac_id, msg):
+        (adjustment,), size = pakbus.decode_bin(['NSec'], msg[4:])
+        old = time_to_nsec(self.now())
+        self.clock_offset += adjustment[0] + adjustment[1] * 1e-9
+        return 0x1, pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'NSec'],
+                                      [0x97, transac_id, 0x00, old])
+
+    def getprogstat(self, pakbus, transac_id, msg):
+        types = ['Byte', 'Byte', 'Byte', 'ASCIIZ', 'UInt2', 'ASCIIZ',
+                 'ASCIIZ', 'Byte', 'ASCIIZ', 'UInt2', 'NSec', 'ASCIIZ']
+        values = [0x98, transac_id, 0x00, self.OS_VERSION, 0x1234,
+                  self.SERIAL_NUMBER, self.PROGRAM, 1, self.PROGRAM,
+                  PakBus.compute_signature(self.files.get(self.PROGRAM, b'')),
+                  time_to_nsec(self.tables[0].start),
+                  'Compiled in SequentialMode.']
+        return 0x1, pakbus.encode_bin(types, values)
+
+    def fileupload(self, pakbus, transac_id, msg):
+        values, size = pakbus.decode_bin(['ASCIIZ', 'Byte', 'UInt4', 'UInt2'],
+                                         msg[4:])
+        filename, closeflag, offset, swath = values
+        filename = filename.decode('utf-8')
+        if filename == '.TDF':
+            data = self.table_def_raw()
+        elif filename == '.DIR':
+            data = self.filedir_raw()
+        else:
+            data = self.files.get(filename)
+        if data is None:
+            # invalid file name
+            respcode, data = 0x0d, b''
+        else:
+            respcode = 0x00
+            swath = min(swath, self.max_packet - 15)
+            data = data[offset:offset + swath]
+        return 0x1, pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'UInt4'],
+                                      [0x9d, transac_id, respcode,
+                                       offset]) + data
+
+    def collectdata(self, pakbus, transac_id, msg):
+        (mode,), offset = pakbus.decode_bin(['Byte'], msg[4:])
+        offset += 4
+        types = {0x04: ['UInt4'], 0x05: ['UInt4'], 0x06: ['UInt4', 'UInt4'],
+                 0x07: ['NSec', 'NSec'],
+                 0x08: ['UInt4', 'UInt4']}.get(mode, [])
+        blocks = []
+        while offset < len(msg):
+            values, size = pakbus.decode_bin(['UInt2', 'UInt2'] + types,
+                                             msg[offset:])
+            offset += size
+            # field list, up to 0 (all fields are always sent)
+            fieldnbr = 1
+            while fieldnbr and offset < len(msg):
+                (fieldnbr,), size = pakbus.decode_bin(['UInt2'],
+                                                      msg[offset:])
+                offset += size
+            blocks.append(values + [0] * (4 - len(values)))
+
+        if self.please_wait:
+            body = pakbus.encode_bin(['Byte', 'Byte', 'Byte', 'UInt2'],
+                                     [0xa1, transac_id, 0x09,
+                                      int(math.ceil(self.please_wait))])
+            self.send(pakbus, 0x1, body)
+            time.sleep(self.please_wait)
+
+        respcode, recdata = self.collect(mode, blocks)
+        return 0x1, pakbus.encode_bin(['Byte', 'Byte', 'Byte'],
+                                      [0x89, transac_id, respcode]) + recdata
+
+    def collect(self, mode, blocks):
+        '''Return the response code and the record data of a collect data
+        request of `mode` for the `(tablenbr, signature, p1, p2)` blocks.'''
+        # header, message type, transaction, response code, more records
+        budget = self.max_packet - 12
+        frags = []
+        more = False
+        for tablenbr, signature, p1, p2 in blocks:
+            if not 0 < tablenbr <= len(self.tables):
+                return 0x07, b''
+            table = self.tables[tablenbr - 1]
+            if signature != table.signature:
+                # invalid table definition
+                return 0x07, b''
+            if mode == 0x08:
+                frag, more = self.partial(tablenbr, table, p1, p2, budget)
+                frags.append(frag)
+                break
+            recnbrs = table.select(mode, p1, p2)
+            frag, count = self.fragment(tablenbr, table, recnbrs, budget,
+                                        not frags)
+            if frag is None:
+                more = True
+                break
+            frags.append(frag)
+            budget -= len(frag)
+            if count < len(recnbrs):
+                more = True
+                break
+        frags.append(struct.pack(str('B'), more))
+        return 0x00, b''.join(frags)
+
+    def fragment(self, tablenbr, table, recnbrs, budget, first):
+        '''Return the fragment of the records `recnbrs` fitting in `budget`
+        bytes and the number of records. If the first record of the response
+        does not fit, the fragment holds its first bytes (`IsOffset`). Return
+        None if no record fits in a following fragment.'''
+        begrecnbr = recnbrs[0] if recnbrs else table.records
+        if not recnbrs:
+            return struct.pack(str('>HLH'), tablenbr, begrecnbr, 0), 0
+        size = PakBus.DATATYPE['NSec']['size']
+        header = 8 if table.event else 8 + size
+        record_size = len(table.encode(begrecnbr))
+        if table.event:
+            record_size += size
+        count = min(len(recnbrs), (budget - header) // record_size)
+        if count <= 0:
+            if not first:
+                return None, 0
+            frag, more = self.partial(tablenbr, table, begrecnbr, 0, budget)
+            return frag, 0
+        buff = [struct.pack(str('>HLH'), tablenbr, begrecnbr, count)]
+        if not table.event:
+            buff.append(table.encode_time(begrecnbr))
+        for recnbr in recnbrs[:count]:
+            if table.event:
+                buff.append(table.encode_time(recnbr))
+            buff.append(table.encode(recnbr))
+        return b''.join(buff), count
+
+    def partial(self, tablenbr, table, recnbr, byteoffset, budget):
+        '''Return the fragment of the record `recnbr` from `byteoffset`
+        (time included) fitting in `budget` bytes, and the flag if more
+        bytes or records follow.'''
+        if not table.first <= recnbr < table.records:
+            return struct.pack(str('>HLH'), tablenbr, recnbr, 0), False
+        data = table.encode_time(recnbr) + table.encode(recnbr)
+        chunk = data[byteoffset:byteoffset + budget - 10]
+        more = (byteoffset + len(chunk) < len(data) or
+                recnbr + 1 < table.records)
+        header = struct.pack(str('>HLL'), tablenbr, recnbr,
+                             0x80000000 | byteoffset)
+        return header + chunk, more
+
+
+class SimulatorServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''Serve a `Simulator` on a TCP port, for `CR1000.from_url` with a
+    `tcp:host:port` URL::
+
+        >>> server = SimulatorServer(Simulator(), ('localhost', 0))
+        >>> server.serve_background()
+        >>> device = CR1000.from_url(server.url)
+
+    :param simulator: The `Simulator`.
+    :param address: The `(host, port)` address, port 0 for any free port.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, simulator, address=('localhost', 0)):
+        self.simulator = simulator
+        socketserver.TCPServer.__init__(self, address, SimulatorHandler)
+
+    @property
+    def url(self):
+        return 'tcp:%s:%d' % self.server_address[:2]
+
+    def serve_background(self):
+        '''Serve in a background thread until `shutdown`.'''
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={'poll_interval': 0.1})
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def shutdown(self):
+        self.simulator.stop()
+        socketserver.TCPServer.shutdown(self)
+        self.server_close()
+
+
+class SimulatorHandler(socketserver.BaseRequestHandler):
+    '''Serve one TCP connection of a `SimulatorServer`.'''
+
+    def handle(self):
+        self.server.simulator.serve(SocketLink(self.request,
+                                               Simulator.POLL_TIME))
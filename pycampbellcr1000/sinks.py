@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.sinks
+    ----------------------
+
+    Local storage of the records collected from the datalogger.
+
+    A sink is created from the table definition of the datalogger and stores
+    the records yielded by `CR1000.get_data_generator`::
+
+        >>> sink = SQLiteSink('station.db', device.table_def)
+        >>> for records in device.get_data_generator('Table1'):
+        ...     sink.write('Table1', records)
+        >>> sink.close()
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import os
+import sqlite3
+
+from datetime import datetime
+
+from .logger import LOGGER
+from .utils import field_name, nsec_to_time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# SQLite column type of the PakBus data types
+SQLITE_TYPES = {
+    'Byte': 'INTEGER', 'UInt2': 'INTEGER', 'UInt4': 'INTEGER',
+    'Int1': 'INTEGER', 'Int2': 'INTEGER', 'Int4': 'INTEGER',
+    'Bool8': 'INTEGER', 'Bool': 'INTEGER', 'Bool2': 'INTEGER',
+    'Bool4': 'INTEGER', 'Sec': 'INTEGER', 'Short': 'INTEGER',
+    'Long': 'INTEGER', 'UShort': 'INTEGER', 'ULong': 'INTEGER',
+    'FP2': 'REAL', 'IEEE4B': 'REAL', 'IEEE8B': 'REAL', 'IEEE4L': 'REAL',
+    'IEEE8L': 'REAL',
+    'NSec': 'TEXT', 'SecNano': 'TEXT', 'ASCII': 'TEXT', 'ASCIIZ': 'TEXT',
+}
+
+
+# Arrow type (pyarrow factory name) of the PakBus data types
+ARROW_TYPES = {
+    'Byte': 'uint8', 'UInt2': 'uint16', 'UInt4': 'uint32', 'Int1': 'int8',
+    'Int2': 'int16', 'Int4': 'int32', 'Bool8': 'uint8', 'Bool': 'uint8',
+    'Bool2': 'uint16', 'Bool4': 'uint32', 'Sec': 'int32', 'Short': 'int16',
+    'Long': 'int32', 'UShort': 'uint16', 'ULong': 'uint32',
+    'FP2': 'float32', 'IEEE4B': 'float32', 'IEEE4L': 'float32',
+    'IEEE8B': 'float64', 'IEEE8L': 'float64',
+    'ASCII': 'string', 'ASCIIZ': 'string',
+}
+
+
+def table_columns(tabledef):
+    '''Return the list of `(record key, column name, data type, element)`
+    tuples of a table definition. Array fields are expanded into one column
+    per element, `element` being None for scalar fields.'''
+    columns = []
+    for field in tabledef['Fields']:
+        name = field_name(field['FieldName'])
+        type_ = field['FieldType']
+        if type_ == 'ASCII' or field['Dimension'] <= 1:
+            columns.append((name, name, type_, None))
+        else:
+            for i in range(field['Dimension']):
+                columns.append((name, '%s(%d)' % (name, i + 1), type_, i))
+    return columns
+
+
+def record_time(value):
+    '''Return the `Datetime` of a record as datetime, records collected with
+    `timestamps=True` giving it as an integer UNIX timestamp.'''
+    if isinstance(value, datetime):
+        return value
+    return datetime.utcfromtimestamp(value)
+
+
+def to_sqlite(value, type_):
+    '''Convert a decoded value to an SQLite value.'''
+    if type_ in ('NSec', 'SecNano'):
+        return nsec_to_time(value).strftime(DATETIME_FORMAT)
+    if type_ in ('ASCII', 'ASCIIZ'):
+        if isinstance(value, bytes):
+            return value.rstrip(b'\0').decode('utf-8', 'replace')
+        return value.rstrip('\0')
+    if SQLITE_TYPES.get(type_) is None:
+        return '%s' % (value, )
+    return value
+
+
+def quote(name):
+    '''Quote an SQL identifier.'''
+    return '"%s"' % name.replace('"', '""')
+
+
+class SQLiteSink(object):
+    '''Store the records in an SQLite database, with one SQL table for each
+    table of the datalogger.
+
+    Records are identified by `(RecNbr, Datetime)`, records already stored
+    are ignored, so overlapping downloads cost nothing. The records are
+    inserted in transactions of `batch_size` rows.
+
+    :param filename: The SQLite database file.
+    :param tabledef: The table definition of the datalogger
+                     (`CR1000.table_def`).
+    :param batch_size: Number of rows inserted per transaction.
+    '''
+
+    def __init__(self, filename, tabledef, batch_size=10000):
+        self.filename = filename
+        self.tabledef = dict((field_name(item['Header']['TableName']), item)
+                             for item in tabledef)
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS _tables '
+                                '(name TEXT PRIMARY KEY, signature INTEGER)')
+        self.tables = {}
+        self.pending = {}
+
+    def _free_name(self, name):
+        '''Return `name`, with a numbered suffix if a table or an index
+        already uses it.'''
+        names = set(row[0].lower() for row in self.connection.execute(
+            'SELECT name FROM sqlite_master'))
+        candidate, number = name, 1
+        while candidate.lower() in names:
+            number += 1
+            candidate = '%s_%d' % (name, number)
+        return candidate
+
+    def _get_table(self, tablename):
+        '''Create the SQL table of `tablename` if needed and return its
+        columns and its insert statement.'''
+        tablename = field_name(tablename)
+        if tablename in self.tables:
+            return self.tables[tablename]
+        tabledef = self.tabledef[tablename]
+        columns = table_columns(tabledef)
+        signature = tabledef['Signature']
+        row = self.connection.execute('SELECT signature FROM _tables WHERE '
+                                      'name = ?', (tablename,)).fetchone()
+        with self.connection:
+            if row is not None and row[0] != signature:
+                # the table definition changed: keep the old records aside
+                aside = self._free_name('%s_%s' % (tablename, row[0]))
+                LOGGER.info('Table definition of %s changed, old records '
+                            'moved to %s' % (tablename, aside))
+                self.connection.execute('ALTER TABLE %s RENAME TO %s' % (
+                    quote(tablename), quote(aside)))
+                # a table set aside earlier may own the index of signature
+                self.connection.execute('DROP INDEX IF EXISTS %s' % quote(
+                    '%s_%s_Datetime' % (tablename, signature)))
+            definition = ['"Datetime" TEXT NOT NULL',
+                          '"RecNbr" INTEGER NOT NULL']
+            for key, column, type_, element in columns:
+                definition.append('%s %s' % (quote(column),
+                                             SQLITE_TYPES.get(type_, 'TEXT')))
+            definition.append('PRIMARY KEY ("RecNbr", "Datetime")')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+                quote(tablename), ', '.join(definition)))
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS %s ON %s ("Datetime")' % (
+                    quote('%s_%s_Datetime' % (tablename, signature)),
+                    quote(tablename)))
+            self.connection.execute('INSERT OR REPLACE INTO _tables VALUES '
+                                    '(?, ?)', (tablename, signature))
+        insert = 'INSERT OR IGNORE INTO %s VALUES (%s)' % (
+            quote(tablename), ', '.join('?' * (len(columns) + 2)))
+        self.tables[tablename] = columns, insert
+        self.pending[tablename] = []
+        return columns, insert
+
+    def write(self, tablename, records):
+        '''Add `records` of `tablename` to the database.'''
+        tablename = field_name(tablename)
+        columns, insert = self._get_table(tablename)
+        pending = self.pending[tablename]
+        for record in records:
+            row = [record_time(record['Datetime']).strftime(DATETIME_FORMAT),
+                   record['RecNbr']]
+            for key, column, type_, element in columns:
+                value = record[key]
+                if element is not None:
+                    value = value[element]
+                row.append(to_sqlite(value, type_))
+            pending.append(row)
+        if len(pending) >= self.batch_size:
+            self.flush(tablename)
+
+    def flush(self, tablename=None):
+        '''Insert the pending rows of `tablename` (by default all tables) in
+        one transaction.'''
+        if tablename is None:
+            tablenames = list(self.pending)
+        else:
+            tablenames = [field_name(tablename)]
+        with self.connection:
+            for name in tablenames:
+                pending = self.pending.get(name)
+                if pending:
+                    self.connection.executemany(self.tables[name][1], pending)
+                    del pending[:]
+
+    def last_record(self, tablename):
+        '''Return the `(Datetime, RecNbr)` of the newest stored record of
+        `tablename`, or None if there is no record.'''
+        tablename = field_name(tablename)
+        self._get_table(tablename)
+        self.flush(tablename)
+        row = self.connection.execute(
+            'SELECT "Datetime", "RecNbr" FROM %s ORDER BY "Datetime" DESC, '
+            '"RecNbr" DESC LIMIT 1' % quote(tablename)).fetchone()
+        if row is None:
+            return None
+        return datetime.strptime(row[0], DATETIME_FORMAT), row[1]
+
+    def iter_recnbrs(self, tablename):
+        '''Yield the `(RecNbr, Datetime)` of the stored records of
+        `tablename` in record number order.'''
+        tablename = field_name(tablename)
+        self._get_table(tablename)
+        self.flush(tablename)
+        cursor = self.connection.execute(
+            'SELECT "RecNbr", "Datetime" FROM %s ORDER BY "RecNbr"' %
+            quote(tablename))
+        for recnbr, dtime in cursor:
+            yield recnbr, datetime.strptime(dtime, DATETIME_FORMAT)
+
+    def close(self):
+        '''Insert the pending rows and close the database.'''
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+
+def arrow_schema(tabledef):
+    '''Return the Arrow schema of a table definition. Array fields are
+    fixed-size lists.'''
+    fields = [pyarrow.field('Datetime', pyarrow.timestamp('us')),
+              pyarrow.field('RecNbr', pyarrow.uint32())]
+    for field in tabledef['Fields']:
+        type_ = field['FieldType']
+        if type_ in ('NSec', 'SecNano'):
+            arrow_type = pyarrow.timestamp('us')
+        else:
+            arrow_type = getattr(pyarrow, ARROW_TYPES.get(type_, 'string'))()
+        if type_ != 'ASCII' and field['Dimension'] > 1:
+            arrow_type = pyarrow.list_(arrow_type, field['Dimension'])
+        fields.append(pyarrow.field(field_name(field['FieldName']),
+                                    arrow_type))
+    return pyarrow.schema(fields)
+
+
+def to_arrow(value, type_):
+    '''Convert a decoded value to a value accepted by Arrow.'''
+    if type_ in ('NSec', 'SecNano'):
+        return nsec_to_time(value)
+    if type_ in ('ASCII', 'ASCIIZ'):
+        if isinstance(value, bytes):
+            return value.rstrip(b'\0').decode('utf-8', 'replace')
+        return value.rstrip('\0')
+    if type_ not in ARROW_TYPES:
+        return '%s' % (value, )
+    return value
+
+
+class ArrowSink(object):
+    '''Store the records as Parquet files partitioned by station, table and
+    day, in `root/station=<station>/table=<table>/date=<YYYY-MM-DD>/`.
+
+    Column types come from the table definition (FP2 as float32, IEEE8 as
+    float64, arrays as fixed-size lists). The rows of each partition are
+    buffered and written in row groups of `row_group_size` rows. Requires
+    the optional `pyarrow` dependency.
+
+    :param root: The root directory of the dataset.
+    :param tabledef: The table definition of the datalogger
+                     (`CR1000.table_def`).
+    :param station: The station name used for partitioning.
+    :param row_group_size: Number of rows per Parquet row group.
+    '''
+
+    def __init__(self, root, tabledef, station='default',
+                 row_group_size=100000):
+        if pyarrow is None:
+            raise ImportError('ArrowSink requires the pyarrow package')
+        self.root = root
+        self.tabledef = dict((field_name(item['Header']['TableName']), item)
+                             for item in tabledef)
+        self.station = station
+        self.row_group_size = row_group_size
+        self.tables = {}
+        self.partitions = {}
+
+    def _get_table(self, tablename):
+        '''Return the schema and the field types of `tablename`.'''
+        if tablename not in self.tables:
+            tabledef = self.tabledef[tablename]
+            types = [field['FieldType'] for field in tabledef['Fields']]
+            self.tables[tablename] = arrow_schema(tabledef), types
+        return self.tables[tablename]
+
+    def write(self, tablename, records):
+        '''Add `records` of `tablename` to the dataset.'''
+        tablename = field_name(tablename)
+        schema, types = self._get_table(tablename)
+        keys = schema.names[1:]
+        self.write_rows(tablename, [[record_time(record['Datetime'])] +
+                                    [record[key] for key in keys]
+                                    for record in records])
+
+    def write_rows(self, tablename, rows):
+        '''Add rows of `tablename` given as `(Datetime, RecNbr, value...)`
+        sequences in table definition order.'''
+        tablename = field_name(tablename)
+        schema, types = self._get_table(tablename)
+        partition = None
+        for row in rows:
+            day = row[0].date()
+            if partition is None or partition['day'] != day:
+                partition = self._get_partition(tablename, day)
+            columns = partition['columns']
+            columns[0].append(row[0])
+            columns[1].append(row[1])
+            for i, type_ in enumerate(types):
+                columns[i + 2].append(to_arrow(row[i + 2], type_))
+            if len(columns[0]) >= self.row_group_size:
+                self._write_row_group(partition)
+
+    def _directory(self, tablename):
+        '''Return the directory of the partitions of `tablename`.'''
+        return os.path.join(self.root, 'station=%s' % self.station,
+                            'table=%s' % tablename)
+
+    def last_record(self, tablename):
+        '''Return the `(Datetime, RecNbr)` of the newest stored record of
+        `tablename`, or None if there is no record. Only the files of the
+        last day stored are read.'''
+        directory = self._directory(field_name(tablename))
+        if not os.path.isdir(directory):
+            return None
+        days = sorted(name for name in os.listdir(directory)
+                      if name.startswith('date='))
+        for day in reversed(days):
+            last = None
+            for name in os.listdir(os.path.join(directory, day)):
+                if not name.endswith('.parquet'):
+                    continue
+                table = pyarrow.parquet.read_table(
+                    os.path.join(directory, day, name),
+                    columns=['Datetime', 'RecNbr'])
+                for record in zip(table.column(0).to_pylist(),
+                                  table.column(1).to_pylist()):
+                    if last is None or record > last:
+                        last = record
+            if last is not None:
+                return last
+        return None
+
+    def _get_partition(self, tablename, day):
+        '''Return the open partition of `tablename` for `day`. Records are
+        sorted by time, so the partitions of the previous days are
+        closed.'''
+        key = (tablename, day)
+        if key not in self.partitions:
+            for other in list(self.partitions):
+                if other[0] == tablename:
+                    self._close_partition(other)
+            schema, types = self._get_table(tablename)
+            self.partitions[key] = {'tablename': tablename, 'day': day,
+                                    'writer': None,
+                                    'columns': [[] for name in schema.names]}
+        return self.partitions[key]
+
+    def _write_row_group(self, partition):
+        '''Write the buffered rows of `partition` as one row group.'''
+        columns = partition['columns']
+        if not columns[0]:
+            return
+        schema, types = self._get_table(partition['tablename'])
+        if partition['writer'] is None:
+            directory = os.path.join(self._directory(partition['tablename']),
+                                     'date=%s' % partition['day'].isoformat())
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'part-%d.parquet' % columns[1][0])
+            i = 0
+            while os.path.exists(path):
+                i += 1
+                path = os.path.join(directory, 'part-%d-%d.parquet'
+                                    % (columns[1][0], i))
+            partition['writer'] = pyarrow.parquet.ParquetWriter(path, schema)
+        arrays = [pyarrow.array(column, type=field.type)
+                  for column, field in zip(columns, schema)]
+        table = pyarrow.Table.from_arrays(arrays, schema=schema)
+        partition['writer'].write_table(table, row_group_size=len(columns[0]))
+        partition['columns'] = [[] for column in columns]
+
+    def _close_partition(self, key):
+        '''Write the remaining rows of a partition and close its file.'''
+        partition = self.partitions.pop(key)
+        self._write_row_group(partition)
+        if partition['writer'] is not None:
+            partition['writer'].close()
+
+    def close(self):
+        '''Write the buffered rows and close all files.'''
+        for key in list(self.partitions):
+            self._close_partition(key)
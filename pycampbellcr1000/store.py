@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.store
+    ----------------------
+
+    Append-only column store of the collected tables, memory-mapped for
+    reading.
+
+    Each table is a directory holding one fixed-width little-endian file per
+    column (derived from the table definition), a `table.json` description
+    and a sparse `index` of the time of every `index_interval`-th row::
+
+        >>> store = ColumnStore('data', device.table_def)
+        >>> for records in device.get_data_generator('Table1'):
+        ...     store.write('Table1', records)
+        >>> store.flush()
+        >>> begin, end = store.rows('Table1', start=datetime(2012, 7, 26))
+        >>> store.column('Table1', 'Batt_Volt_Avg', begin, end)
+
+    Records are only appended in time order, records that are not newer than
+    the last stored one are ignored. The `RecNbr` column is written last and
+    gives the number of committed rows, so readers never see half-written
+    rows.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import os
+import io
+import json
+import mmap
+import struct
+
+from bisect import bisect_right
+
+from .logger import LOGGER
+from .sinks import table_columns
+from .utils import ListDict, Dict, field_name, nsec_to_time, time_to_nsec
+
+
+# struct format of the PakBus data types, times are stored as nanoseconds
+# since 1990-01-01
+STORE_FORMATS = {
+    'Byte': 'B', 'UInt2': 'H', 'UInt4': 'L', 'Int1': 'b', 'Int2': 'h',
+    'Int4': 'l', 'Bool8': 'B', 'Bool': 'B', 'Bool2': 'H', 'Bool4': 'L',
+    'Sec': 'l', 'Short': 'h', 'Long': 'l', 'UShort': 'H', 'ULong': 'L',
+    'FP2': 'f', 'IEEE4B': 'f', 'IEEE4L': 'f', 'IEEE8B': 'd', 'IEEE8L': 'd',
+    'NSec': 'q', 'SecNano': 'q',
+}
+
+TIME_TYPES = ('NSec', 'SecNano')
+
+INDEX_ENTRY = struct.Struct(str('<qQ'))
+
+
+def to_nsec(dtime):
+    '''Convert a datetime to nanoseconds since 1990-01-01.'''
+    sec, nsec = time_to_nsec(dtime)
+    return sec * 1000000000 + nsec
+
+
+def from_nsec(value):
+    '''Convert nanoseconds since 1990-01-01 to an NSec tuple.'''
+    return divmod(value, 1000000000)
+
+
+def pack_values(fmt, values):
+    '''Pack a list of values of the same struct format.'''
+    if fmt.endswith('s'):
+        return struct.pack(str('<' + fmt * len(values)), *values)
+    return struct.pack(str('<%d%s' % (len(values), fmt)), *values)
+
+
+def unpack_values(fmt, buff, offset, count):
+    '''Unpack `count` values of the same struct format.'''
+    if fmt.endswith('s'):
+        fmt = '<' + fmt * count
+    else:
+        fmt = '<%d%s' % (count, fmt)
+    return struct.unpack_from(str(fmt), buff, offset)
+
+
+def store_columns(tabledef):
+    '''Return the list of `(record key, column name, data type, element,
+    struct format)` of a table definition. Fields with a data type that can
+    not be stored with a fixed width are left out.'''
+    columns = []
+    for key, column, type_, element in table_columns(tabledef):
+        if type_ == 'ASCII':
+            dimension = [field['Dimension'] for field in tabledef['Fields']
+                         if field_name(field['FieldName']) == key][0]
+            fmt = '%ds' % dimension
+        elif type_ in STORE_FORMATS:
+            fmt = STORE_FORMATS[type_]
+        else:
+            LOGGER.info('Field %s of type %s is not stored' % (column, type_))
+            continue
+        columns.append((key, column, type_, element, fmt))
+    return columns
+
+
+class ColumnTable(object):
+    '''The files of one table of a `ColumnStore`.'''
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.formats = dict((column[0], column[2])
+                            for column in meta['Columns'])
+        self.types = dict((column[0], column[1])
+                          for column in meta['Columns'])
+        self.maps = {}
+        self.index = []
+        self.index_times = []
+
+    def filename(self, column):
+        return os.path.join(self.path, '%s.col' % column)
+
+    def width(self, column):
+        return struct.calcsize(str('<' + self.formats[column]))
+
+    def count(self):
+        '''Return the number of committed rows.'''
+        try:
+            size = os.path.getsize(self.filename('RecNbr'))
+        except OSError:
+            return 0
+        return size // self.width('RecNbr')
+
+    def map(self, column):
+        '''Return the memory map of `column`, mapped again if the file grew.
+        '''
+        size = os.path.getsize(self.filename(column))
+        if column in self.maps and self.maps[column][0] == size:
+            return self.maps[column][1]
+        self.unmap(column)
+        if size == 0:
+            return b''
+        with open(self.filename(column), 'rb') as file_input:
+            buff = mmap.mmap(file_input.fileno(), 0,
+                             access=mmap.ACCESS_READ)
+        self.maps[column] = (size, buff)
+        return buff
+
+    def unmap(self, column):
+        if column in self.maps:
+            self.maps.pop(column)[1].close()
+
+    def load_index(self):
+        '''Return the sparse index as a list of `(time, row)`.'''
+        filename = os.path.join(self.path, 'index')
+        if not os.path.exists(filename):
+            return []
+        with open(filename, 'rb') as file_input:
+            raw = file_input.read()
+        count = len(raw) // INDEX_ENTRY.size
+        if count != len(self.index):
+            self.index = [INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size)
+                          for i in range(count)]
+            self.index_times = [entry[0] for entry in self.index]
+        return self.index
+
+    def search(self, value, count):
+        '''Return the first row whose time is greater than `value`.'''
+        index = self.load_index()
+        # the sparse index gives the block of `value`
+        i = bisect_right(self.index_times, value)
+        low = index[i - 1][1] if i > 0 else 0
+        high = min(index[i][1] if i < len(index) else count, count)
+        # then a binary search inside the block
+        buff = self.map('Datetime')
+        while low < high:
+            middle = (low + high) // 2
+            (time_,) = unpack_values('q', buff, middle * 8, 1)
+            if time_ > value:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def close(self):
+        for column in list(self.maps):
+            self.unmap(column)
+
+
+class ColumnStore(object):
+    '''Store the records in fixed-width column files, one directory for each
+    table of the datalogger.
+
+    :param root: The root directory of the store.
+    :param tabledef: The table definition of the datalogger
+                     (`CR1000.table_def`), only required to write.
+    :param batch_size: Number of rows buffered before writing.
+    :param index_interval: Number of rows between two sparse index entries.
+    '''
+
+    def __init__(self, root, tabledef=None, batch_size=10000,
+                 index_interval=4096):
+        self.root = root
+        self.tabledef = dict((field_name(item['Header']['TableName']), item)
+                             for item in tabledef or [])
+        self.batch_size = batch_size
+        self.index_interval = index_interval
+        self.tables = {}
+        self.writers = {}
+
+    def _get_table(self, tablename):
+        '''Return the `ColumnTable` of `tablename`.'''
+        tablename = field_name(tablename)
+        if tablename not in self.tables:
+            path = os.path.join(self.root, tablename)
+            filename = os.path.join(path, 'table.json')
+            if not os.path.exists(filename):
+                raise ValueError('table %s not found' % tablename)
+            with io.open(filename, encoding='utf-8') as file_input:
+                meta = json.load(file_input)
+            self.tables[tablename] = ColumnTable(path, meta)
+        return self.tables[tablename]
+
+    def _create_table(self, tablename):
+        '''Create the directory of `tablename` if needed and return its
+        writer state.'''
+        tabledef = self.tabledef[tablename]
+        path = os.path.join(self.root, tablename)
+        filename = os.path.join(path, 'table.json')
+        if os.path.exists(filename):
+            with io.open(filename, encoding='utf-8') as file_input:
+                signature = json.load(file_input)['Signature']
+            if signature != tabledef['Signature']:
+                # the table definition changed: keep the old records aside
+                LOGGER.info('Table definition of %s changed' % tablename)
+                self._get_table(tablename).close()
+                self.tables.pop(tablename)
+                os.rename(path, '%s_%s' % (path, signature))
+        columns = store_columns(tabledef)
+        if not os.path.exists(filename):
+            if not os.path.exists(path):
+                os.makedirs(path)
+            meta = {'Table': tablename, 'Signature': tabledef['Signature'],
+                    'IndexInterval': self.index_interval,
+                    'Columns': [['Datetime', 'NSec', 'q', 'Datetime', None],
+                                ['RecNbr', 'UInt4', 'L', 'RecNbr', None]] +
+                               [[column, type_, fmt, key, element]
+                                for key, column, type_, element, fmt
+                                in columns]}
+            with io.open(filename, 'w', encoding='utf-8') as file_output:
+                file_output.write('%s' % json.dumps(meta))
+        table = self._get_table(tablename)
+        count = table.count()
+        # drop the rows of an interrupted write
+        for column in table.formats:
+            size = count * table.width(column)
+            with open(table.filename(column), 'ab') as file_output:
+                if file_output.tell() > size:
+                    file_output.truncate(size)
+        last = self.last_record(tablename)
+        return {'columns': columns, 'pending': [], 'count': count,
+                'last': last}
+
+    def write(self, tablename, records):
+        '''Append `records` of `tablename` to the store.'''
+        tablename = field_name(tablename)
+        if tablename not in self.writers:
+            self.writers[tablename] = self._create_table(tablename)
+        writer = self.writers[tablename]
+        pending = writer['pending']
+        last = writer['last']
+        for record in records:
+            if last is not None:
+                dtime, recnbr = last
+                if (record['Datetime'] < dtime or
+                        (record['Datetime'] == dtime and
+                         record['RecNbr'] <= recnbr)):
+                    continue
+            last = (record['Datetime'], record['RecNbr'])
+            pending.append(record)
+        writer['last'] = last
+        if len(pending) >= self.batch_size:
+            self.flush(tablename)
+
+    def flush(self, tablename=None):
+        '''Write the pending records of `tablename` (by default all tables).
+        '''
+        if tablename is None:
+            tablenames = list(self.writers)
+        else:
+            tablenames = [field_name(tablename)]
+        for name in tablenames:
+            writer = self.writers.get(name)
+            if not writer or not writer['pending']:
+                continue
+            table = self._get_table(name)
+            records = writer['pending']
+            times = [to_nsec(record['Datetime']) for record in records]
+            for key, column, type_, element, fmt in writer['columns']:
+                values = [record[key] for record in records]
+                if element is not None:
+                    values = [value[element] for value in values]
+                if type_ in TIME_TYPES:
+                    values = [value[0] * 1000000000 + value[1]
+                              for value in values]
+                self._append(table, column, pack_values(fmt, values))
+            self._append(table, 'Datetime', pack_values('q', times))
+            # RecNbr is written last: it commits the rows
+            self._append(table, 'RecNbr',
+                         pack_values('L', [record['RecNbr']
+                                           for record in records]))
+            self._append_index(table, writer['count'], times)
+            writer['count'] += len(records)
+            writer['pending'] = []
+
+    def _append(self, table, column, data):
+        with open(table.filename(column), 'ab') as file_output:
+            file_output.write(data)
+
+    def _append_index(self, table, count, times):
+        '''Add the sparse index entries of the rows appended after row
+        `count`.'''
+        interval = table.meta['IndexInterval']
+        first = -(-count // interval) * interval
+        entries = [INDEX_ENTRY.pack(times[row - count], row)
+                   for row in range(first, count + len(times), interval)]
+        if entries:
+            with open(os.path.join(table.path, 'index'), 'ab') as file_output:
+                file_output.write(b''.join(entries))
+
+    def last_record(self, tablename):
+        '''Return the `(Datetime, RecNbr)` of the last stored record of
+        `tablename`, or None.'''
+        try:
+            table = self._get_table(tablename)
+        except ValueError:
+            return None
+        count = table.count()
+        if not count:
+            return None
+        (time_,) = unpack_values('q', table.map('Datetime'), (count - 1) * 8,
+                                 1)
+        (recnbr,) = unpack_values('L', table.map('RecNbr'), (count - 1) * 4,
+                                  1)
+        return nsec_to_time(from_nsec(time_)), recnbr
+
+    def rows(self, tablename, start=None, stop=None):
+        '''Return the `(begin, end)` range of the rows of `tablename` from
+        `start` to `stop` (both included).'''
+        table = self._get_table(tablename)
+        count = table.count()
+        begin, end = 0, count
+        if count and start is not None:
+            begin = table.search(to_nsec(start) - 1, count)
+        if count and stop is not None:
+            end = table.search(to_nsec(stop), count)
+        return begin, max(begin, end)
+
+    def column(self, tablename, column, begin=0, end=None):
+        '''Return the values of `column` from row `begin` to `end`, read from
+        the memory-mapped file. Times are nanoseconds since 1990-01-01.'''
+        table = self._get_table(tablename)
+        if end is None:
+            end = table.count()
+        if end <= begin:
+            return ()
+        width = table.width(column)
+        return unpack_values(table.formats[column], table.map(column),
+                             begin * width, end - begin)
+
+    def read(self, tablename, start=None, stop=None):
+        '''Return the records of `tablename` from `start` to `stop` as
+        ListDict.'''
+        table = self._get_table(tablename)
+        begin, end = self.rows(tablename, start, stop)
+        columns = table.meta['Columns']
+        values = [self.column(tablename, column[0], begin, end)
+                  for column in columns]
+        records = ListDict()
+        for row in zip(*values):
+            record = Dict()
+            for (column, type_, fmt, key, element), value in zip(columns, row):
+                if column == 'Datetime':
+                    value = nsec_to_time(from_nsec(value))
+                elif type_ in TIME_TYPES:
+                    value = from_nsec(value)
+                if element is None:
+                    record[key] = value
+                else:
+                    # element of an array field
+                    record.setdefault(key, []).append(value)
+            records.append(record)
+        return records
+
+    def close(self):
+        '''Write the pending records and unmap the files.'''
+        self.flush()
+        for table in self.tables.values():
+            table.close()
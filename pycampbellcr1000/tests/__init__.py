@@ -13,6 +13,8 @@ import pytest
 
 from contextlib import contextmanager
 
+from ..pakbus import Transaction
+
 
 @contextmanager
 def assert_raises(exception_class, message_part):
@@ -23,3 +25,16 @@ def assert_raises(exception_class, message_part):
         yield
     message = '%s' % exception
     assert message_part.lower() in message.lower()
+
+
+def restore_transaction():
+    """
+    Make an autouse fixture restoring the transaction number after each
+    test, the command tests expect the transaction numbers from 1.
+    """
+    @pytest.fixture(autouse=True)
+    def transaction():
+        id_ = Transaction().id
+        yield
+        Transaction().id = id_
+    return transaction
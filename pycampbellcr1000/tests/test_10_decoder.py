@@ -0,0 +1,40 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_decoder
+    --------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import pickle
+from datetime import datetime
+
+from ..decoder import PageDecoder, table_layout, row_to_record
+from ..pakbus import PakBus
+from ..utils import record_type
+from .test_6_archive import make_tdf, make_recdata
+
+
+def test_page_decoder():
+    tabledef = PakBus.parse_tabledef(make_tdf())
+    layout = table_layout(tabledef, 1)
+    assert pickle.loads(pickle.dumps(layout)) == layout
+    pages = [make_recdata(10, [20.0, 21.0], True),
+             make_recdata(12, [22.0]),
+             make_recdata(13, [23.0, 24.0, 25.0])]
+    serial = list(PageDecoder(layout).map(iter(pages)))
+    assert [len(rows) for rows in serial] == [2, 1, 3]
+    assert serial[1] == [(datetime(2012, 7, 26, 8, 40), 12, 22.0)]
+    # the pages are decoded by the processes in page order
+    assert list(PageDecoder(layout, 2).map(iter(pages))) == serial
+
+    row = serial[0][1]
+    record = row_to_record(row, ['Datetime', 'RecNbr', 'Temp'])
+    assert record == {'Datetime': datetime(2012, 7, 26, 8, 41),
+                      'RecNbr': 11, 'Temp': 21.0}
+    cls = record_type(['Datetime', 'RecNbr', 'Temp'], [b'Temp'])
+    record = row_to_record(row, None, cls, timestamps=True)
+    assert record['Datetime'] == 1343292060
+    assert record['Temp'] == 21.0
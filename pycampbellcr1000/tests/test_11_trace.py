@@ -0,0 +1,42 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_trace
+    ------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+
+from ..pakbus import PakBus
+from ..trace import FrameCapture, read_capture
+from ..utils import hex_to_bytes, HexBytes
+from .test_1_pakbus import BufferLink
+
+
+def test_frame_capture(tmpdir):
+    filename = str(tmpdir.join('station.pcap'))
+    # the logger (node 0x001) answers to us (node 0x802)
+    logger = PakBus(BufferLink(), dest=0x802, src=0x001)
+    logger.write(logger.pack_header(0x1) + hex_to_bytes('9A 05 10'))
+    pakbus = PakBus(BufferLink(logger.link.written[6:]))
+    pakbus.capture = FrameCapture(filename)
+    pakbus.write(pakbus.pack_header(0x1) + hex_to_bytes('1A 05'))
+    hdr, msg = pakbus.wait_packet(5)
+    assert msg['RespCode'] == 16
+    pakbus.capture.close()
+
+    # appended to the same file
+    capture = FrameCapture(filename)
+    capture.write(FrameCapture.IN, b'\x00')
+    capture.close()
+
+    frames = list(read_capture(filename))
+    assert [frame.direction for frame in frames] == [b'>', b'<', b'<']
+    assert frames[0].header['DstNodeId'] == 0x001
+    assert frames[1].header['SrcNodeId'] == 0x001
+    # signature nullifier included
+    assert frames[1].packet[8:-2] == hex_to_bytes('9A 05 10')
+    assert frames[2].header == {}
+    assert '%s' % HexBytes(frames[0].packet[8:10]) == '1A 05'
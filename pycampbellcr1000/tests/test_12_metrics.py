@@ -0,0 +1,58 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_metrics
+    --------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import io
+
+from ..metrics import Metrics
+from ..pakbus import PakBus
+from ..utils import hex_to_bytes
+from .test_1_pakbus import BufferLink
+
+
+def test_metrics():
+    metrics = Metrics()
+    metrics.inc('timeouts_total')
+    metrics.inc('bytes_sent_total', 10, stage='packet')
+    metrics.inc('bytes_sent_total', 12, stage='wire')
+    metrics.observe('rtt_seconds', 0.2, msgtype='0x09')
+    metrics.observe('rtt_seconds', 3, msgtype='0x09')
+    assert metrics.get('bytes_sent_total') == 22
+    assert metrics.get('bytes_sent_total', stage='wire') == 12
+
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['timeouts_total'] == {'': 1}
+    rtt = snapshot['histograms']['rtt_seconds']['{msgtype="0x09"}']
+    assert rtt['count'] == 2
+    assert dict(rtt['buckets'])[0.25] == 1
+
+    output = io.StringIO()
+    metrics.write_prometheus(output)
+    lines = output.getvalue().splitlines()
+    assert '# TYPE pycr1000_bytes_sent_total counter' in lines
+    assert 'pycr1000_bytes_sent_total{stage="wire"} 12' in lines
+    assert 'pycr1000_timeouts_total 1' in lines
+    assert '# TYPE pycr1000_rtt_seconds histogram' in lines
+    assert 'pycr1000_rtt_seconds_bucket{msgtype="0x09",le="5"} 2' in lines
+    assert 'pycr1000_rtt_seconds_bucket{msgtype="0x09",le="+Inf"} 2' in lines
+    assert 'pycr1000_rtt_seconds_count{msgtype="0x09"} 2' in lines
+
+
+def test_pakbus_metrics():
+    logger = PakBus(BufferLink(), dest=0x802, src=0x001)
+    logger.write(logger.pack_header(0x1) + hex_to_bytes('A1 05 1A 00 01'))
+    logger.write(logger.pack_header(0x1) + hex_to_bytes('9A 05 BD'))
+    assert logger.metrics.get('bytes_sent_total', stage='packet') == 28
+    # quoted 0xBD and frame characters
+    assert logger.metrics.get('bytes_sent_total', stage='wire') == 33
+    pakbus = PakBus(BufferLink(logger.link.written[6:]))
+    pakbus.wait_packet(5)
+    assert pakbus.metrics.get('please_waits_total') == 1
+    assert pakbus.metrics.get('bytes_received_total', stage='packet') == 28
+    assert pakbus.metrics.get('bytes_received_total', stage='wire') == 33
@@ -0,0 +1,63 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_hooks
+    ------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+
+import pytest
+
+from ..decoder import PageDecoder, table_layout
+from ..hooks import Hooks
+from ..pakbus import PakBus
+from ..utils import hex_to_bytes
+from .test_1_pakbus import BufferLink
+from .test_6_archive import make_tdf, make_recdata
+
+
+def test_hooks():
+    events = []
+
+    def callback(event, info):
+        events.append((event, info))
+
+    def failing(event, info):
+        raise RuntimeError()
+
+    hooks = Hooks()
+    assert not hooks.active
+    with pytest.raises(ValueError):
+        hooks.register('unknown', callback)
+    hooks.register('page_parsed', failing)
+    hooks.register('page_parsed', callback)
+    assert hooks.active
+    tabledef = PakBus.parse_tabledef(make_tdf())
+    decoder = PageDecoder(table_layout(tabledef, 1), hooks=hooks)
+    list(decoder.map([make_recdata(10, [20.0, 21.0])]))
+    # the failing callback does not stop the others
+    assert [event for event, info in events] == ['page_parsed']
+    assert events[0][1]['records'] == 2
+    hooks.unregister('page_parsed', failing)
+    hooks.unregister('page_parsed', callback)
+    assert not hooks.active
+
+
+def test_pakbus_hooks():
+    events = []
+    logger = PakBus(BufferLink(), dest=0x802, src=0x001)
+    logger.write(logger.pack_header(0x1) + hex_to_bytes('9A 05 10'))
+    pakbus = PakBus(BufferLink(logger.link.written[6:]))
+    for event in ('frame_written', 'frame_received', 'packet_decoded'):
+        pakbus.hooks.register(event, lambda event, info:
+                              events.append((event, info)))
+    pakbus.write(pakbus.pack_header(0x1) + hex_to_bytes('1A 05'))
+    pakbus.wait_packet(5)
+    assert [event for event, info in events] == \
+        ['frame_written', 'frame_received', 'packet_decoded']
+    assert events[0][1]['size'] == 12
+    assert events[1][1]['valid']
+    assert events[2][1]['msg']['RespCode'] == 16
@@ -0,0 +1,250 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_simulator
+    ----------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import time
+import struct
+from datetime import datetime
+
+import pytest
+
+from ..device import CR1000
+from ..pakbus import PakBus
+from ..exceptions import BadDataException, NoDeviceException
+from ..simulator import Simulator, SimulatorServer, SimTable, encode_fp2
+from ..timeindex import TimeIndex
+from ..trace import FrameCapture, read_capture
+from . import restore_transaction
+
+
+def make_tables():
+    return [SimTable('Table1', [('Batt_Volt', 'FP2'), ('Temp', 'IEEE4B'),
+                                ('Count', 'UInt4')], records=500, size=400),
+            SimTable('Events', [('Level', 'Int2'), ('Raw', 'IEEE4B', 4)],
+                     records=100, interval=600, event=True),
+            SimTable('Spectrum', [('Amp', 'IEEE4B', 300)], records=5)]
+
+
+transaction = restore_transaction()
+
+
+@pytest.fixture
+def simulator():
+    simulator = Simulator(make_tables())
+    yield simulator
+    simulator.stop()
+
+
+@pytest.fixture
+def device(simulator):
+    device = CR1000(simulator.connect(0.2))
+    yield device
+    device.bye()
+
+
+def check(table, records):
+    for record in records:
+        expected = table.record(record['RecNbr'])
+        assert record['Datetime'] == expected['Datetime']
+        for name, type_, dimension in table.fields:
+            value = record[name]
+            if dimension > 1:
+                value = list(value)
+            assert value == expected[name]
+
+
+def test_encode_fp2():
+    for value in (0.0, 1.5, -24.75, 81.91, 819.1, 7000.0):
+        raw = struct.pack(str('>H'), encode_fp2(value))
+        assert PakBus.decode_bin(['FP2'], raw)[0][0] == value
+
+
+def test_table_definition(simulator):
+    tabledef = PakBus.parse_tabledef(simulator.table_def_raw())
+    assert [item['Header']['TableName'] for item in tabledef] == \
+        [b'Table1', b'Events', b'Spectrum']
+    assert tabledef[0]['Header']['TableSize'] == 400
+    assert tabledef[1]['Header']['TblInterval'] == (0, 0)
+    for item, table in zip(tabledef, simulator.tables):
+        assert item['Signature'] == table.signature
+        assert [(field['FieldName'].decode('utf-8'), field['FieldType'],
+                 field['Dimension']) for field in item['Fields']] == \
+            table.fields
+
+
+def test_commands(simulator, device):
+    assert device.list_tables() == [b'Table1', b'Events', b'Spectrum']
+    assert device.list_files() == [b'CPU:simulator.cr1']
+    assert device.getfile('CPU:simulator.cr1') == \
+        simulator.files['CPU:simulator.cr1']
+    assert device.getfile('CPU:missing.cr1') == b''
+    assert device.settings[0]['SettingValue'] == b'CR1000.Std.32'
+    assert device.getprogstat()['ProgName'] == b'CPU:simulator.cr1'
+    assert abs(device.gettime() - datetime.utcnow()).total_seconds() < 2
+    device.settime(datetime(2020, 1, 1, 12))
+    assert abs(device.gettime() - datetime(2020, 1, 1, 12)).total_seconds() \
+        < 2
+
+
+def test_get_data(simulator, device):
+    table = simulator.find('Table1')
+    data = device.get_data('Table1')
+    # the 100 oldest records were overwritten
+    assert [record['RecNbr'] for record in data] == list(range(100, 500))
+    check(table, data)
+    # the end of the time range is excluded
+    start, stop = table.time(200), table.time(250)
+    data = device.get_data('Table1', start, stop)
+    assert [record['RecNbr'] for record in data] == list(range(200, 250))
+    data = device.get_data('Table1', start, stop, prefetch=2)
+    assert [record['RecNbr'] for record in data] == list(range(200, 250))
+    latest = device.get_latest('Table1', 3)
+    assert [record['RecNbr'] for record in latest] == [497, 498, 499]
+    check(table, latest)
+    ranges = list(device.get_data_ranges('Table1', [(150, 160), (300, 305)]))
+    assert [record['RecNbr'] for records in ranges for record in records] \
+        == list(range(150, 160)) + list(range(300, 305))
+
+    table.add(10)
+    results = device.get_data_multi({'Table1': 500, 'Events': None})
+    assert [record['RecNbr'] for record in results['Table1']] == \
+        list(range(500, 510))
+    assert [record['RecNbr'] for record in results['Events']] == [99]
+
+
+def test_get_data_pages(simulator, device):
+    # a time range of several pages, the next ones collected by mode 4
+    table = simulator.find('Table1')
+    start, stop = table.time(150), table.time(400)
+    pages = device.metrics.get('pages_decoded_total')
+    serial = device.get_data('Table1', start, stop)
+    assert device.metrics.get('pages_decoded_total') - pages > 2
+    assert [record['RecNbr'] for record in serial] == list(range(150, 400))
+    data = device.get_data('Table1', start, stop, prefetch=2)
+    assert [record['RecNbr'] for record in data] == list(range(150, 400))
+    check(table, data)
+
+
+def test_get_data_workers(simulator, device):
+    # the pages decoded by a process pool give the serial records
+    table = simulator.find('Table1')
+    for start, stop in ((150, 400), (300, 301), (450, 500)):
+        start, stop = table.time(start), table.time(stop)
+        serial = device.get_data('Table1', start, stop)
+        data = device.get_data('Table1', start, stop, workers=2)
+        assert [record['RecNbr'] for record in data] == \
+            [record['RecNbr'] for record in serial]
+        assert [record['Datetime'] for record in data] == \
+            [record['Datetime'] for record in serial]
+    check(table, data)
+
+
+def test_get_data_indexed(simulator, device, tmpdir):
+    # the index only knows the first records, the range ends at the newest
+    table = simulator.find('Table1')
+    device.time_index = TimeIndex(str(tmpdir.join('Table1.tix')))
+    device.get_data('Table1', table.time(100), table.time(160))
+    start, stop = table.time(300), table.time(400)
+    pages = device.metrics.get('pages_decoded_total')
+    data = device.get_data('Table1', start, stop)
+    assert device.metrics.get('pages_decoded_total') - pages == 3
+    assert [record['RecNbr'] for record in data] == list(range(300, 400))
+    check(table, data)
+
+
+def test_event_table(simulator, device):
+    table = simulator.find('Events')
+    data = device.get_data('Events')
+    assert len(data) == 100
+    check(table, data)
+    data = device.get_data('Events', table.time(10), table.time(20))
+    assert [record['RecNbr'] for record in data] == list(range(10, 20))
+
+
+def test_reassembly(simulator, device):
+    # 1208 bytes records are sent in several fragments
+    table = simulator.find('Spectrum')
+    data = device.get_data('Spectrum')
+    assert [record['RecNbr'] for record in data] == list(range(5))
+    check(table, data)
+
+
+def test_reassembly_incomplete(simulator, device, monkeypatch):
+    # the record is overwritten while its fragments are collected
+    first_fragment = simulator.partial
+
+    def partial(tablenbr, table, recnbr, byteoffset, budget):
+        if byteoffset == 0:
+            return first_fragment(tablenbr, table, recnbr, byteoffset, budget)
+        return struct.pack(str('>HLH'), tablenbr, recnbr, 0), False
+    monkeypatch.setattr(simulator, 'partial', partial)
+    with pytest.raises(BadDataException):
+        device.get_data('Spectrum')
+
+
+def test_retransmission(device):
+    link = device.pakbus.link
+    # the simulator does not answer to another node
+    device.pakbus.dest = 0x002
+    cmd = device.pakbus.get_setvalues_cmd('Public', 'IEEE4B', 'Temp', [1.0])
+    timeouts = device.metrics.get('timeouts_total')
+    assert device.send_wait(cmd)[1] == {}
+    # a command with side effect is not sent again
+    assert device.metrics.get('timeouts_total') == timeouts + 1
+    # the link timeout is only changed during the transaction
+    assert link.timeout == 0.2
+    assert device.send_wait(cmd, retries=1)[1] == {}
+    assert device.metrics.get('timeouts_total') == timeouts + 3
+
+
+def test_capture_hello(simulator, tmpdir):
+    filename = str(tmpdir.join('station.pcap'))
+    capture = FrameCapture(filename, flush_interval=60)
+    device = CR1000(simulator.connect(0.2), capture=capture)
+    device.bye()
+    capture.close()
+    frames = list(read_capture(filename))
+    # the hello command and its response come first
+    assert [(frame.direction, frame.packet[8:9]) for frame in frames[:2]] \
+        == [(b'>', b'\x09'), (b'<', b'\x89')]
+
+
+def test_no_device(simulator):
+    begin = time.time()
+    # no datalogger with this node ID: one hello per connection attempt
+    with pytest.raises(NoDeviceException):
+        CR1000(simulator.connect(0.05), dest=0x002)
+    assert time.time() - begin < 5
+
+
+def test_please_wait():
+    simulator = Simulator(make_tables(), please_wait=0.3, latency=0.05)
+    try:
+        device = CR1000(simulator.connect(0.2))
+        begin = time.time()
+        data = device.get_latest('Table1', 2)
+        assert time.time() - begin >= 0.3
+        assert [record['RecNbr'] for record in data] == [498, 499]
+        assert device.metrics.get('please_waits_total') == 1
+        assert device.metrics.get('timeouts_total') == 0
+        device.bye()
+    finally:
+        simulator.stop()
+
+
+def test_server():
+    server = SimulatorServer(Simulator(make_tables()))
+    server.serve_background()
+    try:
+        device = CR1000.from_url(server.url, timeout=0.2)
+        data = device.get_latest('Table1', 1)
+        assert data[0]['RecNbr'] == 499
+        device.bye()
+    finally:
+        server.shutdown()
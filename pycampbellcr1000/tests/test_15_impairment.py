@@ -0,0 +1,85 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_impairment
+    -----------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import time
+import socket
+from functools import partial
+
+from ..device import CR1000
+from ..impairment import ImpairedLink, benchmark
+from ..simulator import Simulator, SimTable, SocketLink
+from . import restore_transaction
+from .test_1_pakbus import FakeLink
+from .test_14_simulator import check
+
+
+transaction = restore_transaction()
+
+
+def test_impair():
+    link = ImpairedLink(FakeLink(), loss=1)
+    assert link.impair(b'\xBD\x01\x02\xBD', link.write_random) is None
+    # flags alone are never lost
+    assert link.impair(b'\xBD', link.write_random) == b'\xBD'
+    link = ImpairedLink(FakeLink(), corruption=1, seed=1)
+    data = link.impair(b'\x00' * 10, link.write_random)
+    assert len(data) == 10 and b'\x00' not in data
+    assert link.corrupted == 10
+    # one generator per direction: the reads do not change the writes
+    first = ImpairedLink(FakeLink(), jitter=1, seed=1)
+    second = ImpairedLink(FakeLink(), jitter=1, seed=1)
+    second.delay(second.read_random)
+    assert first.delay(first.write_random) == \
+        second.delay(second.write_random)
+
+
+def test_impaired_link():
+    left, right = socket.socketpair()
+    peer = SocketLink(right, 0.1)
+    # 100 bytes take 0.1 sec at 10000 bauds
+    link = ImpairedLink(SocketLink(left, 0.1), latency=0.05, baudrate=10000)
+    link.open()
+    try:
+        begin = time.time()
+        link.write(b'\xBD' + b'\x01' * 98 + b'\xBD')
+        # the writer is not delayed, the frame is
+        assert time.time() - begin < 0.05
+        assert peer.read(1) == b''
+        assert len(peer.read(100, timeout=1)) == 100
+        assert time.time() - begin >= 0.15
+
+        peer.write(b'\xBD\x02\x03\xBD')
+        assert link.read(1, timeout=0.01) == b''
+        assert link.read(1, timeout=1) == b'\xBD'
+        assert link.read(timeout=1) == b'\x02\x03\xBD'
+    finally:
+        link.close()
+        peer.close()
+
+
+def test_benchmark(monkeypatch):
+    monkeypatch.setattr(CR1000, 'retries', 10)
+    simulator = Simulator([SimTable('Table1', [('Temp', 'IEEE4B'),
+                                               ('Count', 'UInt4')],
+                                    records=200)])
+    link = ImpairedLink(simulator.connect(0.5), latency=0.01, loss=0.1,
+                        corruption=0.0002, seed=1)
+    try:
+        device = CR1000(link)
+        results = benchmark(device, 'Table1',
+                            check=partial(check, simulator.find('Table1')))
+        # the lost frames were sent again
+        assert link.lost
+        assert results['timeouts']
+        assert results['records'] == 200
+        assert results['file_bytes'] == len(simulator.table_def_raw())
+        device.bye()
+    finally:
+        simulator.stop()
@@ -8,9 +8,15 @@
 
 '''
 from __future__ import unicode_literals
+import json
+import time
+import struct
 import datetime
 
-from ..pakbus import PakBus
+import pytest
+
+from .. import pakbus as pakbus_module
+from ..pakbus import PakBus, RecordBuffer, RTTEstimator
 from ..utils import hex_to_bytes, bytes_to_hex
 from .ressources import TABLEDEF
 
@@ -154,6 +160,52 @@ def test_parse_tabledef():
     assert tabledef[0]['Signature'] == 14472
 
 
+def test_parse_tabledef_lazy():
+    tabledef = PakBus.parse_tabledef(hex_to_bytes(TABLEDEF))
+    assert [item['Header']['TableName'] for item in tabledef] == \
+        [b'Status', b'Table1', b'Public']
+    # field definitions are decoded on first use
+    assert not dict.__contains__(tabledef[1], 'Fields')
+    tablenbr, item = tabledef.find('Table1')
+    assert tablenbr == 2
+    assert item['Signature'] == 40615
+    assert len(item['Fields']) == 10
+    assert dict.__contains__(tabledef[1], 'Fields')
+    assert not dict.__contains__(tabledef[0], 'Fields')
+
+
+def test_tabledef_mapping():
+    raw = hex_to_bytes(TABLEDEF)
+    # the lazy keys are seen before they are decoded
+    item = PakBus.parse_tabledef(raw)[1]
+    assert 'Fields' in item and 'Signature' in item
+    assert item.get('Signature') == 40615
+    assert item.get('Missing') is None
+    item = PakBus.parse_tabledef(raw)[1]
+    assert sorted(item.keys()) == ['Fields', 'Header', 'Signature']
+    item = PakBus.parse_tabledef(raw)[1]
+    assert sorted(key for key, value in item.items()) == \
+        ['Fields', 'Header', 'Signature']
+    item = PakBus.parse_tabledef(raw)[1]
+    copy = dict(item)
+    assert len(copy) == 3 and len(copy['Fields']) == 10
+    assert PakBus.parse_tabledef(raw)[1] == copy
+    item = PakBus.parse_tabledef(raw)[1]
+    assert json.loads(json.dumps(item, default=repr))['Signature'] == 40615
+
+
+def test_parse_tabledef_truncated():
+    raw = hex_to_bytes(TABLEDEF)
+    item = PakBus.parse_tabledef(raw)[0]
+    # cut in the sub dimensions of the last field of the first table
+    end = len(item.raw) - 5
+    with pytest.raises(ValueError):
+        PakBus.skip_fielddef(raw[:end], 1 + item.fields_offset)
+    for size in (end, len(item.raw) - 1, len(item.raw) // 2):
+        with pytest.raises(ValueError):
+            PakBus.parse_tabledef(raw[:size])
+
+
 def test_parse_collectdata():
     pakbus = PakBus(FakeLink())
     tabledef = pakbus.parse_tabledef(hex_to_bytes(TABLEDEF))
@@ -342,3 +394,189 @@ def test_fileupload_response():
     assert filedata['files'][0]['Attribute'] == []
     assert filedata['files'][0]['FileSize'] == 1
     assert filedata['files'][0]['FileName'] == b'Status'
+
+
+def test_get_multi_collectdata_cmd():
+    pakbus = PakBus(FakeLink())
+    tables = [(1, 14472, 10, 0), (2, 40615, 20, 0)]
+    cmd = pakbus.get_multi_collectdata_cmd(0x04, tables)[0]
+    # after the header, message type and transaction number
+    cmd = bytes_to_hex(cmd[10:])
+    assert cmd == '00 00 04 00 01 38 88 00 00 00 0A 00 00 00 02 9E A7 00 00'\
+                  ' 00 14 00 00'
+
+
+def test_getvalues():
+    pakbus = PakBus(FakeLink())
+    cmd = pakbus.get_getvalues_cmd('Public', 'IEEE4B', 'Temp(2)', 2)[0]
+    cmd = bytes_to_hex(cmd[10:])
+    assert cmd == '00 00 50 75 62 6C 69 63 00 09 54 65 6D 70 28 32 29 00 00'\
+                  ' 02'
+    packet = pakbus.pack_header(0x1) + hex_to_bytes('9A 05 00 41 A4 00 00'
+                                                    ' 41 A8 00 00')
+    hdr, msg = pakbus.decode_packet(packet)
+    assert msg['RespCode'] == 0
+    assert pakbus.decode_bin(2 * ['IEEE4B'], msg['Values'])[0] == \
+        [20.5, 21.0]
+
+
+def test_setvalues():
+    pakbus = PakBus(FakeLink())
+    cmd = pakbus.get_setvalues_cmd('Public', 'IEEE4B', 'Flag', [1.0])[0]
+    cmd = bytes_to_hex(cmd[8:])
+    assert cmd.startswith('1B')
+    assert cmd.endswith('50 75 62 6C 69 63 00 09 46 6C 61 67 00 00 01 3F'
+                        ' 80 00 00')
+    packet = pakbus.pack_header(0x1) + hex_to_bytes('9B 05 10')
+    hdr, msg = pakbus.decode_packet(packet)
+    assert msg['RespCode'] == 16
+
+
+def test_record_buffer():
+    tabledef = PakBus.parse_tabledef(hex_to_bytes(
+        '01 54 61 62 6C 65 31 00 00 00 03 E8 0E 00 00 00 00 00 00 00 00 00'
+        ' 00 00 3C 00 00 00 00 89 54 65 6D 70 00 00 53 6D 70 00 64 65 67 43'
+        ' 00 00 00 00 00 01 00 00 00 02 00 00 00 00 00'))
+    size = PakBus.record_size(tabledef[0])
+    assert size == 16
+    record = RecordBuffer(1, 10, size)
+    # TableNbr, BegRecNbr, IsOffset and ByteOffset, fragment, MoreRecsExist
+    assert record.add(hex_to_bytes('00 01 00 00 00 0A 80 00 00 00'
+                                   ' 2A 72 64 E0 00 00 00 00 41 A0 01'))
+    assert not record.complete
+    # not the next bytes
+    assert not record.add(hex_to_bytes('00 01 00 00 00 0A 80 00 00 0E'
+                                       ' 00 00 01'))
+    assert record.add(hex_to_bytes('00 01 00 00 00 0A 80 00 00 0A'
+                                   ' 00 00 41 A8 00 00 00'))
+    assert record.complete
+    data, more = PakBus.parse_collectdata(record.to_recdata(), tabledef)
+    # the flag of the last fragment
+    assert not more
+    assert data[0]['NbrOfRecs'] == 1
+    item = data[0]['RecFrag'][0]
+    assert item['RecNbr'] == 10
+    assert item['TimeOfRec'] == datetime.datetime(2012, 7, 26, 8, 40)
+    assert item['Fields'][b'Temp'] == [20.0, 21.0]
+
+
+def make_array_recdata():
+    '''Build the table definition of a table with a `Temp(2,2)` FP2 field
+    and the record data of one record.'''
+    tdf = b'\x01' + b'Table1\0' + struct.pack('>LB', 1000, 14)
+    tdf += struct.pack('>4l', 0, 0, 60, 0)
+    tdf += b'\x07' + b'Temp\0' + b'\0' + b'Smp\0' + b'degC\0' + b'\0'
+    tdf += struct.pack('>5L', 1, 4, 2, 2, 0) + b'\0'
+    recdata = struct.pack('>HLH2l', 1, 10, 1, 712140000, 0)
+    recdata += struct.pack('>4H', 0x200F, 0xC000 | 225, 3, 0x2005)
+    return PakBus.parse_tabledef(tdf), recdata + b'\0'
+
+
+def test_parse_collectdata_arrays(monkeypatch):
+    tabledef, recdata = make_array_recdata()
+    # plain lists without NumPy
+    monkeypatch.setattr(pakbus_module, 'numpy', None)
+    data, more = PakBus.parse_collectdata(recdata, tabledef, arrays=True)
+    assert data[0]['RecFrag'][0]['Fields'][b'Temp'] == [1.5, -2.25, 3.0,
+                                                        0.5]
+    monkeypatch.undo()
+
+    numpy = pytest.importorskip('numpy')
+    data, more = PakBus.parse_collectdata(recdata, tabledef, arrays=True)
+    values = data[0]['RecFrag'][0]['Fields'][b'Temp']
+    assert values.shape == (2, 2)
+    assert numpy.array_equal(values, [[1.5, -2.25], [3.0, 0.5]])
+    values, size = PakBus.decode_array('UInt2', recdata, 16, 4)
+    assert size == 8
+    assert list(values) == [0x200F, 0xC000 | 225, 3, 0x2005]
+
+
+def test_rtt_estimator():
+    rtt = RTTEstimator(10)
+    assert rtt.timeout(100) == 10
+    # hop metric 1: response within 1 second
+    rtt.seed(1)
+    assert rtt.timeout(100) == 3
+    rtt.add(0.1)
+    # not below the hop metric
+    assert rtt.timeout(100) == 1
+    rtt = RTTEstimator(10)
+    rtt.add(0.1)
+    assert round(rtt.timeout(100), 3) == 0.3
+    for i in range(20):
+        rtt.add(0.1)
+    assert rtt.timeout(100) == 0.2
+    # transfer time of the command and of a full response at 9600 bauds
+    assert round(rtt.timeout(100, 9600), 3) == round(0.2 + 11100 / 9600, 3)
+    # the timeout is doubled for the next attempts of one request only
+    assert rtt.backoff(rtt.timeout(100)) == 0.4
+    assert rtt.backoff(50) == 60
+    assert rtt.timeout(100) == 0.2
+
+
+def test_is_idempotent():
+    pakbus = PakBus(FakeLink())
+    assert pakbus.is_idempotent(pakbus.get_hello_cmd()[0])
+    assert pakbus.is_idempotent(pakbus.get_clock_cmd()[0])
+    assert not pakbus.is_idempotent(pakbus.get_clock_cmd((3600, 0))[0])
+    assert pakbus.is_idempotent(pakbus.get_collectdata_cmd(1, 1234)[0])
+    assert pakbus.is_idempotent(pakbus.get_fileupload_cmd('.TDF')[0])
+    assert not pakbus.is_idempotent(
+        pakbus.get_setvalues_cmd('Public', 'IEEE4B', 'Temp', [1.0])[0])
+
+
+class BufferLink(FakeLink):
+    timeout = 1
+
+    def __init__(self, data=b''):
+        self.data = data
+        self.written = b''
+
+    def write(self, data):
+        self.written += data
+
+    def read(self, size):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+
+def test_wait_packet():
+    # frames sent by the datalogger (node 0x001) to us (node 0x802)
+    logger = PakBus(BufferLink(), dest=0x802, src=0x001)
+    for body in ('A1 05 1A 00 01',  # please wait 1 sec for transaction 5
+                 '9A 07 10',  # response of transaction 7
+                 '9A 05 00 41 A4 00 00'):
+        logger.write(logger.pack_header(0x1) + hex_to_bytes(body))
+    link = BufferLink(logger.link.written[6:])
+    pakbus = PakBus(link)
+    hdr, msg = pakbus.wait_packet(5, timeout=0.5)
+    assert msg['RespCode'] == 0
+    assert pakbus.delayed
+    assert list(pakbus.mailbox) == [7]
+    hdr, msg = pakbus.wait_packet(7)
+    assert msg['RespCode'] == 16
+    assert pakbus.wait_packet(8, timeout=0.1) == ({}, {})
+
+
+def test_wait_packet_stale():
+    logger = PakBus(BufferLink(), dest=0x802, src=0x001)
+    # GetValues command of transaction 5
+    command = logger.pack_header(0x1) + hex_to_bytes('1A 05 00 00')
+    expected = PakBus.response_type(command)
+    assert expected == (0x1, 0x9a)
+    for body in ('97 05 00 00 00 00 00 00 00 00 00',  # an older clock command
+                 '9A 06 10',  # response of transaction 6
+                 '9A 05 00 41 A4 00 00'):
+        logger.write(logger.pack_header(0x1) + hex_to_bytes(body))
+    pakbus = PakBus(BufferLink(logger.link.written[6:]))
+    hdr, msg = pakbus.wait_packet(5, 0.5, expected)
+    assert msg['MsgType'] == 0x9a and msg['RespCode'] == 0
+    # a new transaction 6 is sent, the kept packet answers an older one
+    assert list(pakbus.mailbox) == [6]
+    pakbus.forget(6)
+    assert pakbus.wait_packet(6, 0.1, expected) == ({}, {})
+    # the old packets and please wait messages are dropped
+    pakbus.mailbox[7] = (time.time() - 2 * PakBus.MAILBOX_AGE, {}, {})
+    pakbus.please_wait[8] = time.time() - 2 * PakBus.MAILBOX_AGE
+    pakbus._purge()
+    assert pakbus.mailbox == {} and pakbus.please_wait == {}
@@ -8,10 +8,15 @@
 
 '''
 from __future__ import unicode_literals
+import io
+import pickle
 import random
 
+from datetime import datetime
+
 from ..utils import (cached_property, Dict, hex_to_bytes, bytes_to_hex,
-                     csv_to_dict)
+                     csv_to_dict, csv_last_row, CSVWriter, ListDict,
+                     record_type, make_record, parse_datetime)
 from ..compat import StringIO, is_text, is_bytes
 
 
@@ -53,6 +58,76 @@ def test_ordered_dict():
     assert "f,a,b\r\n222,111,000\r\n" == d.to_csv()
 
 
+def test_record():
+    '''Tests compact records.'''
+    Table1 = record_type(['Datetime', 'RecNbr', b'Temp', b'Batt'],
+                         name=b'Table1')
+    assert record_type(['Datetime', 'RecNbr', 'Temp', 'Batt']) is Table1
+    item = {'TimeOfRec': datetime(2012, 7, 26), 'RecNbr': 1,
+            'Fields': {'Batt': 13.5, 'Temp': 20.5}}
+    record = make_record(item, Table1)
+    assert record['Temp'] == 20.5
+    assert record.get('Missing', 0) == 0
+    assert list(record) == ['Datetime', 'RecNbr', 'Temp', 'Batt']
+    assert record == {'Datetime': datetime(2012, 7, 26), 'RecNbr': 1,
+                      'Temp': 20.5, 'Batt': 13.5}
+    assert not hasattr(record, '__dict__')
+    assert pickle.loads(pickle.dumps(record)) == record
+    assert make_record(item, Table1, timestamps=True)['Datetime'] == \
+        1343260800
+
+    records = ListDict([record, make_record(dict(item, RecNbr=0), Table1)])
+    assert records.sorted_by('RecNbr')[0]['RecNbr'] == 0
+    assert records.filter(['RecNbr'])[0] == {'RecNbr': 1}
+    assert records.to_csv() == ('Datetime,RecNbr,Temp,Batt\r\n'
+                                '2012-07-26 00:00:00,1,20.5,13.5\r\n'
+                                '2012-07-26 00:00:00,0,20.5,13.5\r\n')
+
+
+def test_csv_writer():
+    '''Tests incremental csv writer.'''
+    output = StringIO()
+    writer = CSVWriter(output, delimiter=';', bufsize=1024)
+    d = Dict()
+    d["f"] = "222"
+    d["a"] = "111"
+    writer.writerows([d])
+    writer.writerows([{"a": "333", "f": "444"}, {"f": "555"}])
+    writer.writerows([])
+    # rows are buffered until the block is full or the writer is closed
+    assert output.getvalue() == ""
+    writer.close()
+    assert output.getvalue() == "f;a\r\n222;111\r\n444;333\r\n555;\r\n"
+
+
+def test_csv_writer_without_header():
+    '''Tests csv writer flushing blocks without header.'''
+    output = StringIO()
+    writer = CSVWriter(output, fieldnames=["a"], header=False, bufsize=1)
+    writer.writerow({"a": "1"})
+    assert output.getvalue() == "1\r\n"
+
+
+def test_csv_last_row():
+    '''Tests reading the last csv row from the end of the file.'''
+    content = "Datetime,RecNbr\r\n" + "".join("2012-07-26 13:%02d:00,%d\r\n"
+                                              % (i, i) for i in range(60))
+    row = csv_last_row(io.BytesIO(content.encode('utf-8')), blocksize=7)
+    assert row == {"Datetime": "2012-07-26 13:59:00", "RecNbr": "59"}
+    row = csv_last_row(io.BytesIO(b"a;b\n1;2"), delimiter=';')
+    assert row == {"a": "1", "b": "2"}
+    assert csv_last_row(io.BytesIO(b"a,b\r\n")) is None
+    assert csv_last_row(io.BytesIO(b"")) is None
+
+
+def test_parse_datetime():
+    '''Tests parsing record datetimes with and without microseconds.'''
+    dtime = datetime(2012, 7, 26, 13, 59)
+    assert parse_datetime(str(dtime)) == dtime
+    dtime = dtime.replace(microsecond=500000)
+    assert parse_datetime(str(dtime)) == dtime
+
+
 class TestCachedProperty:
     ''' Tests cached_property decorator.'''
 
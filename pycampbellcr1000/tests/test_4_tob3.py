@@ -0,0 +1,118 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_tob3
+    -----------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import struct
+import pytest
+import datetime
+
+from ..tob3 import (TOB3File, convert, convert_parquet, parse_interval,
+                    parse_datatype)
+from ..compat import StringIO
+
+
+HEADER = ('"TOB3","CR1000","CR1000","E4668","CR1000.Std.24","CPU:T.CR1",'
+          '"2993","2012-07-26 13:40:00"\r\n'
+          '"OneMin","1 MIN","40","1000","4660","SecUsec","0","0","0"\r\n'
+          '"Batt_Volt","Temp","Flag"\r\n'
+          '"V","degC",""\r\n'
+          '"Avg","Smp","Smp"\r\n'
+          '"IEEE4","FP2","ASCII(2)"\r\n')
+
+
+def make_frame(seconds, recnbr, records, validation=4660, flags=0):
+    '''Build a 40 bytes frame holding up to three 8 bytes records.'''
+    data = struct.pack('<3L', seconds, 0, recnbr)
+    for volt, temp, flag in records:
+        data += struct.pack('<f', volt) + struct.pack('>H', 0x4000 | temp)
+        data += flag.ljust(2, b'\0')
+    data += b'\0' * (36 - len(data))
+    return data + struct.pack('<L', (validation << 16) | flags)
+
+
+def make_tob3(tmpdir, header=HEADER):
+    '''Write a TOB3 file whose frames are not in record order.'''
+    seconds = 712140000  # 2012-07-26 08:40:00
+    frames = [
+        make_frame(seconds + 180, 3, [(12.5, 253, b'c'), (12.75, 254, b'd'),
+                                      (13.0, 255, b'e')]),
+        make_frame(seconds, 0, [(11.5, 250, b'ab'), (11.75, 251, b'b'),
+                                (12.0, 252, b'b')]),
+        make_frame(seconds, 9, [], validation=1),
+    ]
+    filename = str(tmpdir.join('CPU_OneMin.dat'))
+    with open(filename, 'wb') as fileobj:
+        fileobj.write(header.encode('utf-8'))
+        fileobj.write(b''.join(frames))
+    return filename
+
+
+def test_parse_header_values():
+    assert parse_interval('1 MIN') == 60
+    assert parse_interval('100 MSEC') == 0.1
+    assert parse_datatype('ASCII(16)') == ('ASCII', 16)
+    assert parse_datatype('IEEE4') == ('IEEE4L', 1)
+    assert parse_datatype('ulong') == ('ULong', 1)
+
+
+def test_tob3_frames(tmpdir):
+    tob3 = TOB3File(make_tob3(tmpdir))
+    assert tob3.header['TableName'] == 'OneMin'
+    assert tob3.layout.record_size == 8
+    assert tob3.fieldnames == ['Datetime', 'RecNbr', 'Batt_Volt', 'Temp',
+                               'Flag']
+    # the frame with a bad validation stamp is skipped
+    offset = tob3.header['DataOffset']
+    assert tob3.frames() == [(offset + 40, 3), (offset, 3)]
+    assert tob3.table_def['Header']['TblInterval'] == (60, 0)
+    tob3.close()
+
+
+def test_tob3_subsecond_interval(tmpdir):
+    tob3 = TOB3File(make_tob3(tmpdir, HEADER.replace('1 MIN', '250 MSEC')))
+    assert tob3.table_def['Header']['TblInterval'] == (0, 250000000)
+    tob3.close()
+
+
+def test_tob3_rows_in_order(tmpdir):
+    tob3 = TOB3File(make_tob3(tmpdir))
+    rows = [row for rows in tob3.iter_rows(workers=1, frames_per_chunk=1)
+            for row in rows]
+    assert [row[1] for row in rows] == [0, 1, 2, 3, 4, 5]
+    assert rows[0][0] == datetime.datetime(2012, 7, 26, 8, 40)
+    assert rows[4][0] == datetime.datetime(2012, 7, 26, 8, 44)
+    assert rows[0][2:] == (11.5, 2.5, 'ab')
+    assert rows[5][2:] == (13.0, 2.55, 'e')
+    tob3.close()
+
+
+def test_convert_with_process_pool(tmpdir):
+    filename = make_tob3(tmpdir)
+    serial = StringIO()
+    assert convert(filename, serial, workers=1) == 6
+    parallel = StringIO()
+    assert convert(filename, parallel, workers=2, frames_per_chunk=1) == 6
+    assert serial.getvalue() == parallel.getvalue()
+    lines = serial.getvalue().splitlines()
+    assert lines[0] == 'Datetime,RecNbr,Batt_Volt,Temp,Flag'
+    assert lines[1] == '2012-07-26 08:40:00,0,11.5,2.5,ab'
+
+
+def test_convert_parquet(tmpdir):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    root = str(tmpdir.join('dataset'))
+    assert convert_parquet(make_tob3(tmpdir), root, workers=1) == 6
+    table = pyarrow.parquet.read_table(str(tmpdir.join(
+        'dataset', 'station=CR1000', 'table=OneMin', 'date=2012-07-26',
+        'part-0.parquet')))
+    assert table.column_names == ['Datetime', 'RecNbr', 'Batt_Volt', 'Temp',
+                                  'Flag']
+    assert table.column('RecNbr').to_pylist() == [0, 1, 2, 3, 4, 5]
+    assert table.column('Flag').to_pylist()[0] == 'ab'
@@ -0,0 +1,149 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_sinks
+    ------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import sqlite3
+import calendar
+import pytest
+from datetime import datetime, timedelta
+
+from ..sinks import SQLiteSink, ArrowSink
+from ..utils import Dict
+
+
+def make_field(name, type_, dimension=1):
+    return {'FieldName': name, 'FieldType': type_, 'Dimension': dimension,
+            'SubDim': [], 'Units': b'', 'Processing': b''}
+
+
+TABLEDEF = [{'Header': {'TableName': b'Table1', 'TblInterval': (60, 0)},
+             'Signature': 1234,
+             'Fields': [make_field(b'Batt_Volt_Avg', 'FP2'),
+                        make_field(b'Temp', 'IEEE4B', 2),
+                        make_field(b'Msg', 'ASCII', 8),
+                        make_field(b'LastTime', 'NSec')]}]
+
+
+def make_records(begin, end):
+    records = []
+    for i in range(begin, end):
+        record = Dict()
+        record['Datetime'] = datetime(2012, 7, 26) + timedelta(minutes=i)
+        record['RecNbr'] = i
+        record['Batt_Volt_Avg'] = 13.5
+        record['Temp'] = [20.0 + i, 21.0]
+        record['Msg'] = b'ok\0\0\0\0\0\0'
+        record['LastTime'] = (712108800, 0)
+        records.append(record)
+    return records
+
+
+def test_sqlite_sink(tmpdir):
+    filename = str(tmpdir.join('station.db'))
+    sink = SQLiteSink(filename, TABLEDEF, batch_size=4)
+    assert sink.last_record('Table1') is None
+    sink.write('Table1', make_records(0, 3))
+    # overlapping records are ignored
+    sink.write(b'Table1', make_records(2, 6))
+    assert sink.last_record('Table1') == (datetime(2012, 7, 26, 0, 5), 5)
+    sink.close()
+
+    connection = sqlite3.connect(filename)
+    rows = connection.execute('SELECT * FROM Table1 '
+                              'ORDER BY RecNbr').fetchall()
+    assert len(rows) == 6
+    assert rows[1] == ('2012-07-26 00:01:00', 1, 13.5, 21.0, 21.0, 'ok',
+                       '2012-07-26 00:00:00')
+    columns = [column[1] for column in
+               connection.execute('PRAGMA table_info(Table1)')]
+    assert columns == ['Datetime', 'RecNbr', 'Batt_Volt_Avg', 'Temp(1)',
+                       'Temp(2)', 'Msg', 'LastTime']
+
+
+def test_sqlite_sink_timestamps(tmpdir):
+    # records collected with timestamps=True, ASCII values decoded as text
+    filename = str(tmpdir.join('station.db'))
+    sink = SQLiteSink(filename, TABLEDEF)
+    records = make_records(0, 2)
+    for record in records:
+        record['Datetime'] = calendar.timegm(record['Datetime'].timetuple())
+        record['Msg'] = 'text\0\0\0\0'
+    sink.write('Table1', records)
+    assert sink.last_record('Table1') == (datetime(2012, 7, 26, 0, 1), 1)
+    sink.close()
+
+    connection = sqlite3.connect(filename)
+    rows = connection.execute('SELECT "Datetime", "Msg" FROM Table1 '
+                              'ORDER BY RecNbr').fetchall()
+    assert rows == [('2012-07-26 00:00:00', 'text'),
+                    ('2012-07-26 00:01:00', 'text')]
+    connection.close()
+
+
+def test_sqlite_sink_new_signature(tmpdir):
+    filename = str(tmpdir.join('station.db'))
+    sink = SQLiteSink(filename, TABLEDEF)
+    sink.write('Table1', make_records(0, 3))
+    sink.close()
+
+    tabledef = [dict(TABLEDEF[0], Signature=4321)]
+    sink = SQLiteSink(filename, tabledef)
+    assert sink.last_record('Table1') is None
+    sink.close()
+    connection = sqlite3.connect(filename)
+    count = connection.execute('SELECT COUNT(*) FROM Table1_1234').fetchone()
+    assert count == (3,)
+    connection.close()
+
+    # back and forth: the name of the old records is already used
+    for signature, start in ((1234, 10), (4321, 20)):
+        tabledef = [dict(TABLEDEF[0], Signature=signature)]
+        sink = SQLiteSink(filename, tabledef)
+        sink.write('Table1', make_records(start, start + 2))
+        sink.close()
+    connection = sqlite3.connect(filename)
+    count = connection.execute('SELECT COUNT(*) FROM Table1_1234').fetchone()
+    assert count == (3,)
+    count = connection.execute('SELECT COUNT(*) FROM Table1_4321').fetchone()
+    assert count == (0,)
+    count = connection.execute('SELECT COUNT(*) FROM Table1_1234_2').fetchone()
+    assert count == (2,)
+    count = connection.execute('SELECT COUNT(*) FROM Table1').fetchone()
+    assert count == (2,)
+    indexes = connection.execute('SELECT name FROM sqlite_master WHERE '
+                                 'tbl_name = "Table1" AND type = "index" '
+                                 'AND sql IS NOT NULL').fetchall()
+    assert indexes == [('Table1_4321_Datetime',)]
+
+
+def test_arrow_sink(tmpdir):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    root = str(tmpdir.join('dataset'))
+    sink = ArrowSink(root, TABLEDEF, station='labo', row_group_size=1000)
+    assert sink.last_record('Table1') is None
+    # 2012-07-26 23:58 to 2012-07-27 00:01
+    sink.write('Table1', make_records(1438, 1442))
+    sink.close()
+    assert sink.last_record('Table1') == (datetime(2012, 7, 27, 0, 1), 1441)
+
+    directory = tmpdir.join('dataset', 'station=labo', 'table=Table1')
+    assert sorted(path.basename for path in directory.listdir()) == \
+        ['date=2012-07-26', 'date=2012-07-27']
+    table = pyarrow.parquet.read_table(
+        str(directory.join('date=2012-07-27', 'part-1440.parquet')))
+    assert table.num_rows == 2
+    assert table.schema.field('Batt_Volt_Avg').type == pyarrow.float32()
+    assert table.schema.field('Temp').type == pyarrow.list_(pyarrow.float32(),
+                                                            2)
+    row = table.to_pylist()[0]
+    assert row['Datetime'] == datetime(2012, 7, 27)
+    assert row['RecNbr'] == 1440
+    assert row['Temp'] == [1460.0, 21.0]
+    assert row['Msg'] == 'ok'
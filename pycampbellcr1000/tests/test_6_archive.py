@@ -0,0 +1,71 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_archive
+    --------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+import struct
+from datetime import datetime
+
+from ..archive import RawArchive
+from ..pakbus import PakBus
+
+
+def make_tdf():
+    '''Build the .TDF of a one minute table with a `Temp` IEEE4B field.'''
+    data = b'\x01' + b'Table1\0' + struct.pack('>LB', 1000, 14)
+    data += struct.pack('>4l', 0, 0, 60, 0)
+    data += b'\x89' + b'Temp\0' + b'\0' + b'Smp\0' + b'degC\0' + b'\0'
+    data += struct.pack('>3L', 1, 1, 0)
+    return data + b'\0'
+
+
+def make_recdata(begrecnbr, temps, more=False):
+    '''Build the RecData of a collectdata response.'''
+    # 2012-07-26 08:40
+    data = struct.pack('>HLH2l', 1, begrecnbr, len(temps), 712140000, 0)
+    for temp in temps:
+        data += struct.pack('>f', temp)
+    return data + struct.pack('B', more)
+
+
+def test_parse_collectdata_header():
+    frag, more = PakBus.parse_collectdata_header(make_recdata(12, [1.0, 2.0],
+                                                              True))
+    assert frag['TableNbr'] == 1
+    assert frag['BegRecNbr'] == 12
+    assert frag['NbrOfRecs'] == 2
+    assert not frag['IsOffset']
+    assert more
+
+
+def test_raw_archive(tmpdir):
+    filename = str(tmpdir.join('station.pba'))
+    archive = RawArchive(filename)
+    tabledef = PakBus.parse_tabledef(make_tdf())
+    assert archive.next_recnbr(tabledef, 'Table1') is None
+    ref = archive.add_tabledef(make_tdf())
+    archive.add_recdata(ref, tabledef[0]['Signature'],
+                        make_recdata(10, [20.0, 21.0], True))
+    archive.close()
+
+    # reopen and resume
+    archive = RawArchive(filename)
+    assert archive.add_tabledef(make_tdf()) == ref
+    assert archive.next_recnbr(tabledef, b'Table1') == 12
+    archive.add_recdata(ref, tabledef[0]['Signature'],
+                        make_recdata(12, [22.0]))
+    assert archive.next_recnbr(tabledef, 'Table1') == 13
+
+    packets = list(archive.iter_records('Table1'))
+    assert [len(records) for records in packets] == [2, 1]
+    record = packets[1][0]
+    assert record['RecNbr'] == 12
+    assert record['Datetime'] == datetime(2012, 7, 26, 8, 40)
+    assert record['Temp'] == 22.0
+    assert len(archive.entries) == 3
+    archive.close()
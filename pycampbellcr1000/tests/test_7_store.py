@@ -0,0 +1,48 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_store
+    ------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+from datetime import datetime
+
+from ..store import ColumnStore
+from .test_5_sinks import TABLEDEF, make_records
+
+
+def test_column_store(tmpdir):
+    root = str(tmpdir.join('store'))
+    store = ColumnStore(root, TABLEDEF, batch_size=4, index_interval=3)
+    assert store.last_record('Table1') is None
+    store.write('Table1', make_records(0, 6))
+    # old records are ignored
+    store.write(b'Table1', make_records(4, 10))
+    store.close()
+
+    reader = ColumnStore(root)
+    assert reader.last_record('Table1') == (datetime(2012, 7, 26, 0, 9), 9)
+    begin, end = reader.rows('Table1', datetime(2012, 7, 26, 0, 2),
+                             datetime(2012, 7, 26, 0, 7))
+    assert (begin, end) == (2, 8)
+    assert reader.column('Table1', 'RecNbr', begin, end) == (2, 3, 4, 5, 6, 7)
+    assert reader.column('Table1', 'Temp(1)', 0, 2) == (20.0, 21.0)
+    assert reader.rows('Table1', datetime(2013, 1, 1)) == (10, 10)
+
+    records = reader.read('Table1', stop=datetime(2012, 7, 26, 0, 1))
+    assert len(records) == 2
+    assert records[1] == {'Datetime': datetime(2012, 7, 26, 0, 1),
+                          'RecNbr': 1, 'Batt_Volt_Avg': 13.5,
+                          'Temp': [21.0, 21.0], 'Msg': b'ok\0\0\0\0\0\0',
+                          'LastTime': (712108800, 0)}
+
+    # the writer appends while the reader has the files mapped
+    store = ColumnStore(root, TABLEDEF)
+    store.write('Table1', make_records(10, 12))
+    store.flush()
+    assert reader.rows('Table1', datetime(2012, 7, 26, 0, 10)) == (10, 12)
+    store.close()
+    reader.close()
@@ -0,0 +1,42 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_timeindex
+    ----------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+from datetime import datetime
+
+from ..timeindex import TimeIndex
+
+
+def minute(n):
+    return datetime(2012, 7, 26, 0, n)
+
+
+def test_time_index(tmpdir):
+    filename = str(tmpdir.join('station.tix'))
+    index = TimeIndex(filename)
+    assert index.lookup('Table1', 1234, minute(5), minute(8)) is None
+    index.add(b'Table1', 1234, [(minute(0), 100), (minute(4), 104),
+                                (minute(10), 110), (minute(20), 120)])
+    index.save()
+
+    index = TimeIndex(filename)
+    # between the 104 and 110 known records
+    assert index.lookup('Table1', 1234, minute(5), minute(8)) == (105, 110)
+    assert index.lookup('Table1', 1234, minute(4), minute(30)) == (101, None)
+    # nothing is known before
+    assert index.lookup('Table1', 1234, minute(0), minute(30)) is None
+
+    # the clock was set back: the range is wider
+    index.add('Table1', 1234, [(minute(2), 115)])
+    assert index.lookup('Table1', 1234, minute(5), minute(8)) == (105, 120)
+
+    # new table definition
+    assert index.lookup('Table1', 4321, minute(5), minute(8)) is None
+    index.save()
+    assert TimeIndex(filename).tables['Table1']['Points'] == {}
@@ -0,0 +1,42 @@
+# coding: utf8
+'''
+    PyCampbellCRX.tests.test_backfill
+    ---------------------------------
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import unicode_literals
+from datetime import timedelta
+
+from ..backfill import (find_gaps, find_time_gaps, scan_gaps, clip_gaps,
+                        table_interval)
+from ..sinks import SQLiteSink
+from .test_5_sinks import TABLEDEF, make_records
+
+
+def test_find_gaps(tmpdir):
+    sink = SQLiteSink(str(tmpdir.join('station.db')), TABLEDEF)
+    records = make_records(0, 20)
+    del records[12:15]
+    del records[3]
+    # the datalogger was stopped 5 minutes after record 7
+    for record in records[7:]:
+        record['Datetime'] += timedelta(minutes=5)
+    sink.write('Table1', records)
+    rows = list(sink.iter_recnbrs('Table1'))
+    sink.close()
+
+    assert find_gaps(rows) == [(3, 4), (12, 15)]
+    interval = table_interval(TABLEDEF[0])
+    assert interval == timedelta(minutes=1)
+    gaps = find_time_gaps(rows, interval)
+    assert [(begin.minute, end.minute) for begin, end in gaps] == [(7, 13)]
+    # the datalogger only holds the records from 13
+    assert clip_gaps(find_gaps(rows), 13, 30) == [(13, 15)]
+    # the same in a single pass over the cursor
+    sink = SQLiteSink(str(tmpdir.join('station.db')), TABLEDEF)
+    assert scan_gaps(sink.iter_recnbrs('Table1'), interval) == \
+        (find_gaps(rows), gaps)
+    sink.close()
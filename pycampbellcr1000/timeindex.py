@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.timeindex
+    --------------------------
+
+    Persistent map of the record times to the record numbers of the tables,
+    learned from the collected records. It turns a time window into a record
+    number range, so the datalogger does not search by time::
+
+        >>> device.time_index = TimeIndex('station.tix')
+        >>> device.get_data('Table1', start_date, stop_date)
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import io
+import os
+import json
+
+from .logger import LOGGER
+from .utils import field_name, time_to_nsec
+
+
+def to_seconds(dtime):
+    '''Convert a datetime to seconds since 1990-01-01.'''
+    return time_to_nsec(dtime)[0]
+
+
+class TimeIndex(object):
+    '''Map of the times of the records to their numbers, for each table,
+    stored in a JSON file. The points of a table are forgotten when its
+    signature changes.
+
+    :param filename: The index file.
+    :param max_points: Number of points kept for each table, the oldest are
+                       dropped.
+    '''
+
+    def __init__(self, filename, max_points=10000):
+        self.filename = filename
+        self.max_points = max_points
+        self.tables = {}
+        if os.path.exists(filename):
+            with io.open(filename, encoding='utf-8') as file_input:
+                for name, table in json.load(file_input).items():
+                    self.tables[name] = {
+                        'Signature': table['Signature'],
+                        'Points': dict((recnbr, seconds)
+                                       for recnbr, seconds in table['Points'])
+                    }
+        self.changed = False
+
+    def _get_points(self, tablename, signature):
+        '''Return the points of `tablename`, reset if the signature
+        changed.'''
+        tablename = field_name(tablename)
+        table = self.tables.get(tablename)
+        if table is None or table['Signature'] != signature:
+            if table is not None:
+                LOGGER.info('Table definition of %s changed' % tablename)
+            table = {'Signature': signature, 'Points': {}}
+            self.tables[tablename] = table
+            self.changed = True
+        return table['Points']
+
+    def add(self, tablename, signature, points):
+        '''Learn `(datetime, recnbr)` points of `tablename`.'''
+        table = self._get_points(tablename, signature)
+        for dtime, recnbr in points:
+            table[recnbr] = to_seconds(dtime)
+            self.changed = True
+        if len(table) > self.max_points:
+            for recnbr in sorted(table)[:len(table) - self.max_points]:
+                del table[recnbr]
+
+    def add_fragments(self, tabledef, data):
+        '''Learn the first and last records of the fragments `data` parsed
+        by `PakBus.parse_collectdata` with the table definition `tabledef`.
+        '''
+        for frag in data:
+            if frag['NbrOfRecs']:
+                item = tabledef[frag['TableNbr'] - 1]
+                self.add(item['Header']['TableName'], item['Signature'],
+                         [(rec['TimeOfRec'], rec['RecNbr'])
+                          for rec in (frag['RecFrag'][0],
+                                      frag['RecFrag'][-1])])
+
+    def lookup(self, tablename, signature, start, stop):
+        '''Return the range `(first, end)` of record numbers that holds all
+        the records of `tablename` from `start` to `stop`, `end` being
+        excluded or None if unknown. Return None if the index can not tell
+        where `start` is.
+
+        Records are assumed to be stored in time order, when they are not
+        (the clock was set back) the range is only wider.'''
+        table = self._get_points(tablename, signature)
+        points = sorted(table.items())
+        start, stop = to_seconds(start), to_seconds(stop)
+        # the known records before `start`, with no later record before them
+        first = None
+        for recnbr, seconds in points:
+            if seconds >= start:
+                break
+            first = recnbr + 1
+        if first is None:
+            return None
+        # the known records after `stop`, with no earlier record after them
+        end = None
+        for recnbr, seconds in reversed(points):
+            if seconds <= stop:
+                break
+            end = recnbr
+        if end is not None and end < first:
+            end = first
+        return first, end
+
+    def save(self):
+        '''Write the index file if it changed.'''
+        if not self.changed:
+            return
+        data = dict((name, {'Signature': table['Signature'],
+                            'Points': sorted(table['Points'].items())})
+                    for name, table in self.tables.items())
+        with io.open(self.filename, 'w', encoding='utf-8') as file_output:
+            file_output.write('%s' % json.dumps(data))
+        self.changed = False
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.tob3
+    ---------------------
+
+    Offline conversion of TOB3 data files dumped from a datalogger card.
+
+    The binary part of a TOB3 file is a sequence of fixed-size frames, each
+    one holding a 12 bytes header (time of first record and record number),
+    a block of fixed-size records and a 4 bytes footer carrying flags and the
+    validation stamp. Frames are therefore independent of each other and can
+    be decoded on several processes at the same time.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import os
+import re
+import csv
+import mmap
+import struct
+import multiprocessing
+
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+
+from .compat import is_py3
+from .logger import LOGGER
+from .pakbus import PakBus
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:  # python 2 without the `futures` backport
+    ProcessPoolExecutor = None
+
+
+# TOB3 data types and their PakBus equivalent
+DATATYPE = {
+    'IEEE4': 'IEEE4L',
+    'IEEE4L': 'IEEE4L',
+    'IEEE4B': 'IEEE4B',
+    'IEEE8': 'IEEE8L',
+    'IEEE8L': 'IEEE8L',
+    'IEEE8B': 'IEEE8B',
+    'FP2': 'FP2',
+    'FP4': 'FP4',
+    'USHORT': 'UShort',
+    'SHORT': 'Short',
+    'UINT2': 'UInt2',
+    'INT2': 'Int2',
+    'ULONG': 'ULong',
+    'LONG': 'Long',
+    'UINT4': 'UInt4',
+    'INT4': 'Int4',
+    'BOOL': 'Bool',
+    'BOOL2': 'Bool2',
+    'BOOL4': 'Bool4',
+    'BOOL8': 'Bool8',
+    'NSEC': 'NSec',
+    'SECNANO': 'SecNano',
+}
+
+# Seconds per unit used in the record interval of line 2
+INTERVAL_UNITS = {
+    'NSEC': 1e-9,
+    'USEC': 1e-6,
+    'MSEC': 1e-3,
+    'SEC': 1,
+    'MIN': 60,
+    'HR': 3600,
+    'HOUR': 3600,
+    'DAY': 86400,
+}
+
+# Sub-second resolution of frame timestamps
+FRAME_RESOLUTION = {
+    'SecMsec': 1e-3,
+    'Sec100Usec': 1e-4,
+    'Sec10Usec': 1e-5,
+    'SecUsec': 1e-6,
+    'SecNsec': 1e-9,
+}
+
+FRAME_HEADER = struct.Struct(str('<3L'))
+FRAME_FOOTER = struct.Struct(str('<L'))
+FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_FOOTER.size
+
+# Footer flags
+FLAG_EMPTY = 0x2000
+FLAG_MINOR = 0x4000
+
+NSEC_BASE = datetime(1990, 1, 1)
+
+#: Picklable description of a TOB3 table, shipped to the worker processes.
+Layout = namedtuple('Layout', ['names', 'segments', 'record_size',
+                               'interval', 'resolution'])
+
+
+def parse_interval(value):
+    '''Convert a TOB3 interval like "1 MIN" or "100 MSEC" into seconds.'''
+    match = re.match(r'\s*(\d+)\s*([A-Za-z]+)', value)
+    if match is None:
+        raise ValueError('Unknown TOB3 interval %r' % value)
+    number, unit = match.groups()
+    try:
+        return int(number) * INTERVAL_UNITS[unit.upper()]
+    except KeyError:
+        raise ValueError('Unknown TOB3 interval unit %r' % unit)
+
+
+def parse_datatype(value):
+    '''Return the (PakBus type, length) tuple of a TOB3 data type.'''
+    value = value.strip().upper()
+    if value.startswith('ASCII'):
+        return 'ASCII', int(value[5:].strip('()'))
+    try:
+        return DATATYPE[value], 1
+    except KeyError:
+        raise ValueError('Unsupported TOB3 data type %r' % value)
+
+
+def read_header(fileobj):
+    '''Read the six ASCII header lines of a TOB3 file and return the header
+    as a dict. The `DataOffset` key gives the position of the first frame.'''
+    lines = [fileobj.readline() for i in range(6)]
+    rows = []
+    for line in lines:
+        line = line.decode('latin-1').rstrip('\r\n')
+        rows.extend(csv.reader([line]))
+    if not rows or rows[0][0] != 'TOB3':
+        raise ValueError('Not a TOB3 file')
+    environment, table, names, units, processing, types = rows
+    header = {
+        'Environment': environment,
+        'TableName': table[0],
+        'Interval': parse_interval(table[1]),
+        'FrameSize': int(table[2]),
+        'IntendedTableSize': int(table[3]),
+        'Validation': int(table[4]),
+        'Resolution': FRAME_RESOLUTION.get(table[5], 1e-3),
+        'FieldNames': names,
+        'Units': units,
+        'Processing': processing,
+        'DataTypes': types,
+        'DataOffset': fileobj.tell(),
+    }
+    return header
+
+
+def make_layout(header):
+    '''Build the compact record layout from a TOB3 header. Consecutive
+    fixed-length fields are grouped into segments so each record is decoded
+    with few calls to `PakBus.decode_bin`.'''
+    segments = []
+    types = []
+    record_size = 0
+    for datatype in header['DataTypes']:
+        type_, length = parse_datatype(datatype)
+        if type_ == 'ASCII':
+            if types:
+                segments.append((tuple(types), 1))
+                types = []
+            segments.append((('ASCII',), length))
+            record_size += length
+        else:
+            types.append(type_)
+            record_size += PakBus.DATATYPE[type_]['size']
+    if types:
+        segments.append((tuple(types), 1))
+    return Layout(tuple(header['FieldNames']), tuple(segments), record_size,
+                  header['Interval'], header['Resolution'])
+
+
+def decode_frames(layout, buff, frames):
+    '''Decode `frames` from `buff` and return a list of row tuples
+    `(Datetime, RecNbr, value, ...)`.
+
+    :param layout: The table `Layout`.
+    :param buff: Any buffer holding the frames (typically a `mmap`).
+    :param frames: List of `(offset, nbr_of_recs)` tuples.
+    '''
+    rows = []
+    decode_bin = PakBus.decode_bin
+    for offset, nbrofrecs in frames:
+        seconds, subseconds, recnbr = FRAME_HEADER.unpack_from(buff, offset)
+        begin = seconds + subseconds * layout.resolution
+        offset += FRAME_HEADER.size
+        for n in range(nbrofrecs):
+            record = buff[offset:offset + layout.record_size]
+            offset += layout.record_size
+            row = [NSEC_BASE + timedelta(seconds=begin + n * layout.interval),
+                   recnbr + n]
+            position = 0
+            for types, length in layout.segments:
+                values, size = decode_bin(types, record[position:], length)
+                if types == ('ASCII',):
+                    values = [values[0].rstrip(b'\0').decode('latin-1')]
+                row.extend(values)
+                position += size
+            rows.append(tuple(row))
+    return rows
+
+
+def _decode_chunk(task):
+    '''Worker entry point: map the file and decode the frames of one chunk.
+    The map is released before returning, workers keep no open files.'''
+    filename, layout, frames = task
+    with open(filename, 'rb') as fileobj:
+        mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return decode_frames(layout, mapped, frames)
+    finally:
+        mapped.close()
+
+
+class TOB3File(object):
+    '''A memory-mapped TOB3 file.
+
+    :param filename: Path of the TOB3 file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fileobj:
+            self.header = read_header(fileobj)
+            self.size = os.fstat(fileobj.fileno()).st_size
+            if self.size > self.header['DataOffset']:
+                self.mmap = mmap.mmap(fileobj.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            else:
+                self.mmap = b''
+        self.layout = make_layout(self.header)
+
+    @property
+    def table_def(self):
+        '''The table definition of this file, in the format of
+        `CR1000.table_def` items.'''
+        fields = []
+        for name, datatype, units, processing in zip(
+                self.header['FieldNames'], self.header['DataTypes'],
+                self.header['Units'], self.header['Processing']):
+            type_, length = parse_datatype(datatype)
+            fields.append({'FieldName': name, 'FieldType': type_,
+                           'Dimension': length, 'SubDim': [],
+                           'Units': units, 'Processing': processing})
+        # sub-second intervals must not become (0, 0), an event table
+        seconds = int(self.header['Interval'])
+        nanoseconds = int(round((self.header['Interval'] - seconds) * 1e9))
+        header = {'TableName': self.header['TableName'],
+                  'TableSize': self.header['IntendedTableSize'],
+                  'TblInterval': (seconds, nanoseconds)}
+        return {'Header': header, 'Fields': fields,
+                'Signature': self.header['Validation']}
+
+    @property
+    def fieldnames(self):
+        '''Column names of the rows returned by this file.'''
+        return ['Datetime', 'RecNbr'] + list(self.layout.names)
+
+    def frames(self):
+        '''Scan frame footers and return the valid frames as a list of
+        `(offset, nbr_of_recs)` tuples sorted by record number.'''
+        frame_size = self.header['FrameSize']
+        stamp = self.header['Validation']
+        valid = (stamp, stamp ^ 0xFFFF)
+        major = (frame_size - FRAME_OVERHEAD) // self.layout.record_size
+        frames = []
+        offset = self.header['DataOffset']
+        while offset + frame_size <= self.size:
+            footer, = FRAME_FOOTER.unpack_from(
+                self.mmap, offset + frame_size - FRAME_FOOTER.size)
+            if (footer >> 16) in valid and not footer & FLAG_EMPTY:
+                nbrofrecs = major
+                if footer & FLAG_MINOR:
+                    # minor frame: the footer offset gives its real size
+                    minor_size = footer & 0x7FF
+                    nbrofrecs = ((minor_size - FRAME_OVERHEAD)
+                                 // self.layout.record_size)
+                if nbrofrecs > 0:
+                    recnbr = FRAME_HEADER.unpack_from(self.mmap, offset)[2]
+                    frames.append((recnbr, offset, nbrofrecs))
+            offset += frame_size
+        frames.sort()
+        return [(offset, nbrofrecs) for recnbr, offset, nbrofrecs in frames]
+
+    def chunks(self, frames_per_chunk=256):
+        '''Split the file into picklable decode tasks of `frames_per_chunk`
+        frames, in record number order.'''
+        frames = self.frames()
+        for i in range(0, len(frames), frames_per_chunk):
+            yield (self.filename, self.layout, frames[i:i + frames_per_chunk])
+
+    def iter_rows(self, workers=None, frames_per_chunk=256):
+        '''Decode the file and yield lists of row tuples in record order.
+
+        :param workers: Number of decoding processes. With `None` the number
+                        of CPUs is used, with 1 (or when no process pool is
+                        available) the file is decoded in this process.
+        :param frames_per_chunk: Number of frames decoded by each task.
+                                 Up to two chunks per process are decoded
+                                 ahead.
+        '''
+        tasks = self.chunks(frames_per_chunk)
+        if workers == 1 or ProcessPoolExecutor is None:
+            for task in tasks:
+                yield decode_frames(self.layout, self.mmap, task[2])
+            return
+        workers = workers or multiprocessing.cpu_count()
+        executor = ProcessPoolExecutor(workers)
+        futures = deque()
+        try:
+            for task in tasks:
+                futures.append(executor.submit(_decode_chunk, task))
+                if len(futures) >= 2 * workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown()
+
+    def close(self):
+        '''Release the memory map.'''
+        if self.mmap:
+            self.mmap.close()
+            self.mmap = b''
+
+
+def convert(filename, output, workers=None, delimiter=',', header=True,
+            frames_per_chunk=256):
+    '''Convert a TOB3 file into CSV and return the number of records.
+
+    :param filename: Path of the TOB3 file.
+    :param output: File object where the CSV is written.
+    :param workers: Number of decoding processes (see `TOB3File.iter_rows`).
+    :param delimiter: CSV char delimiter.
+    :param header: Write the header line.
+    '''
+    tob3 = TOB3File(filename)
+    LOGGER.info('Convert %s (table %s)' % (filename,
+                                           tob3.header['TableName']))
+    if not is_py3:
+        delimiter = delimiter.encode('utf-8')
+    writer = csv.writer(output, delimiter=delimiter)
+    if header:
+        writer.writerow(tob3.fieldnames)
+    total = 0
+    try:
+        for rows in tob3.iter_rows(workers, frames_per_chunk):
+            writer.writerows(rows)
+            total += len(rows)
+    finally:
+        tob3.close()
+    return total
+
+
+def convert_parquet(filename, root, workers=None, frames_per_chunk=256,
+                    row_group_size=100000):
+    '''Convert a TOB3 file into a Parquet dataset partitioned by station,
+    table and day (see `ArrowSink`) and return the number of records.
+
+    :param filename: Path of the TOB3 file.
+    :param root: Root directory of the dataset.
+    :param workers: Number of decoding processes (see `TOB3File.iter_rows`).
+    '''
+    from .sinks import ArrowSink
+    tob3 = TOB3File(filename)
+    tablename = tob3.header['TableName']
+    LOGGER.info('Convert %s (table %s)' % (filename, tablename))
+    sink = ArrowSink(root, [tob3.table_def],
+                     station=tob3.header['Environment'][1],
+                     row_group_size=row_group_size)
+    total = 0
+    try:
+        for rows in tob3.iter_rows(workers, frames_per_chunk):
+            sink.write_rows(tablename, rows)
+            total += len(rows)
+    finally:
+        sink.close()
+        tob3.close()
+    return total
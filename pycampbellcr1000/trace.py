@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+'''
+    PyCampbellCR1000.trace
+    ----------------------
+
+    Binary capture of the PakBus frames written and read, to diagnose a
+    link without logging::
+
+        >>> device = CR1000(link, capture=FrameCapture('station.pcap'))
+
+    The file is a pcap file (user link type 147, readable by Wireshark): each
+    frame is the direction byte followed by the unquoted packet, signature
+    nullifier included.
+
+    :copyright: Copyright 2012 Salem Harrache and contributors, see AUTHORS.
+    :license: GNU GPL v3.
+
+'''
+from __future__ import division, unicode_literals
+import os
+import struct
+import threading
+import time
+
+from collections import namedtuple
+
+from .pakbus import PakBus
+
+# magic, version, time zone, accuracy, snapshot length, link type
+PCAP_HEADER = struct.Struct(str('<IHHiIII'))
+# seconds, microseconds, captured length, length
+PCAP_RECORD = struct.Struct(str('<IIII'))
+PCAP_MAGIC = 0xA1B2C3D4
+LINKTYPE_USER0 = 147
+
+Frame = namedtuple('Frame', ['time', 'direction', 'header', 'packet'])
+
+
+class FrameCapture(object):
+    '''Append the frames to a pcap file.
+
+    :param filename: The capture file, created if it does not exist.
+    :param flush_interval: Seconds between two flushes of the file, the
+                           frames are buffered meanwhile.
+    '''
+    OUT = b'>'
+    IN = b'<'
+
+    def __init__(self, filename, flush_interval=1):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        new = not os.path.exists(filename) or not os.path.getsize(filename)
+        self.file = open(filename, 'ab')
+        self.lock = threading.Lock()
+        self.flushed = time.time()
+        if new:
+            self.file.write(PCAP_HEADER.pack(PCAP_MAGIC, 2, 4, 0, 0, 65535,
+                                             LINKTYPE_USER0))
+
+    def write(self, direction, packet):
+        '''Record the `packet` sent (`OUT`) or received (`IN`) now.'''
+        now = time.time()
+        seconds = int(now)
+        length = len(packet) + 1
+        with self.lock:
+            self.file.write(PCAP_RECORD.pack(seconds,
+                                             int((now - seconds) * 1e6),
+                                             length, length))
+            self.file.write(direction)
+            self.file.write(packet)
+            if now - self.flushed >= self.flush_interval:
+                self.file.flush()
+                self.flushed = now
+
+    def flush(self):
+        '''Write the buffered frames to the capture file.'''
+        with self.lock:
+            self.file.flush()
+            self.flushed = time.time()
+
+    def close(self):
+        '''Write the buffered frames and close the capture file.'''
+        with self.lock:
+            self.file.close()
+
+
+def read_capture(filename):
+    '''Yield the frames of a capture file as `Frame` with the decoded
+    PakBus header.'''
+    with open(filename, 'rb') as file_input:
+        header = file_input.read(PCAP_HEADER.size)
+        if len(header) < PCAP_HEADER.size:
+            return
+        if PCAP_HEADER.unpack(header)[0] != PCAP_MAGIC:
+            raise ValueError('%s is not a capture file' % filename)
+        while True:
+            record = file_input.read(PCAP_RECORD.size)
+            if len(record) < PCAP_RECORD.size:
+                return
+            seconds, microseconds, length, size = PCAP_RECORD.unpack(record)
+            data = file_input.read(length)
+            if len(data) < length:
+                # partially written last frame
+                return
+            direction, packet = data[:1], data[1:]
+            header = PakBus.decode_header(packet) if len(packet) >= 8 \
+                else {}
+            yield Frame(seconds + microseconds / 1e6, direction, header,
+                        packet)
@@ -13,10 +13,12 @@ import time
 import calendar
 import csv
 import binascii
+import itertools
 
 from datetime import datetime
 
-from .compat import to_char, str, StringIO, is_py3, OrderedDict
+from .compat import (to_char, str, StringIO, is_py3, is_bytes, OrderedDict,
+                     intern)
 
 
 class Singleton(object):
@@ -105,11 +107,63 @@ def bytes_to_hex(byte):
     return ' '.join(data)
 
 
+class HexBytes(object):
+    '''Bytes shown in hex only when formatted, for lazy log messages::
+
+        >>> LOGGER.info('Write: %s', HexBytes(packet))
+    '''
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return bytes_to_hex(self.data)
+
+
 def hex_to_bytes(hexstr):
     '''Convert a string hex byte values into a byte string.'''
     return binascii.unhexlify(hexstr.replace(' ', '').encode('utf-8'))
 
 
+def field_name(name):
+    '''Return the name of a table or field definition as text.'''
+    if is_bytes(name):
+        return name.decode('utf-8')
+    return name
+
+
+def make_record(item, record_type=None, timestamps=False):
+    '''Return a record from an item of a parsed collectdata `RecFrag`.
+
+    :param item: The parsed record.
+    :param record_type: A `Record` class (see `record_type`), by default the
+                        record is a `Dict`.
+    :param timestamps: Give the record datetime as an integer UNIX timestamp.
+    '''
+    dtime = item['TimeOfRec']
+    if timestamps:
+        dtime = calendar.timegm(dtime.timetuple())
+    fields = item['Fields']
+    if record_type is not None:
+        return record_type((dtime, item['RecNbr']) +
+                           tuple([fields[key] for key in record_type._keys]))
+    record = Dict()
+    record["Datetime"] = dtime
+    record["RecNbr"] = item['RecNbr']
+    for key in fields:
+        record[field_name(key)] = fields[key]
+    return record
+
+
+def parse_datetime(value):
+    '''Parse a record datetime written as text by `str`, the microseconds
+    being only written when they are not null.'''
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
 def csv_to_dict(file_input, delimiter=','):
     '''Deserialize csv to list of dictionaries.'''
     delimiter = to_char(delimiter)
@@ -121,21 +175,106 @@ def csv_to_dict(file_input, delimiter=','):
     return ListDict(table)
 
 
+def csv_last_row(file_input, delimiter=',', blocksize=4096):
+    '''Return the last row of a csv file as Dict, or None if the file has no
+    data row. Only the header line and the end of the file are read, so the
+    cost does not depend on the file size.
+
+    :param file_input: A csv file opened in binary mode.
+    '''
+    file_input.seek(0)
+    header = file_input.readline()
+    file_input.seek(0, 2)
+    position = file_input.tell()
+    data = b''
+    # Seek backwards until the last line is complete
+    while position > len(header):
+        step = min(blocksize, position - len(header))
+        position -= step
+        file_input.seek(position)
+        data = file_input.read(step) + data
+        if b'\n' in data.rstrip(b'\r\n'):
+            break
+    last = data.rstrip(b'\r\n').split(b'\n')[-1]
+    if not last:
+        return None
+    lines = [header.rstrip(b'\r\n'), last.rstrip(b'\r')]
+    if is_py3:
+        lines = [line.decode('utf-8') for line in lines]
+    reader = csv.reader(lines, delimiter=to_char(delimiter),
+                        skipinitialspace=True)
+    names, values = list(reader)
+    return Dict(zip(names, values))
+
+
+class CSVWriter(object):
+    '''Incremental CSV writer bound to an `output` file.
+
+    Rows are formatted into a single reusable buffer and written to `output`
+    in blocks of about `bufsize` characters. The header is written once,
+    before the first row, and the values are read straight from the records
+    (any mapping) without copying them.
+
+    :param output: File-like object where the CSV is written.
+    :param fieldnames: The columns. By default the keys of the first record.
+    :param delimiter: CSV char delimiter.
+    :param header: Write the header line before the first row.
+    :param bufsize: Number of characters buffered before writing to output.
+    '''
+
+    def __init__(self, output, fieldnames=None, delimiter=',', header=True,
+                 bufsize=256 * 1024):
+        self.output = output
+        self.fieldnames = fieldnames
+        self.header = header
+        self.bufsize = bufsize
+        self.buffer = StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=to_char(delimiter))
+
+    def writerow(self, record):
+        '''Write one record.'''
+        self.writerows((record,))
+
+    def writerows(self, records):
+        '''Write all `records`.'''
+        records = iter(records)
+        if self.fieldnames is None:
+            first = next(records, None)
+            if first is None:
+                return
+            self.fieldnames = list(first.keys())
+            records = itertools.chain((first,), records)
+        if self.header:
+            self.writer.writerow(self.fieldnames)
+            self.header = False
+        fieldnames = self.fieldnames
+        self.writer.writerows([record.get(key, '') for key in fieldnames]
+                              for record in records)
+        if self.buffer.tell() >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        '''Write the buffered rows to output.'''
+        if self.buffer.tell():
+            self.output.write(self.buffer.getvalue())
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        if hasattr(self.output, 'flush'):
+            self.output.flush()
+
+    def close(self):
+        '''Flush the buffered rows. The output file is left open.'''
+        self.flush()
+
+
 def dict_to_csv(items, delimiter, header):
     '''Serialize list of dictionaries to csv.'''
     content = ""
     if len(items) > 0:
-        delimiter = to_char(delimiter)
         output = StringIO()
-        csvwriter = csv.DictWriter(output, fieldnames=items[0].keys(),
-                                   delimiter=delimiter)
-        if header:
-            csvwriter.writerow(dict((key, key) for key in items[0].keys()))
-            # writeheader is not supported in python2.6
-            # csvwriter.writeheader()
-        for item in items:
-            csvwriter.writerow(dict(item))
-
+        writer = CSVWriter(output, delimiter=delimiter, header=header)
+        writer.writerows(items)
+        writer.close()
         content = output.getvalue()
         output.close()
     return content
@@ -163,6 +302,98 @@ class Dict(OrderedDict):
         return dict_to_csv([self], delimiter, header)
 
 
+class Record(tuple):
+    '''A compact read-only record: a tuple of values, with the field names
+    stored once on its class (see `record_type`). It can be used as a
+    mapping of the field names to the values, like `Dict`.'''
+    __slots__ = ()
+    _fields = ()
+    _keys = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple.__getitem__(self, key)
+        return tuple.__getitem__(self, self._index[key])
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return dict(self.items()) == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % item for item in self.items()))
+
+    def __reduce__(self):
+        return (rebuild_record, (self._fields, self._keys,
+                                 tuple(self.values())))
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        if index is None:
+            return default
+        return tuple.__getitem__(self, index)
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return list(tuple.__iter__(self))
+
+    def items(self):
+        return list(zip(self._fields, tuple.__iter__(self)))
+
+    def filter(self, keys):
+        '''Create a `Dict` with only the following `keys`.'''
+        return Dict((key, self[key]) for key in keys if key in self._index)
+
+    def to_csv(self, delimiter=',', header=True):
+        '''Serialize the record to csv.'''
+        return dict_to_csv([self], delimiter, header)
+
+
+_record_types = {}
+
+
+def record_type(fields, keys=None, name='Record'):
+    '''Return the `Record` class of a table, created once for each list of
+    fields.
+
+    :param fields: The field names, with "Datetime" and "RecNbr" first.
+    :param keys: The keys of the data fields (without "Datetime" and
+                 "RecNbr") in the parsed `Fields` of a record, by default
+                 the field names.
+    :param name: The class name.
+    '''
+    name = field_name(name)
+    fields = tuple(intern(field_name(field)) for field in fields)
+    keys = tuple(keys if keys is not None else fields[2:])
+    if (fields, keys) not in _record_types:
+        attrs = {'__slots__': (), '_fields': fields, '_keys': keys,
+                 '_index': dict((field, i) for i, field in enumerate(fields))}
+        cls = type(name if is_py3 else name.encode('utf-8'), (Record,),
+                   attrs)
+        _record_types[fields, keys] = cls
+    return _record_types[fields, keys]
+
+
+def rebuild_record(fields, keys, values):
+    '''Unpickle a `Record`.'''
+    return record_type(fields, keys)(values)
+
+
 class ListDict(list):
     '''List of dicts with somes additional methods.'''
 
@@ -73,6 +73,10 @@ setup(
     packages=find_packages(),
     zip_safe=False,
     install_requires=REQUIREMENTS,
+    extras_require={
+        'parquet': ['pyarrow'],
+        'arrays': ['numpy'],
+    },
     test_suite='pycampbellcr1000.tests',
     entry_points={
         'console_scripts': [